@@ -308,7 +308,8 @@ class VideoAdmin(admin.ModelAdmin):
         (
             'Stats', {
                 'fields': (('view_count', 'number_of_likes', 'number_of_reports',
-                            'upload_session_length', 'video_length'),)
+                            'upload_session_length', 'video_length'),
+                           ('width', 'height', 'video_codec', 'bitrate'))
             }
         )
     )
@@ -319,6 +320,10 @@ class VideoAdmin(admin.ModelAdmin):
         'number_of_likes',
         'number_of_reports',
         'video_length',
+        'width',
+        'height',
+        'video_codec',
+        'bitrate',
         'upload_session_length',
         'video_content',
         'created',
@@ -353,7 +358,8 @@ class VideoAdmin(admin.ModelAdmin):
         reverse('admin:core_user_change', kwargs={'object_id': str(obj.owner.pk)}), obj.owner.username))
 
     def number_of_likes(self, obj):
-        return obj.likes.count()
+        return obj.like_count
+    number_of_likes.admin_order_field = 'like_count'
 
     def number_of_reports(self, obj):
         return ReportedVideo.objects.filter(video=obj).count()
@@ -0,0 +1,165 @@
+"""
+Grouping of bursts of activity in the feed. When a followed user likes (or follows) lots of things in a short time, the
+feed shows a single grouped item ("X liked 40 videos") instead of a separate item for each of them.
+
+The grouping is done by the database: the likes/follows of each followed user are bucketed by time
+(settings.FEED_GROUP_PERIOD) and the buckets with at least settings.FEED_GROUP_MIN_SIZE items are aggregated into
+grouped items. The rest are shown one by one.
+"""
+import datetime
+
+from django.conf import settings
+from django.contrib.postgres.aggregates import ArrayAgg
+from django.db.models import Count, Max, Q, Subquery, OuterRef, Value, ExpressionWrapper, IntegerField, DateTimeField, \
+    DurationField
+from django.db.models.functions import Trunc
+
+# The length of the time buckets, for the possible values of settings.FEED_GROUP_PERIOD
+PERIODS = {
+    'minute': datetime.timedelta(minutes=1),
+    'hour': datetime.timedelta(hours=1),
+    'day': datetime.timedelta(days=1),
+}
+
+
+class FeedGroup(object):
+    """
+    The likes or follows of a user in a time bucket. `object_ids` are the ids of the liked videos or followed users (in
+    no particular order), `objects` are those objects when the group is expanded.
+    """
+    def __init__(self, actor_id, bucket, size, newest, last_id, object_ids):
+        self.actor_id = actor_id
+        self.bucket = bucket
+        self.size = size
+        self.newest = newest
+        self.last_id = last_id
+        self.object_ids = object_ids
+        self.actor = None
+        self.objects = None
+
+    @property
+    def pk(self):
+        return self.last_id
+
+    @property
+    def feed_order(self):
+        return self.newest
+
+
+class LikeGroup(FeedGroup):
+    pass
+
+
+class FollowGroup(FeedGroup):
+    pass
+
+
+def _buckets(actor_field, keys):
+    """
+    A filter matching the rows of the (actor id, bucket) `keys`
+    """
+    period = PERIODS[settings.FEED_GROUP_PERIOD]
+    predicate = Q(pk__in=[])
+    for actor_id, bucket in keys:
+        predicate |= Q(**{actor_field: actor_id, 'created__gte': bucket, 'created__lt': bucket + period})
+    return predicate
+
+
+def _with_bucket(query_set):
+    return query_set.annotate(bucket=Trunc('created', settings.FEED_GROUP_PERIOD))
+
+
+class GroupedQuerySet(object):
+    """
+    The grouped items of a query set of likes or follows, with the part of the QuerySet interface the feed needs (see
+    MergingQuerySetAdapter and FeedSinceView). Each group is ordered by its newest item (`newest`), ties are broken by
+    the id of that (`last_id`).
+
+    Filters on the groups are on aggregates (a HAVING clause), so they don't limit the rows read. The rows are bounded
+    separately: by the cursor position (see `bound`) or by the buckets of the groups being loaded (see `in_bulk`).
+    """
+    def __init__(self, rows, model, actor_field, object_field, filters=(), ordering=None):
+        self.rows = rows
+        self.model = model
+        self.actor_field = actor_field
+        self.object_field = object_field
+        self.filters = filters
+        self.ordering = ordering
+
+    @classmethod
+    def group(cls, query_set, group_class, actor_field, object_field):
+        """
+        Group `query_set` by `actor_field` and time bucket, keeping only the big enough groups
+        """
+        return cls(query_set, group_class, actor_field, object_field)
+
+    def _copy(self, **kwargs):
+        attributes = dict(rows=self.rows, model=self.model, actor_field=self.actor_field,
+                          object_field=self.object_field, filters=self.filters, ordering=self.ordering)
+        attributes.update(kwargs)
+        return GroupedQuerySet(**attributes)
+
+    @property
+    def query_set(self):
+        grouped = _with_bucket(self.rows).order_by().values(self.actor_field, 'bucket') \
+            .annotate(size=Count('pk'), newest=Max('created'), last_id=Max('pk'),
+                      object_ids=ArrayAgg(self.object_field)) \
+            .filter(size__gte=settings.FEED_GROUP_MIN_SIZE)
+        for args, kwargs in self.filters:
+            grouped = grouped.filter(*args, **kwargs)
+        if self.ordering is not None:
+            grouped = grouped.order_by(*self.ordering)
+        return grouped
+
+    def bound(self, timestamp, reverse=False):
+        """
+        Only read the rows of the groups that can be older than `timestamp` (newer if `reverse`). The bound is one
+        period wider, so the bucket `timestamp` is in stays whole.
+        """
+        period = PERIODS[settings.FEED_GROUP_PERIOD]
+        if reverse:
+            return self._copy(rows=self.rows.filter(created__gte=timestamp - period))
+        return self._copy(rows=self.rows.filter(created__lt=timestamp + period))
+
+    def filter(self, *args, **kwargs):
+        return self._copy(filters=self.filters + ((args, kwargs),))
+
+    def order_by(self, *field_names):
+        return self._copy(ordering=field_names)
+
+    def values_list(self, *fields, **kwargs):
+        return self.query_set.values_list(*fields, **kwargs)
+
+    def in_bulk(self, id_list):
+        """
+        The groups by the id of their newest item. Only the rows in the buckets of those items are grouped.
+        """
+        keys = _with_bucket(self.rows.filter(pk__in=id_list)).values_list(self.actor_field, 'bucket')
+        groups = self._copy(rows=self.rows.filter(_buckets(self.actor_field, set(keys)))).filter(last_id__in=id_list)
+        return {group.last_id: group for group in groups[:]}
+
+    def __getitem__(self, key):
+        return [self.model(row[self.actor_field], row['bucket'], row['size'], row['newest'], row['last_id'],
+                           row['object_ids'])
+                for row in self.query_set[key]]
+
+
+def ungrouped(query_set, actor_field):
+    """
+    The likes or follows of `query_set` that aren't part of a group. The database leaves out the ones in a bucket with
+    a settings.FEED_GROUP_MIN_SIZE-th item, found with the (actor, created) index without counting the whole bucket.
+    """
+    period = settings.FEED_GROUP_PERIOD
+    min_size = settings.FEED_GROUP_MIN_SIZE
+    nth_in_bucket = query_set.model.objects.filter(**{
+        actor_field: OuterRef(actor_field),
+        'created__gte': OuterRef('bucket'),
+        'created__lt': OuterRef('bucket_end'),
+    }).order_by().values('pk')[min_size - 1:min_size]
+
+    return query_set.annotate(
+        bucket=Trunc('created', period),
+        bucket_end=ExpressionWrapper(Trunc('created', period) + Value(PERIODS[period], output_field=DurationField()),
+                                     output_field=DateTimeField())
+    ).annotate(nth_in_bucket=Subquery(nth_in_bucket, output_field=IntegerField())) \
+        .filter(nth_in_bucket__isnull=True)
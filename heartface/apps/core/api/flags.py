@@ -0,0 +1,59 @@
+"""
+The flags of videos that depend on the request user: `liked` and `following_owner` (see VideoSerializer).
+
+They are set on the page of videos being serialized, with a single query for the whole page, instead of subqueries on
+every row of the query set.
+"""
+from heartface.apps.core.models import Like
+from heartface.libs import follow_graph
+
+
+class VideoFlags(object):
+    """
+    The flags of videos for `user`. Whatever's been looked up once is memoized.
+    """
+    def __init__(self, user):
+        self.user = user
+        self._liked = {}
+        self._following = None
+
+    def annotate(self, videos):
+        """
+        Set the flags on `videos`. Returns them as a list.
+        """
+        videos = list(videos)
+        if not self.user.is_authenticated:
+            return videos
+
+        missing = {video.pk for video in videos if video.pk not in self._liked}
+        if missing:
+            liked = set(Like.objects.filter(user=self.user, video_id__in=missing).values_list('video_id', flat=True))
+            self._liked.update((video_id, video_id in liked) for video_id in missing)
+        if self._following is None:
+            self._following = follow_graph.following_ids(self.user.pk)
+
+        for video in videos:
+            video.liked = self._liked[video.pk]
+            video.following_owner = video.owner_id in self._following
+        return videos
+
+
+def annotate_videos(request, videos):
+    """
+    Set the flags of `videos` for the user of `request` (memoized for the request)
+    """
+    if not hasattr(request, '_video_flags'):
+        request._video_flags = VideoFlags(request.user)
+    return request._video_flags.annotate(videos)
+
+
+class VideoFlagsMixin(object):
+    """
+    For generic views of videos: the flags are set on whatever gets serialized, i.e. the page after it's sliced or the
+    single video.
+    """
+    def get_serializer(self, *args, **kwargs):
+        instance = args[0] if args else kwargs.get('instance')
+        if instance is not None:
+            annotate_videos(self.request, instance if kwargs.get('many', False) else [instance])
+        return super().get_serializer(*args, **kwargs)
@@ -1,3 +1,21 @@
+import binascii
+from base64 import b64decode, b64encode
+from collections import OrderedDict, namedtuple
+from urllib import parse
+
+from django.utils.dateparse import parse_datetime
+from django.utils.translation import ugettext_lazy as _
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, CursorPagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+# The position of an item in the (merged) feed. Items are ordered by their timestamp, ties are broken by the type and
+#  then by the id of the item.
+FeedPosition = namedtuple('FeedPosition', ['timestamp', 'type', 'id'])
+
+
 class PaginationMixin(object):
 
     @property
@@ -27,3 +45,113 @@ class PaginationMixin(object):
         """
         assert self.paginator is not None
         return self.paginator.get_paginated_response(data)
+
+
+class TimelineCursorPagination(CursorPagination):
+    """
+    Cursor pagination for the materialized feed timelines (FeedTimelineEntry)
+    """
+    # The id breaks ties, so items with the same timestamp aren't skipped or repeated between pages
+    ordering = ('-feed_order', '-id')
+
+
+class FeedCursorPagination(BasePagination):
+    """
+    Cursor pagination for the merged feed (see heartface.apps.core.api.views.feed.MergingQuerySetAdapter).
+
+    CursorPagination can't be used there: the items come from several tables ordered by different fields, so a position
+    in the feed isn't the value of a single field. The (opaque) cursor holds the FeedPosition of the item at the edge of
+    the page and the direction, and the adapter turns it into a keyset predicate on each of its query sets. This way
+    there are no duplicates or gaps between pages and fetching a page costs the same at any depth.
+    """
+    cursor_query_param = 'cursor'
+    page_size = api_settings.PAGE_SIZE
+    invalid_cursor_message = _('Invalid cursor')
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.base_url = request.build_absolute_uri()
+        position, reverse = self.decode_cursor(request)
+
+        if position is not None:
+            try:
+                queryset = queryset.seek(position, reverse)
+            except ValueError:
+                raise NotFound(self.invalid_cursor_message)
+
+        # Fetch an extra item to find out if there are more in this direction
+        results = queryset[0:self.page_size + 1]
+        has_more = len(results) > self.page_size
+        self.page = results[:self.page_size]
+        if reverse:
+            # Going backwards the items are fetched in ascending order
+            self.page.reverse()
+
+        if self.page:
+            self.has_next = position is not None if reverse else has_more
+            self.has_previous = has_more if reverse else position is not None
+            self.next_position = queryset.position(self.page[-1])
+            self.previous_position = queryset.position(self.page[0])
+        else:
+            self.has_next = self.has_previous = False
+
+        return self.page
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data)
+        ]))
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        return self.encode_cursor(self.next_position, reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        return self.encode_cursor(self.previous_position, reverse=True)
+
+    def decode_cursor(self, request):
+        """
+        The position and the direction encoded in the cursor of the request, (None, False) for the first page
+        """
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None, False
+
+        try:
+            return decode_feed_cursor(encoded)
+        except ValueError:
+            raise NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, position, reverse):
+        return replace_query_param(self.base_url, self.cursor_query_param, encode_feed_cursor(position, reverse))
+
+
+def encode_feed_cursor(position, reverse=False):
+    """
+    The opaque cursor of a position in the feed, for paging forwards (or backwards if `reverse`) from it
+    """
+    tokens = OrderedDict([('t', position.timestamp.isoformat()), ('k', position.type), ('i', position.id)])
+    if reverse:
+        tokens['r'] = '1'
+    return b64encode(parse.urlencode(tokens).encode('ascii')).decode('ascii')
+
+
+def decode_feed_cursor(encoded):
+    """
+    The (FeedPosition, reverse) encoded in a cursor. Raises ValueError if the cursor is invalid.
+    """
+    try:
+        tokens = parse.parse_qs(b64decode(encoded.encode('ascii')).decode('ascii'), keep_blank_values=True)
+        position = FeedPosition(parse_datetime(tokens['t'][0]), tokens['k'][0], int(tokens['i'][0]))
+        reverse = bool(int(tokens.get('r', ['0'])[0]))
+    except (TypeError, KeyError, UnicodeError, binascii.Error) as e:
+        raise ValueError('Invalid feed cursor: %s' % e)
+
+    if position.timestamp is None:
+        raise ValueError('Invalid feed cursor: no timestamp')
+
+    return position, reverse
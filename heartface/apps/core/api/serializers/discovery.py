@@ -37,6 +37,8 @@ class VideoSerializer(CustomElasticModelSerializer):
 
     # If the request.user in some view has liked this video
     liked = serializers.BooleanField(required=False, read_only=True)
+    like_count = serializers.IntegerField(read_only=True)
+    comment_count = serializers.IntegerField(read_only=True)
 
     class Meta:
         model = Video
@@ -51,6 +53,8 @@ class VideoSerializer(CustomElasticModelSerializer):
             'cover_picture',
             'owner',
             'likes',
+            'like_count',
+            'comment_count',
             'products',
             'hashtags',
             'publish',
@@ -63,7 +67,7 @@ class VideoSerializer(CustomElasticModelSerializer):
         """
         If request.user is following the video owner
         Set `is_followed` on obj.owner so PublicUserSerializer will render it
-        Use `annotate` or `with_liked_and_following` in the View to add `follwing_owner` to Videos in queryset.
+        Use heartface.apps.core.api.flags in the View to add `following_owner` to the Videos being serialized.
         """
         if hasattr(obj, 'following_owner'):
             obj.owner.is_followed = obj.following_owner
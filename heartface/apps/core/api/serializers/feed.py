@@ -3,6 +3,7 @@
 from rest_framework import serializers
 
 from heartface.apps.core.api.serializers.accounts import PublicUserSerializer
+from heartface.apps.core.api.serializers.discovery import VideoSerializer
 from heartface.apps.core.models import Like
 
 
@@ -20,3 +21,29 @@ class FollowSerializer(serializers.HyperlinkedModelSerializer):
             'created',
             'timestamp'
         ]
+
+
+class FeedGroupSerializer(serializers.Serializer):
+    """
+    A group of likes or follows of a user (see heartface.apps.core.api.feed_groups). `objects` is the list of the ids of
+    the liked videos/followed users, or the serialized objects when the group is expanded (`objects` are loaded).
+    """
+    object_serializer_class = None
+
+    actor = PublicUserSerializer(read_only=True)
+    count = serializers.IntegerField(source='size', read_only=True)
+    timestamp = serializers.DateTimeField(source='newest', read_only=True)
+    objects = serializers.SerializerMethodField()
+
+    def get_objects(self, group):
+        if group.objects is None:
+            return group.object_ids
+        return self.object_serializer_class(group.objects, many=True, context=self.context).data
+
+
+class LikeGroupSerializer(FeedGroupSerializer):
+    object_serializer_class = VideoSerializer
+
+
+class FollowGroupSerializer(FeedGroupSerializer):
+    object_serializer_class = PublicUserSerializer
@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+# coding=utf-8
+from django.conf import settings
+from rest_framework import serializers
+
+from heartface.apps.core.models import UploadSession
+
+
+class UploadSessionSerializer(serializers.ModelSerializer):
+    # The CRC-32 of the bytes received so far, as 8 hex digits
+    checksum = serializers.SerializerMethodField()
+
+    class Meta:
+        model = UploadSession
+        fields = [
+            'id',
+            'filename',
+            'length',
+            'offset',
+            'checksum',
+            'created',
+        ]
+        read_only_fields = ['offset', 'created']
+
+    def get_checksum(self, session):
+        return '%08x' % session.crc32
+
+    def validate_length(self, length):
+        if not 0 < length <= settings.VIDEO_UPLOAD_MAX_LENGTH:
+            raise serializers.ValidationError('Must be between 1 and %s bytes' % settings.VIDEO_UPLOAD_MAX_LENGTH)
+        return length
+
+
+class FinalizeUploadSerializer(serializers.Serializer):
+    # The CRC-32 of the whole file, to verify the upload with
+    checksum = serializers.RegexField(r'^[0-9a-fA-F]{8}$', required=False,
+                                      error_messages={'invalid': 'Must be 8 hex digits'})
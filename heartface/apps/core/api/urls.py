@@ -12,6 +12,7 @@ from heartface.apps.core.api.views.discovery import DiscoveryView, CollectionRet
 from heartface.apps.core.api.views.products import ProductViewSet, OrdersViewSet, SupplierProductViewSet, \
     SupplierViewSet, MissingProductViewSet
 from heartface.apps.core.api.views.notifications import NotificationViewSet, RegisterDeviceViewSet
+from heartface.apps.core.api.views.uploads import UploadSessionViewSet
 from heartface.apps.core.api.views.accounts import UserViewSet, FollowerView, \
     FollowingView, FollowingIDView, LikedVideosIDView, UsernameAvailableView
 
@@ -29,6 +30,7 @@ router.register('videos/(?P<id>\w+)/comments', CommentViewSet)
 router.register('users/(?P<id>\w+)/videos', UserVideosViewSet)
 router.register('orders', OrdersViewSet)
 router.register('missing-products', MissingProductViewSet)
+router.register('uploads', UploadSessionViewSet)
 
 urlpatterns = [
     url('', include(router.urls)),
@@ -40,6 +42,7 @@ urlpatterns = [
     url(r'^discovery/$', DiscoveryView.as_view()),
     url(r'^homepagecontent/$', HomepageContentView.as_view()),
     url(r'^feed/$', FeedView.as_view()),
+    url(r'^feed/since/$', FeedSinceView.as_view(), name='feed-since'),
     url(r'^recommended/follows/$', RecommendedFollowsListView.as_view()),
     url(r'^recommended/$', RecommendedVideosListView.as_view()),
     url(r'^users/(?P<user_id>\w+)/likes/$', LikedVideosListView.as_view()),
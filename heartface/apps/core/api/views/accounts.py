@@ -4,7 +4,6 @@ from heartface.apps.core.apps import stripe
 from django.conf import settings
 from django.db.models.signals import post_save
 from heartface.libs.utils import sendgrid_send_notification
-from django.db.models import Exists, OuterRef
 from django.dispatch import receiver
 from django.templatetags.static import static
 from djstripe.models import Customer
@@ -19,10 +18,10 @@ from rest_framework.settings import api_settings
 
 from allauth.account.utils import send_email_confirmation
 from allauth.account.models import EmailAddress
-from heartface.apps.core.models import User, Video, Follow, Notification
+from heartface.apps.core.models import User, Video, Notification
 from heartface.apps.core.permissions import SelfOrReadOnly, IsAuthenticatedAndEnabled, IsAuthenticatedAndMaybeDisabled
 from heartface.apps.core.api.serializers.accounts import *
-from heartface.libs import notifications
+from heartface.libs import follow_graph, notifications
 
 
 class UserViewSet(mixins.CreateModelMixin,
@@ -166,12 +165,13 @@ class UserViewSet(mixins.CreateModelMixin,
         Expected Response: A list of serialized User instances that the User with pk=id is following
         """
         user = self.get_object()
-        following_qs = user.following.filter(disabled=False)
+        following = list(User.objects.filter(pk__in=follow_graph.following_ids(user.pk), disabled=False))
         if request.user.is_authenticated:
-            # Annotate with `is_followed`. True if the request user is following the specific user in the QuerySet
-            following_qs = following_qs.annotate(is_followed=Exists(Follow.objects.filter(followed=OuterRef('pk'),
-                                                                                          follower=request.user)))
-        return Response(PublicUserSerializer(following_qs, many=True, context={'request': request}).data)
+            # Set `is_followed`. True if the request user is following the specific user in the list
+            request_user_following = follow_graph.following_ids(request.user.pk)
+            for followed_user in following:
+                followed_user.is_followed = followed_user.pk in request_user_following
+        return Response(PublicUserSerializer(following, many=True, context={'request': request}).data)
 
     @detail_route(methods=['GET'])
     def stripe_key(self, request, pk=None):
@@ -323,7 +323,7 @@ class FollowingView(ListAPIView):
     permission_classes = (IsAuthenticatedAndEnabled,)
 
     def get_queryset(self):
-        return self.request.user.following.filter(disabled=False)
+        return User.objects.filter(pk__in=follow_graph.following_ids(self.request.user.pk), disabled=False)
 
 
 class FollowingIDView(ListAPIView):
@@ -342,7 +342,8 @@ class FollowingIDView(ListAPIView):
     serializer_class = GenericIDSerializer.for_model(User)
 
     def get_queryset(self):
-        return User.objects.filter(followers=self.request.user).exclude(disabled=True).values('id')
+        return User.objects.filter(pk__in=follow_graph.following_ids(self.request.user.pk)) \
+            .exclude(disabled=True).values('id')
 
 
 class LikedVideosIDView(ListAPIView):
@@ -1,18 +1,20 @@
+import heapq
 import os
-import random
 import math
 
 from logging import getLogger
 
 import uuid
+import redis
 from django.contrib.auth.models import AnonymousUser
 from django.db import IntegrityError
-from django.db.models import QuerySet, F
+from django.db.models import QuerySet, F, Q, prefetch_related_objects
 from django.utils import timezone
 from django.templatetags.static import static
+from django.urls import reverse
 
-from collections import namedtuple
-from itertools import chain
+from collections import namedtuple, defaultdict
+from itertools import islice
 from typing import List
 
 from rest_framework import mixins
@@ -21,58 +23,158 @@ from rest_framework import viewsets
 from rest_framework.decorators import detail_route, list_route
 from rest_framework.exceptions import NotFound, ValidationError
 from rest_framework.generics import get_object_or_404, ListAPIView
-from rest_framework.pagination import CursorPagination
 from rest_framework.parsers import MultiPartParser, FileUploadParser
 from rest_framework.permissions import AllowAny
 from rest_framework.response import Response
 from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
 from rest_framework.views import APIView
 
-from heartface.apps.core.api.pagination import PaginationMixin
+from heartface.apps.core.api.feed_groups import GroupedQuerySet, LikeGroup, FollowGroup, ungrouped
+from heartface.apps.core.api.flags import VideoFlagsMixin, annotate_videos
+from heartface.apps.core.api.pagination import PaginationMixin, TimelineCursorPagination, FeedCursorPagination, \
+    FeedPosition, encode_feed_cursor, decode_feed_cursor
 
 from heartface.apps.core.api.serializers.discovery import *
-from heartface.apps.core.api.serializers.feed import FollowSerializer
+from heartface.apps.core.api.serializers.feed import FollowSerializer, LikeGroupSerializer, FollowGroupSerializer
 from heartface.apps.core.api.serializers.products import VideoProductTagRequestSerializer
 from heartface.apps.core.models import Comment, Like, User, Product, View, Notification
-from heartface.apps.core.models import Follow, DefaultFollowRecommendation
+from heartface.apps.core.models import Follow, DefaultFollowRecommendation, FeedTimelineEntry
 from heartface.apps.core.permissions import IsAuthenticatedAndEnabled, IsOwnerOrReadOnly
-from heartface.apps.core.tasks import upload_video
+from heartface.apps.core.tasks import upload_video, archive_videos
+from heartface.libs import cdn_availability
+from heartface.libs import follow_graph
 from heartface.libs import notifications
+from heartface.libs import recommendations
+from heartface.libs import seen_filter
+from heartface.libs import timeline
+from heartface.libs import view_ingestion
 from heartface.libs.utils import sendgrid_send_notification
 
 log = getLogger(__name__)
 
-FeedSerializationInfo = namedtuple('FeedSerializationInfo', ['serializer_class', 'type_name'])
+# How the items of a type are serialized, and the relations of theirs to prefetch for it (besides the videos', see
+#  FeedView.video_prefetch)
+FeedSerializationInfo = namedtuple('FeedSerializationInfo', ['serializer_class', 'type_name', 'prefetch'])
+
+# The types of items in the feed. Their order breaks the ties between items of different types with the same timestamp.
+FEED_TYPES = ('video', 'like', 'comment', 'follow', 'like_group', 'follow_group')
+
+# The item types that can be selected with the `types` parameter of the feed, with the types of the items they stand for
+FEED_TYPE_FILTERS = {
+    'video': ('video',),
+    'like': ('like', 'like_group'),
+    'comment': ('comment',),
+    'follow': ('follow', 'follow_group'),
+}
+
+# A query set the feed is merged from, with the name of the type of its items, the field they're ordered by and the
+#  field that breaks the ties (the id)
+FeedSource = namedtuple('FeedSource', ['type_name', 'query_set', 'order_field', 'id_field'])
 
 
 class MergingQuerySetAdapter(object):
     """
-    An adapter class providing the necessary interface methods of QuerySet required by CursorPagination to work. It
-    merges the results from the provided list of querysets. It's not a generic class, just an adapter and its logic
-    is tied to the feed.
+    An adapter class providing the interface FeedCursorPagination needs over the query sets of the feed. It merges the
+    results from the provided list of sources. It's not a generic class, just an adapter and its logic is tied to the
+    feed.
+
+    Each source is ordered by its own feed_order field (and the id for ties). The merged feed is ordered by FeedPosition,
+    i.e. (timestamp, type, id), descending (or ascending if `reverse`, used for paging backwards).
+
+    The merge is lazy: the query sets are read in small chunks and merged on a heap (k-way merge), so we stop fetching as
+    soon as the page is full instead of loading a full page from every one of them.
+
+    Reading is done in two phases. The merge only reads the (timestamp, id) pairs of the items, so it yields
+    FeedPositions. The full objects are loaded with `load()` for the positions that made it into the page.
     """
-    def __init__(self, query_sets: List[QuerySet], sort_key: str):
-        self.query_sets = query_sets
-        self.reverse = sort_key.startswith('-')
-        self.sort_key = sort_key[1:] if self.reverse else sort_key
-        self._orig_sort_key = sort_key
+    # Never fetch less than this many rows in one go from a query set
+    min_chunk_size = 5
+
+    def __init__(self, sources: List[FeedSource], reverse=False):
+        self.sources = sources
+        self.reverse = reverse
 
-    def filter(self, *args, **kwargs):
-        return MergingQuerySetAdapter([q.filter(*args, **kwargs) for q in self.query_sets], self._orig_sort_key)
+    def position(self, item):
+        # The items of the merge are the positions themselves
+        return item
 
-    def order_by(self, *args, **kwargs):
-        # print('** New MergingQuerySetAdapter [order_by=%s]' % args)
-        return MergingQuerySetAdapter(self.query_sets, *args)
+    def seek(self, position: FeedPosition, reverse=False):
+        """
+        The items after `position` (or the ones before it, in ascending order, if `reverse`). This is how the cursor
+        position gets pushed down to each query set: one keyset predicate per source, which its index can answer.
+        """
+        if position.type not in FEED_TYPES:
+            raise ValueError('Unknown feed item type: %s' % position.type)
+        rank = FEED_TYPES.index(position.type)
+        lookup = 'gt' if reverse else 'lt'
+
+        sources = []
+        for source in self.sources:
+            field, source_rank = source.order_field, FEED_TYPES.index(source.type_name)
+            if source_rank == rank:
+                predicate = Q(**{'%s__%s' % (field, lookup): position.timestamp}) | \
+                            Q(**{field: position.timestamp, '%s__%s' % (source.id_field, lookup): position.id})
+            elif (source_rank < rank) != reverse:
+                # Items of this type come after the one at `position` when they have the same timestamp
+                predicate = Q(**{'%s__%se' % (field, lookup): position.timestamp})
+            else:
+                predicate = Q(**{'%s__%s' % (field, lookup): position.timestamp})
+            query_set = source.query_set
+            if isinstance(query_set, GroupedQuerySet):
+                # The predicate is on aggregates, the rows read need a bound of their own
+                query_set = query_set.bound(position.timestamp, reverse)
+            sources.append(source._replace(query_set=query_set.filter(predicate)))
+
+        return MergingQuerySetAdapter(sources, reverse)
 
     def __getitem__(self, key):
         """
         This is where the merging/magic happens.
         """
-        # We're disregarding the start of the slice (the offset) here, because we don't know which queriset it belongs to
-        #  (if it belongs to one and not caused by a collision between multiple ones). We'll apply it later.
-        results = list(chain.from_iterable(q[:key.stop] for q in self.query_sets))
-        # print('** Sorint by [key=%s, reverse=%s]' % (self.sort_key, self.reverse))
-        return list(sorted(results, key=lambda o: getattr(o, self.sort_key), reverse=self.reverse)[key])
+        # We're disregarding the start of the slice (the offset) while fetching, because we don't know which queryset it
+        #  belongs to. It's skipped in the merged stream instead.
+        chunk_size = max(self.min_chunk_size, math.ceil(key.stop / (len(self.sources) or 1)))
+        merged = heapq.merge(*(self._iterate(source.type_name, self._ordered(source), chunk_size)
+                               for source in self.sources),
+                             key=self._sort_key, reverse=not self.reverse)
+        return list(islice(merged, key.start, key.stop))
+
+    def load(self, positions):
+        """
+        The objects at `positions` in the same order (one query per item type). The ones that are gone since the merge
+        are left out.
+        """
+        ids_by_type = defaultdict(list)
+        for position in positions:
+            ids_by_type[position.type].append(position.id)
+
+        objects = {source.type_name: source.query_set.in_bulk(ids_by_type[source.type_name])
+                   for source in self.sources if source.type_name in ids_by_type}
+        return [objects[position.type][position.id] for position in positions
+                if position.id in objects.get(position.type, {})]
+
+    @staticmethod
+    def _sort_key(position):
+        return position.timestamp, FEED_TYPES.index(position.type), position.id
+
+    def _ordered(self, source):
+        direction = '' if self.reverse else '-'
+        return source.query_set.order_by(direction + source.order_field, direction + source.id_field) \
+            .values_list(source.order_field, source.id_field)
+
+    @staticmethod
+    def _iterate(type_name, query_set, chunk_size):
+        """
+        Iterate over the positions of the items of `query_set` fetching `chunk_size` rows at a time
+        """
+        start = 0
+        while True:
+            chunk = list(query_set[start:start + chunk_size])
+            yield from (FeedPosition(timestamp, type_name, item_id) for timestamp, item_id in chunk)
+            if len(chunk) < chunk_size:
+                return
+            start += chunk_size
 
 
 class RecommendedFollowsListView(ListAPIView):
@@ -105,50 +207,230 @@ class FeedView(PaginationMixin, APIView):
     endpoint format: /api/v1/feed/
     Request Body: N/A
     Expected status code: HTTP_200_OK
+    URL parameters:
+    - types: Comma separated list of the item types to include (video, like, comment, follow), all by default
+    - expand: `groups` to include the serialized objects of grouped items instead of just their ids
     Expected Response: A list of serialized Video feed instances of user's followed by Logged in user.
+
+    Bursts of likes and follows of a user are shown as a single grouped item (`like_group`, `follow_group`, see
+    heartface.apps.core.api.feed_groups), in pull mode only.
+
+    Depending on settings.FEED_MODE the feed is either computed from the activity of the followed users (pull) or read
+    from the user's materialized timeline (push).
     """
-    pagination_class = CursorPagination
     permission_classes = (IsAuthenticatedAndEnabled,)
-    # NOTE: this doesn't really work and will be replaced with 'created' by cursor pagination. (Using a non-field
-    #  doesn't work, because CursorPagination will have to use a field for filtering as well.)
-    sort_key = '-feed_order'
-    # sort_key = '-created'
 
     serialization_info = {
-        Video: FeedSerializationInfo(VideoSerializer, 'video'),
-        Like: FeedSerializationInfo(LikeSerializer, 'like'),
-        Comment: FeedSerializationInfo(CommentSerializer, 'comment'),
-        Follow: FeedSerializationInfo(FollowSerializer, 'follow')
+        Video: FeedSerializationInfo(VideoSerializer, 'video', ()),
+        Like: FeedSerializationInfo(LikeSerializer, 'like', ('user', 'video')),
+        Comment: FeedSerializationInfo(CommentSerializer, 'comment', ('author', 'video')),
+        Follow: FeedSerializationInfo(FollowSerializer, 'follow', ('followed', 'follower')),
+        LikeGroup: FeedSerializationInfo(LikeGroupSerializer, 'like_group', ()),
+        FollowGroup: FeedSerializationInfo(FollowGroupSerializer, 'follow_group', ()),
     }
 
+    # Everything VideoSerializer needs. Videos are in the feed on their own and in likes and comments too.
+    video_prefetch = ('owner', 'likes', 'hashtags', 'products__pictures', 'products__supplier_info__supplier',
+                      'products__supplier_info__product', 'products__marketplace_urls__marketplace')
+
+    @property
+    def pagination_class(self):
+        return TimelineCursorPagination if timeline.is_push_mode() else FeedCursorPagination
+
     def get(self, request, *args, **kwargs):
-        page = self.paginate_queryset(MergingQuerySetAdapter(self.get_query_set_list(), self.sort_key)) or []
+        if timeline.is_push_mode():
+            page = self.get_timeline_items(self.paginate_queryset(self.get_timeline_entries()) or [])
+        else:
+            adapter = MergingQuerySetAdapter(self.get_sources())
+            page = adapter.load(self.paginate_queryset(adapter) or [])
+
+        response = self.get_paginated_response(self.serialize_page(page))
+        if self.paginator.cursor_query_param not in request.query_params:
+            # The top of the feed: clients can poll this to find out if there's anything new
+            response.data['since'] = self.get_since_link(page)
+        return response
+
+    def get_since_link(self, page):
+        """
+        The link to the number of items newer than the first one of `page` (see FeedSinceView)
+        """
+        url = self.request.build_absolute_uri(reverse('feed-since'))
+        if 'types' in self.request.query_params:
+            url = replace_query_param(url, 'types', self.request.query_params['types'])
+        if not page:
+            return url
+        return replace_query_param(url, 'cursor', encode_feed_cursor(self.get_position(page[0]), reverse=True))
 
-        data = []
+    def get_position(self, item):
+        return FeedPosition(item.feed_order, self.serialization_info[type(item)].type_name, item.pk)
 
+    def serialize_page(self, page):
+        """
+        Serialize a page of feed items. The items are grouped by type, everything they reference is loaded for the whole
+        page at once (so the number of queries doesn't depend on the number or the content of the items) and each group
+        is serialized in one go.
+        """
+        items_by_type = defaultdict(list)
         for item in page:
-            info = self.serialization_info[type(item)]
-            data.append({'type': info.type_name, 'content': info.serializer_class(item, context={'request': request}).data})
-
-        return self.get_paginated_response(data)
-
-    def get_query_set_list(self):
-        following = self.request.user.following.filter(disabled=False)
-        return [
-            # NOTE: using different fields for ordering doesn't really work while using (an unmodified) CursorPagination.
-            Video.objects.filter(
-                owner__in=following, owner__disabled=False, published__isnull=False, cdn_available__isnull=False)
-            .prefetch_related('owner').with_liked_and_following(self.request.user)\
-            .order_by('-published', '-created'),
-            Like.objects.filter(user__in=following).order_by('-created'),
-            Comment.objects.filter(author__in=following).order_by('-created'),
-            # We show in the feed if a user we follow starts following someone (if someone starts following us, that goes
-            #  into the notifications)
-            Follow.objects.filter(follower__in=following).exclude(follower=self.request.user).order_by('-created')
+            items_by_type[type(item)].append(item)
+
+        videos = list(items_by_type.get(Video, []))
+        for model, items in items_by_type.items():
+            prefetch_related_objects(items, *self.serialization_info[model].prefetch)
+            if 'video' in self.serialization_info[model].prefetch:
+                videos.extend(item.video for item in items)
+        videos.extend(self.load_groups(items_by_type.get(LikeGroup, []), items_by_type.get(FollowGroup, [])))
+        annotate_videos(self.request, items_by_type.get(Video, []) + [
+            video for group in items_by_type.get(LikeGroup, []) for video in group.objects or ()])
+        prefetch_related_objects(videos, *self.video_prefetch)
+
+        serialized = {}
+        for model, items in items_by_type.items():
+            info = self.serialization_info[model]
+            data = info.serializer_class(items, many=True, context={'request': self.request}).data
+            serialized.update((id(item), {'type': info.type_name, 'content': content})
+                              for item, content in zip(items, data))
+
+        return [serialized[id(item)] for item in page]
+
+    def load_groups(self, like_groups, follow_groups):
+        """
+        Load the actors of the grouped items and, if they're expanded, their objects. Returns the videos loaded.
+        """
+        groups = like_groups + follow_groups
+        actors = User.objects.in_bulk({group.actor_id for group in groups})
+        for group in groups:
+            group.actor = actors[group.actor_id]
+
+        if self.request.query_params.get('expand') != 'groups':
+            return []
+
+        for typed_groups, query_set in ((like_groups, Video.objects.all()), (follow_groups, User.objects.all())):
+            objects = query_set.in_bulk({object_id for group in typed_groups for object_id in group.object_ids})
+            for group in typed_groups:
+                group.objects = [objects[object_id] for object_id in group.object_ids if object_id in objects]
+        return [video for group in like_groups for video in group.objects]
+
+    def get_sources(self):
+        following = follow_graph.following_ids(self.request.user.pk)
+        likes = Like.objects.filter(user__in=following, user__disabled=False)
+        # We show in the feed if a user we follow starts following someone (if someone starts following us, that goes
+        #  into the notifications)
+        follows = Follow.objects.filter(follower__in=following, follower__disabled=False) \
+            .exclude(follower=self.request.user)
+        sources = [
+            FeedSource('video', Video.objects.filter(
+                owner__in=following, owner__disabled=False, published__isnull=False, cdn_available__isnull=False),
+                'published', 'pk'),
+            FeedSource('like', ungrouped(likes, 'user_id'), 'created', 'pk'),
+            FeedSource('comment', Comment.objects.filter(author__in=following, author__disabled=False), 'created', 'pk'),
+            FeedSource('follow', ungrouped(follows, 'follower_id'), 'created', 'pk'),
+            FeedSource('like_group', GroupedQuerySet.group(likes, LikeGroup, 'user_id', 'video_id'),
+                       'newest', 'last_id'),
+            FeedSource('follow_group', GroupedQuerySet.group(follows, FollowGroup, 'follower_id', 'followed_id'),
+                       'newest', 'last_id'),
         ]
+        # The query sets are lazy, the ones left out are never run
+        types = self.get_types()
+        return [source for source in sources if source.type_name in types]
+
+    def get_types(self):
+        """
+        The types of the items to show, from the `types` parameter
+        """
+        if not self.request.query_params.get('types'):
+            return set(FEED_TYPES)
+
+        selected = self.request.query_params['types'].split(',')
+        unknown = [type_name for type_name in selected if type_name not in FEED_TYPE_FILTERS]
+        if unknown:
+            raise ValidationError({'types': 'Unknown feed item type(s): %s' % ', '.join(unknown)})
+        return {type_name for selected_type in selected for type_name in FEED_TYPE_FILTERS[selected_type]}
+
+    def get_timeline_entries(self):
+        """
+        The timeline of the request user, with the entries of the selected types (push mode)
+        """
+        entries = timeline.timeline_for(self.request.user)
+        if self.request.query_params.get('types'):
+            types = FeedTimelineEntry.TYPES
+            entries = entries.filter(type__in=[getattr(types, type_name) for type_name in self.get_types()
+                                               if hasattr(types, type_name)])
+        return entries
+
+    def get_timeline_query_sets(self):
+        """
+        The query sets the objects referenced by the timeline are loaded from (push mode)
+        """
+        return {
+            FeedTimelineEntry.TYPES.video: Video.objects.filter(published__isnull=False, cdn_available__isnull=False),
+            FeedTimelineEntry.TYPES.like: Like.objects.all(),
+            FeedTimelineEntry.TYPES.comment: Comment.objects.all(),
+            FeedTimelineEntry.TYPES.follow: Follow.objects.all(),
+        }
+
+    def get_timeline_items(self, entries):
+        """
+        Load the objects referenced by a page of timeline entries (one query per item type) in timeline order. Entries
+        whose object isn't visible (yet), e.g. a video not available on the CDN, are left out.
+        """
+        object_ids = defaultdict(list)
+        for entry in entries:
+            object_ids[entry.type].append(entry.object_id)
+
+        query_sets = self.get_timeline_query_sets()
+        objects = {item_type: query_sets[item_type].in_bulk(ids) for item_type, ids in object_ids.items()}
+
+        return [objects[entry.type][entry.object_id] for entry in entries if entry.object_id in objects[entry.type]]
+
+
+class FeedSinceView(FeedView):
+    """
+    Count the feed items newer than a position in the feed, so clients can cheaply check if there's anything new before
+    fetching the feed again.
+    permissions: authenticated and enabled
+    methods accepted: GET
+    endpoint format: /api/v1/feed/since/?cursor=<cursor>
+    URL parameters:
+    - cursor: The cursor from the `since` link of the first page of the feed. Without it all items are counted.
+    - types: The item types to count, like in the feed
+    Expected status code: HTTP_200_OK
+    Expected Response: The number of newer items (at most settings.FEED_SINCE_MAX_COUNT) and the timestamp of the
+     newest one: {"count": <count>, "timestamp": <timestamp or null>}
+    """
+    def get(self, request, *args, **kwargs):
+        position = None
+        if 'cursor' in request.query_params:
+            try:
+                position = decode_feed_cursor(request.query_params['cursor'])[0]
+            except ValueError:
+                raise NotFound(FeedCursorPagination.invalid_cursor_message)
+
+        # Only the timestamps are read (from the feed indexes), at most FEED_SINCE_MAX_COUNT of each type
+        limit = settings.FEED_SINCE_MAX_COUNT
+        timestamps = []
+        for query_set, order_field in self.get_newer_query_sets(position):
+            timestamps.extend(query_set.order_by('-%s' % order_field).values_list(order_field, flat=True)[:limit])
+
+        return Response({'count': min(len(timestamps), limit), 'timestamp': max(timestamps, default=None)})
+
+    def get_newer_query_sets(self, position):
+        """
+        The query sets of the items newer than `position` with the field they're ordered by
+        """
+        if timeline.is_push_mode():
+            entries = self.get_timeline_entries()
+            if position is not None:
+                entries = entries.filter(feed_order__gt=position.timestamp)
+            return [(entries, 'feed_order')]
 
+        adapter = MergingQuerySetAdapter(self.get_sources())
+        if position is not None:
+            adapter = adapter.seek(position, reverse=True)
+        return [(source.query_set, source.order_field) for source in adapter.sources]
 
-class VideoViewSet(viewsets.ModelViewSet):
+
+class VideoViewSet(VideoFlagsMixin, viewsets.ModelViewSet):
     """
     Methods supported: GET, POST, PUT, PATCH, DELETE
     retrieve:
@@ -233,8 +515,6 @@ class VideoViewSet(viewsets.ModelViewSet):
     permission_classes = (IsOwnerOrReadOnly, )
 
     def get_queryset(self):
-        if not self.request.user.is_anonymous:
-            return Video.objects.filter(owner__disabled=False).with_liked_and_following(self.request.user).order_by('-published', '-created')
         return Video.objects.filter(owner__disabled=False).order_by('-published', '-created')
 
     def filter_queryset(self, queryset: QuerySet):
@@ -295,11 +575,20 @@ class VideoViewSet(viewsets.ModelViewSet):
         - id*: The pk of the Video object
         Expected status code: HTTP_201_CREATED
         Expected Response: Empty data
+
+        With settings.VIEW_INGESTION_MODE = 'buffered' the view is only queued and the View and view_count are updated
+        by the ingest_views task (see heartface.libs.view_ingestion).
         """
         user = request.user
         video = self.get_object()
         if request.method == 'POST':
             user = None if isinstance(request.user, AnonymousUser) else request.user
+            if view_ingestion.is_buffered():
+                # Counted later, by the ingest_views task
+                visitor = '%s %s' % (request.META.get('REMOTE_ADDR', ''), request.META.get('HTTP_USER_AGENT', ''))
+                if view_ingestion.record(video.pk, user_id=user and user.pk, visitor=visitor):
+                    return Response(data={}, status=status.HTTP_201_CREATED)
+                return Response(data={}, status=status.HTTP_200_OK)
             try:
                 if user is None:
                     # For anon user, just create the view as new entry
@@ -399,7 +688,7 @@ class VideoViewSet(viewsets.ModelViewSet):
 
         return Response(status=status.HTTP_200_OK)
 
-    @list_route(methods=['GET'], url_path='pushr-status')
+    @list_route(methods=['GET', 'POST'], url_path='pushr-status', permission_classes=[AllowAny])
     def pushr_status(self, request):
         """
         Pushr CDN will ping this hook with the query parameters of filename and status
@@ -409,39 +698,51 @@ class VideoViewSet(viewsets.ModelViewSet):
         In the event of a transcoding error they would also add the query parameter
         error with a description of what went wrong.
 
+        Several statuses can be reported at once with a POST of
+        {"statuses": [{"filename": ..., "status": ..., "error": ...}, ...]}, the response
+        lists the filenames of the unknown videos as "missing".
+
         This endpoint is for pushr use only
         """
-        errors = []
-        filename = request.GET.get('filename')
-        status = request.GET.get('status')
-        error = request.GET.get('error')
+        if request.method == 'POST':
+            reported = request.data.get('statuses') if isinstance(request.data, dict) else None
+            if not isinstance(reported, list) or not all(isinstance(params, dict) for params in reported):
+                log.error("Pushr got wrong request: no list of statuses")
+                return Response(status=400, content_type='application/json',
+                                data={'errors': ['missing "statuses" list in the body']})
+        else:
+            reported = [request.GET]
 
-        if not filename:
-            errors.append('missing ?filename parameter in URL')
-        if not status and not error:
-            errors.append('missing ?status or ?error parameters in URL')
+        errors = []
+        statuses = []
+        for params in reported:
+            filename = params.get('filename')
+            cdn_status = params.get('status')
+            error = params.get('error')
+
+            if not filename:
+                errors.append('missing ?filename parameter in URL')
+            if not cdn_status and not error:
+                errors.append('missing ?status or ?error parameters in URL')
+
+            if error:
+                statuses.append((filename, 'error', error))
+            else:
+                statuses.append((filename, cdn_status, ''))
 
         if errors:
             log.error("Pushr got wrong request: %s", errors)
             return Response(status=400, content_type='application/json', data={'errors': errors})
 
-        filename = filename[0]
-        if error:
-            status = 'error'
-            description = error[0]
-        else:
-            description = ''
-            status = status[0]
-
-        try:
-            # 'videos/%s' % filename because in db we store them relative to Upload
-            video = Video.objects.get(videofile='videos/%s' % filename)
-        except Video.DoesNotExist:
+        missing, marked = cdn_availability.record_statuses(statuses)
+        archive_videos(marked)
+        for filename in missing:
             log.error("Unable to find video for file %s", filename)
-            return Response(status=404, data={})
-
-        video.cdn_status.create(status=status, description=description, filename=filename)
 
+        if request.method == 'POST':
+            return Response(status=200, data={'missing': missing})
+        if missing:
+            return Response(status=404, data={})
         return Response(status=200, data={})
 
     @list_route(methods=['POST'])
@@ -550,7 +851,7 @@ class VideoViewSet(viewsets.ModelViewSet):
                 return Response(status=status.HTTP_200_OK)
 
 
-class BaseListVideoView(ListAPIView):
+class BaseListVideoView(VideoFlagsMixin, ListAPIView):
     permission_classes = ()
     pagination_class = api_settings.DEFAULT_PAGINATION_CLASS
     serializer_class = VideoSerializer
@@ -591,57 +892,25 @@ class RecommendedVideosListView(BaseListVideoView):
         """
         Videos that user with id `user_id` has liked
         """
-        # Make sure whatever that the videos are published, cdn available with active owner
-        base_qs = Video.objects.filter(owner__disabled=False, published__isnull=False, cdn_available__isnull=False)
-
-        videos = []  # Final set to return
         VIDEO_SET_SIZE = 5  # How many videos should be in final set
 
-        # Get unseen admin recommended videos as first preference
-        recommended_videos = base_qs.filter(recommended=True).exclude(view__user=self.request.user)
-        sample_size = min(VIDEO_SET_SIZE, len(recommended_videos))
-        videos = random.sample(list(recommended_videos), sample_size)
-        missing_count = VIDEO_SET_SIZE - len(videos)
-
-        if missing_count > 0:
-            # Need to augment videos set from other sources
-            unseen_videos = list(base_qs.exclude(pk__in=recommended_videos)\
-                                 .exclude(view__user=self.request.user).order_by('-view_count'))
-            # Get top 10%, 10-20%, 20-30% videos from user unseen
-            top_10_pc_cutoff = math.ceil(0.1 * len(unseen_videos))
-            top_20_pc_cutoff = math.ceil(0.2 * len(unseen_videos))
-            top_30_pc_cutoff = math.ceil(0.3 * len(unseen_videos))
-            top_10_pc_videos = unseen_videos[:top_10_pc_cutoff]
-            top_20_pc_videos = unseen_videos[top_10_pc_cutoff: top_20_pc_cutoff]
-            top_30_pc_videos = unseen_videos[top_20_pc_cutoff: top_30_pc_cutoff]
-            # Try to take `missing_count` random videos from top 10
-            sample_size = min(missing_count, len(top_10_pc_videos))
-            videos.extend(random.sample(top_10_pc_videos, sample_size))
-            # Update missing count
-            missing_count = VIDEO_SET_SIZE - len(videos)
-            if missing_count > 0:
-                # Try to take `missing_count` videos from top 20
-                sample_size = min(missing_count, len(top_20_pc_videos))
-                videos.extend(random.sample(top_20_pc_videos, sample_size))
-                missing_count = VIDEO_SET_SIZE - len(videos)
-                if missing_count > 0:
-                    # Try to take `missing_count` videos from top 30
-                    sample_size = min(missing_count, len(top_30_pc_videos))
-                    videos.extend(random.sample(top_30_pc_videos, sample_size))
-
-        # If still missing some, just augment with random already seen rec vids
-        missing_count = VIDEO_SET_SIZE - len(videos)
-        if missing_count > 0:
-            extra_recommended_videos = recommended_videos.exclude(pk__in=[video.pk for video in videos])
-            sample_size = min(missing_count, len(extra_recommended_videos))
-            videos.extend(random.sample(list(extra_recommended_videos), sample_size))
-
-
-        # Convert these back to queryset
-        qs = Video.objects.filter(pk__in=[video.id for video in videos])
-        if not self.request.user.is_anonymous:
-            qs = qs.with_liked_and_following(self.request.user)
-        return qs.order_by('-view_count')
+        # Sampled from the precomputed candidate pools (see heartface.libs.recommendations)
+        seen = None
+        if self.request.user.is_authenticated:
+            if seen_filter.is_enabled():
+                try:
+                    seen = seen_filter.load(self.request.user.pk)
+                except redis.RedisError:
+                    log.error('Loading the seen filter of user [id=%s] failed, reading their views instead',
+                              self.request.user.pk, exc_info=True)
+            if seen is None:
+                seen = set(View.objects.filter(user=self.request.user).values_list('video_id', flat=True))
+        else:
+            seen = set()
+        video_ids = recommendations.recommend(VIDEO_SET_SIZE, seen)
+
+        # Only the picked videos are loaded (and the pools may be a bit stale, so they're checked again)
+        return recommendations.candidates().filter(pk__in=video_ids).order_by('-view_count')
 
 
 class HashtagViewSet(mixins.CreateModelMixin, mixins.ListModelMixin, mixins.RetrieveModelMixin,
@@ -731,7 +1000,7 @@ class CommentViewSet(mixins.CreateModelMixin, mixins.ListModelMixin, mixins.Retr
                                        dynamic_template_data, settings.SENDGRID_VIDEO_COMMENT_UNSUB_GROUP_ID)
 
 
-class UserVideosViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
+class UserVideosViewSet(VideoFlagsMixin, mixins.ListModelMixin, viewsets.GenericViewSet):
     """
     Get videos that user with id `user_id` uploaded
     permissions: any
@@ -0,0 +1,201 @@
+import logging
+import os
+import uuid
+import zlib
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from rest_framework import mixins
+from rest_framework import status
+from rest_framework import viewsets
+from rest_framework.decorators import detail_route
+from rest_framework.exceptions import ValidationError
+from rest_framework.generics import get_object_or_404
+from rest_framework.response import Response
+
+from heartface.apps.core.api.serializers.discovery import VideoSerializer
+from heartface.apps.core.api.serializers.uploads import UploadSessionSerializer, FinalizeUploadSerializer
+from heartface.apps.core.models import UploadSession, Video
+from heartface.apps.core.permissions import IsAuthenticatedAndEnabled
+
+logger = logging.getLogger(__name__)
+
+
+class UploadSessionViewSet(mixins.CreateModelMixin, mixins.RetrieveModelMixin, mixins.DestroyModelMixin,
+                           viewsets.GenericViewSet):
+    """
+    Resumable, chunked upload of video files (modelled after the tus protocol): create an upload session, send the
+    file in as many chunks as needed (resuming from the offset the server has if a request fails), then finalize the
+    session to create the video.
+
+    The chunks are written straight into the file under MEDIA_ROOT/videos, in blocks of
+    settings.VIDEO_UPLOAD_BLOCK_SIZE, while keeping a running CRC-32 of the data. Nothing is buffered in memory.
+
+    create:
+        Start an upload
+        permissions: authenticated and enabled
+        methods accepted: POST
+        endpoint format: /api/v1/uploads/
+        Request Body:
+        - filename*: The name of the file being uploaded
+        - length*: The size of the file in bytes (at most settings.VIDEO_UPLOAD_MAX_LENGTH)
+        Expected status code: HTTP_201_CREATED
+        Expected Response: The serialized upload session, its URL in the Location header
+
+    retrieve:
+        The state of an upload, e.g. the offset to resume from. Also available with HEAD, in the Upload-Offset and
+        Upload-Length headers.
+        permissions: owner
+        methods accepted: GET, HEAD
+        endpoint format: /api/v1/uploads/:id/
+        Expected status code: HTTP_200_OK
+        Expected Response: The serialized upload session
+
+    partial_update:
+        Upload a chunk of the file
+        permissions: owner
+        methods accepted: PATCH
+        endpoint format: /api/v1/uploads/:id/
+        Headers:
+        - Upload-Offset*: The offset of the chunk in the file, must be the current offset of the upload
+        - Content-Type: application/offset+octet-stream
+        Request Body: The bytes of the chunk
+        Expected status code: HTTP_204_NO_CONTENT, HTTP_409_CONFLICT if the offset doesn't match or another chunk is
+        being written
+        Expected Response: The new offset in the Upload-Offset header
+
+    finalize:
+        Create the video from the completed upload, like /api/v1/videos/upload/ does
+        permissions: owner
+        methods accepted: POST
+        endpoint format: /api/v1/uploads/:id/finalize/
+        Request Body:
+        - checksum: The CRC-32 of the whole file (8 hex digits), to verify the upload with
+        Expected status code: HTTP_201_CREATED
+        Expected Response: The serialized Video instance
+
+    destroy:
+        Abort an upload
+        permissions: owner
+        methods accepted: DELETE
+        endpoint format: /api/v1/uploads/:id/
+        Expected status code: HTTP_204_NO_CONTENT
+    """
+    queryset = UploadSession.objects.all()
+    serializer_class = UploadSessionSerializer
+    permission_classes = (IsAuthenticatedAndEnabled,)
+
+    def get_queryset(self):
+        return UploadSession.objects.filter(owner=self.request.user)
+
+    def perform_create(self, serializer):
+        # The same naming as /api/v1/videos/upload/
+        extension = os.path.splitext(serializer.validated_data['filename'])[1]
+        path = os.path.join('videos', '%s%s' % (uuid.uuid4(), extension))
+        full_path = os.path.join(settings.MEDIA_ROOT, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        open(full_path, 'wb').close()
+        serializer.save(owner=self.request.user, path=path)
+
+    def create(self, request, *args, **kwargs):
+        response = super().create(request, *args, **kwargs)
+        response['Location'] = request.build_absolute_uri('%s/' % response.data['id'])
+        return response
+
+    def retrieve(self, request, *args, **kwargs):
+        session = self.get_object()
+        return self.with_offset_headers(Response(self.get_serializer(session).data), session)
+
+    def partial_update(self, request, *args, **kwargs):
+        try:
+            offset = int(request.META['HTTP_UPLOAD_OFFSET'])
+        except (KeyError, ValueError):
+            raise ValidationError({'Upload-Offset': 'A valid Upload-Offset header is required'})
+        content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+
+        # The session is only locked to claim it, so no other request writes it meanwhile. The chunk is written
+        #  outside the transaction and the new offset saved only if the upload is still where it was.
+        with transaction.atomic():
+            session = self.get_locked_object()
+            if offset != session.offset or session.is_claimed:
+                return self.with_offset_headers(Response(status=status.HTTP_409_CONFLICT), session)
+            if offset + content_length > session.length:
+                raise ValidationError({'Upload-Offset': 'The chunk goes past the length of the upload'})
+            session.claimed_until = timezone.now() + settings.VIDEO_UPLOAD_CLAIM_TIMEOUT
+            session.save(update_fields=['claimed_until'])
+
+        try:
+            self.write_chunk(session, request.stream, content_length)
+        finally:
+            # Whatever was written is kept, even if the request failed
+            saved = UploadSession.objects.filter(pk=session.pk, offset=offset, claimed_until=session.claimed_until) \
+                .update(offset=session.offset, crc32=session.crc32, claimed_until=None, updated=timezone.now())
+        if not saved:
+            # Taken over by another request after the claim ran out
+            session = get_object_or_404(self.get_queryset(), pk=session.pk)
+            return self.with_offset_headers(Response(status=status.HTTP_409_CONFLICT), session)
+
+        return self.with_offset_headers(Response(status=status.HTTP_204_NO_CONTENT), session)
+
+    @detail_route(methods=['POST'])
+    def finalize(self, request, pk=None):
+        serializer = FinalizeUploadSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        checksum = serializer.validated_data.get('checksum')
+
+        with transaction.atomic():
+            session = self.get_locked_object()
+            if not session.is_complete:
+                raise ValidationError({'offset': 'The upload is incomplete: %s of %s bytes received'
+                                                 % (session.offset, session.length)})
+            if checksum is not None and checksum.lower() != '%08x' % session.crc32:
+                raise ValidationError({'checksum': "Doesn't match the data received"})
+
+            video = Video.objects.create(owner=request.user, videofile=session.path)
+            session.delete()
+
+        return Response(VideoSerializer(video, context=self.get_serializer_context()).data,
+                        status=status.HTTP_201_CREATED)
+
+    def perform_destroy(self, instance):
+        instance.delete()
+        try:
+            os.remove(os.path.join(settings.MEDIA_ROOT, instance.path))
+        except FileNotFoundError:
+            pass
+
+    def get_locked_object(self):
+        session = get_object_or_404(self.get_queryset().select_for_update(), pk=self.kwargs['pk'])
+        self.check_object_permissions(self.request, session)
+        return session
+
+    def write_chunk(self, session, stream, length):
+        """
+        Append up to `length` bytes from `stream` at the offset of `session`, updating its offset and checksum. If the
+        client goes away in the middle, whatever has arrived is kept, the upload can be resumed from there.
+        """
+        with open(os.path.join(settings.MEDIA_ROOT, session.path), 'r+b') as f:
+            f.seek(session.offset)
+            remaining = length if stream is not None else 0
+            while remaining:
+                try:
+                    block = stream.read(min(settings.VIDEO_UPLOAD_BLOCK_SIZE, remaining))
+                except IOError:
+                    logger.warning('Upload [id=%s] interrupted at %s bytes', session.pk, session.offset, exc_info=True)
+                    block = None
+                if not block:
+                    break
+                f.write(block)
+                session.offset += len(block)
+                session.crc32 = zlib.crc32(block, session.crc32)
+                remaining -= len(block)
+            # Drop anything left over from an earlier, interrupted attempt at this chunk
+            f.truncate()
+
+    @staticmethod
+    def with_offset_headers(response, session):
+        response['Upload-Offset'] = session.offset
+        response['Upload-Length'] = session.length
+        response['Cache-Control'] = 'no-store'
+        return response
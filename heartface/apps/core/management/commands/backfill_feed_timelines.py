@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+
+from heartface.apps.core.models import User
+from heartface.libs import timeline
+
+
+class Command(BaseCommand):
+    help = '''
+        (Re)build the materialized feed timelines used when settings.FEED_MODE is 'push'
+
+        run ./manage backfill_feed_timelines [--user <user id> ...]
+    '''
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--user',
+            action='append',
+            type=int,
+            dest='users',
+            help='Only rebuild the timeline of this user (can be repeated)'
+        )
+
+    def handle(self, *args, **options):
+        users = User.objects.filter(is_active=True, disabled=False)
+        if options['users']:
+            users = users.filter(pk__in=options['users'])
+
+        total = 0
+        for user_id in users.order_by('pk').values_list('pk', flat=True).iterator():
+            count = timeline.backfill(user_id)
+            total += count
+            if options['verbosity'] > 1:
+                self.stdout.write('Timeline of user %s: %s entries' % (user_id, count))
+
+        self.stdout.write(self.style.SUCCESS('Backfilled %s timeline entries' % total))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from heartface.libs import trending
+
+
+class Command(BaseCommand):
+    help = '''
+        Compare the popularity scores of users in the current trending window, summed from the counters (what
+        check_trending uses), with the ones computed from their activity. List the users they differ for, e.g. by
+        activity deleted since it was counted.
+
+        run ./manage check_trending_counters [--limit <users>]
+    '''
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--limit',
+            type=int,
+            dest='limit',
+            default=100,
+            help='List at most this many users'
+        )
+
+    def handle(self, *args, **options):
+        drift = trending.drift()
+        for user_id, counted, actual in drift[:options['limit']]:
+            self.stdout.write('User %s: %s counted, %s from the activity' % (user_id, counted, actual))
+        self.stdout.write(self.style.SUCCESS('The counters differ from the activity for %s users' % len(drift)))
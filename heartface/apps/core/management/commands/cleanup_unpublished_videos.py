@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+
+from heartface.libs import video_cleanup
+
+
+class Command(BaseCommand):
+    help = '''
+        Delete the videos that haven't been published within settings.UNPUBLISHED_VIDEO_RETAIN_WINDOW and the expired
+        uploads (what the hourly cleanup_unpublished_vids task does)
+
+        run ./manage cleanup_unpublished_videos [--dry-run] [--time-budget <seconds>] [--chunk-size <videos>]
+    '''
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            dest='dry_run',
+            help='Only count the videos to delete'
+        )
+        parser.add_argument(
+            '--time-budget',
+            type=float,
+            dest='time_budget',
+            help='Stop after this many seconds'
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            dest='chunk_size',
+            help='Delete this many videos at once'
+        )
+
+    def handle(self, *args, **options):
+        stats = video_cleanup.cleanup(dry_run=options['dry_run'], time_budget=options['time_budget'],
+                                      chunk_size=options['chunk_size'])
+
+        message = '%s %s unpublished videos' % ('Would delete' if options['dry_run'] else 'Deleted', stats.deleted)
+        if stats.out_of_time:
+            message += ', ran out of time before the end'
+        self.stdout.write(self.style.SUCCESS(message))
+
+        uploads = video_cleanup.cleanup_uploads(dry_run=options['dry_run'])
+        self.stdout.write(self.style.SUCCESS('%s %s expired uploads' % (
+            'Would delete' if options['dry_run'] else 'Deleted', uploads)))
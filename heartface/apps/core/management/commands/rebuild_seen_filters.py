@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from heartface.libs import seen_filter
+
+
+class Command(BaseCommand):
+    help = '''
+        Seed the filters of the videos each user has seen (used when settings.SEEN_FILTER_ENABLED is True) from their
+        views
+
+        run ./manage rebuild_seen_filters [--user <user id> ...]
+    '''
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--user',
+            action='append',
+            type=int,
+            dest='users',
+            help='Only rebuild the filter of this user (can be repeated)'
+        )
+
+    def handle(self, *args, **options):
+        count = seen_filter.rebuild(options['users'])
+        self.stdout.write(self.style.SUCCESS('Rebuilt the seen filters of %s users' % count))
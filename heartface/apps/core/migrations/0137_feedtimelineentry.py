@@ -0,0 +1,36 @@
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0136_auto_20190124_1811'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FeedTimelineEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('type', models.PositiveSmallIntegerField(choices=[(0, 'video'), (1, 'like'), (2, 'comment'), (3, 'follow')])),
+                ('object_id', models.PositiveIntegerField()),
+                ('feed_order', models.DateTimeField()),
+                ('actor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='timeline', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='feedtimelineentry',
+            index=models.Index(fields=['owner', '-feed_order'], name='core_timeline_owner_order_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='feedtimelineentry',
+            index=models.Index(fields=['type', 'object_id'], name='core_timeline_object_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='feedtimelineentry',
+            unique_together={('owner', 'type', 'object_id')},
+        ),
+    ]
@@ -0,0 +1,21 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0138_feed_indexes'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='video',
+            name='core_video_feed_idx',
+        ),
+        # Only the videos that can show up in the feed
+        migrations.RunSQL(
+            'CREATE INDEX core_video_feed_partial_idx ON core_video (owner_id, published DESC, id DESC) '
+            'WHERE published IS NOT NULL AND cdn_available IS NOT NULL',
+            'DROP INDEX core_video_feed_partial_idx',
+        ),
+    ]
@@ -0,0 +1,34 @@
+from django.db import migrations
+
+
+def add_task(apps, schema_editor):
+    IntervalSchedule = apps.get_model('django_celery_beat', 'IntervalSchedule')
+    PeriodicTask = apps.get_model('django_celery_beat', 'PeriodicTask')
+
+    every_10_seconds, _ = IntervalSchedule.objects.get_or_create(every=10, period='seconds')
+    PeriodicTask.objects.create(
+        interval=every_10_seconds,
+        name='Ingest buffered video views',
+        task='heartface.apps.core.tasks.ingest_views'
+    )
+
+
+def del_task(apps, schema_editor):
+    PeriodicTask = apps.get_model('django_celery_beat', 'PeriodicTask')
+
+    PeriodicTask.objects.filter(
+        name='Ingest buffered video views',
+        task='heartface.apps.core.tasks.ingest_views'
+    ).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0139_video_feed_partial_index'),
+        ('django_celery_beat', '0006_periodictask_priority'),
+    ]
+
+    operations = [
+        migrations.RunPython(code=add_task, reverse_code=del_task),
+    ]
@@ -0,0 +1,33 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0140_ingest_views_task'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='video',
+            name='comment_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='video',
+            name='like_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunSQL(
+            'UPDATE core_video SET like_count = likes.count '
+            'FROM (SELECT video_id, COUNT(*) AS count FROM core_like GROUP BY video_id) AS likes '
+            'WHERE core_video.id = likes.video_id',
+            migrations.RunSQL.noop,
+        ),
+        migrations.RunSQL(
+            'UPDATE core_video SET comment_count = comments.count '
+            'FROM (SELECT video_id, COUNT(*) AS count FROM core_comment GROUP BY video_id) AS comments '
+            'WHERE core_video.id = comments.video_id',
+            migrations.RunSQL.noop,
+        ),
+    ]
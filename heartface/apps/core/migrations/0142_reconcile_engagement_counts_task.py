@@ -0,0 +1,34 @@
+from django.db import migrations
+
+
+def add_task(apps, schema_editor):
+    CrontabSchedule = apps.get_model('django_celery_beat', 'CrontabSchedule')
+    PeriodicTask = apps.get_model('django_celery_beat', 'PeriodicTask')
+
+    nightly, _ = CrontabSchedule.objects.get_or_create(minute=40, hour=3)
+    PeriodicTask.objects.create(
+        crontab=nightly,
+        name='Reconcile the like and comment counts of videos',
+        task='heartface.apps.core.tasks.reconcile_engagement_counts'
+    )
+
+
+def del_task(apps, schema_editor):
+    PeriodicTask = apps.get_model('django_celery_beat', 'PeriodicTask')
+
+    PeriodicTask.objects.filter(
+        name='Reconcile the like and comment counts of videos',
+        task='heartface.apps.core.tasks.reconcile_engagement_counts'
+    ).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0141_video_engagement_counts'),
+        ('django_celery_beat', '0006_periodictask_priority'),
+    ]
+
+    operations = [
+        migrations.RunPython(code=add_task, reverse_code=del_task),
+    ]
@@ -0,0 +1,34 @@
+from django.db import migrations
+
+
+def add_task(apps, schema_editor):
+    IntervalSchedule = apps.get_model('django_celery_beat', 'IntervalSchedule')
+    PeriodicTask = apps.get_model('django_celery_beat', 'PeriodicTask')
+
+    every_30_seconds, _ = IntervalSchedule.objects.get_or_create(every=30, period='seconds')
+    PeriodicTask.objects.create(
+        interval=every_30_seconds,
+        name='Check the availability of published videos on the CDN',
+        task='heartface.apps.core.tasks.check_cdn_availability'
+    )
+
+
+def del_task(apps, schema_editor):
+    PeriodicTask = apps.get_model('django_celery_beat', 'PeriodicTask')
+
+    PeriodicTask.objects.filter(
+        name='Check the availability of published videos on the CDN',
+        task='heartface.apps.core.tasks.check_cdn_availability'
+    ).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0144_uploadsession'),
+        ('django_celery_beat', '0006_periodictask_priority'),
+    ]
+
+    operations = [
+        migrations.RunPython(code=add_task, reverse_code=del_task),
+    ]
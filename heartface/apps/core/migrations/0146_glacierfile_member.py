@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0145_check_cdn_availability_task'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='glacierfile',
+            name='member',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+    ]
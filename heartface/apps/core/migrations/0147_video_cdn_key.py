@@ -0,0 +1,20 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0146_glacierfile_member'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='video',
+            name='cdn_key',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=255),
+        ),
+        migrations.RunSQL(
+            "UPDATE core_video SET cdn_key = regexp_replace(videofile, '^.*/', '')",
+            migrations.RunSQL.noop,
+        ),
+    ]
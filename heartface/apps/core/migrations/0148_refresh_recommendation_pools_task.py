@@ -0,0 +1,34 @@
+from django.db import migrations
+
+
+def add_task(apps, schema_editor):
+    IntervalSchedule = apps.get_model('django_celery_beat', 'IntervalSchedule')
+    PeriodicTask = apps.get_model('django_celery_beat', 'PeriodicTask')
+
+    every_10_minutes, _ = IntervalSchedule.objects.get_or_create(every=10, period='minutes')
+    PeriodicTask.objects.create(
+        interval=every_10_minutes,
+        name='Refresh the candidate pools of the recommended videos',
+        task='heartface.apps.core.tasks.refresh_recommendation_pools'
+    )
+
+
+def del_task(apps, schema_editor):
+    PeriodicTask = apps.get_model('django_celery_beat', 'PeriodicTask')
+
+    PeriodicTask.objects.filter(
+        name='Refresh the candidate pools of the recommended videos',
+        task='heartface.apps.core.tasks.refresh_recommendation_pools'
+    ).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0147_video_cdn_key'),
+        ('django_celery_beat', '0006_periodictask_priority'),
+    ]
+
+    operations = [
+        migrations.RunPython(code=add_task, reverse_code=del_task),
+    ]
@@ -0,0 +1,32 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0148_refresh_recommendation_pools_task'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TrendingCounter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.PositiveSmallIntegerField(choices=[(0, 'views'), (1, 'likes'), (2, 'followers'), (3, 'comments'), (4, 'uploads'), (5, 'hashtag videos'), (6, 'hashtag comments')])),
+                ('object_id', models.PositiveIntegerField()),
+                ('hour', models.DateTimeField()),
+                ('count', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='TrendingWatermark',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('counted_until', models.DateTimeField()),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='trendingcounter',
+            unique_together={('hour', 'source', 'object_id')},
+        ),
+    ]
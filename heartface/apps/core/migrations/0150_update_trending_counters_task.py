@@ -0,0 +1,34 @@
+from django.db import migrations
+
+
+def add_task(apps, schema_editor):
+    IntervalSchedule = apps.get_model('django_celery_beat', 'IntervalSchedule')
+    PeriodicTask = apps.get_model('django_celery_beat', 'PeriodicTask')
+
+    every_5_minutes, _ = IntervalSchedule.objects.get_or_create(every=5, period='minutes')
+    PeriodicTask.objects.create(
+        interval=every_5_minutes,
+        name='Count the activity for trending',
+        task='heartface.apps.core.tasks.update_trending_counters'
+    )
+
+
+def del_task(apps, schema_editor):
+    PeriodicTask = apps.get_model('django_celery_beat', 'PeriodicTask')
+
+    PeriodicTask.objects.filter(
+        name='Count the activity for trending',
+        task='heartface.apps.core.tasks.update_trending_counters'
+    ).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0149_trending_counters'),
+        ('django_celery_beat', '0006_periodictask_priority'),
+    ]
+
+    operations = [
+        migrations.RunPython(code=add_task, reverse_code=del_task),
+    ]
@@ -0,0 +1,19 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0150_update_trending_counters_task'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='feedtimelineentry',
+            name='core_timeline_owner_order_idx',
+        ),
+        migrations.AddIndex(
+            model_name='feedtimelineentry',
+            index=models.Index(fields=['owner', '-feed_order', '-id'], name='core_timeline_owner_order_idx'),
+        ),
+    ]
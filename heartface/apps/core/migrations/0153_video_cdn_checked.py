@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0152_uploadsession_claimed_until'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='video',
+            name='cdn_checked',
+            field=models.DateTimeField(editable=False, null=True),
+        ),
+    ]
@@ -9,7 +9,6 @@ from datetime import date
 
 from urllib.parse import urljoin
 from urllib.parse import quote
-from moviepy.editor import VideoFileClip
 from dateutil.relativedelta import relativedelta
 
 from django.conf import settings
@@ -17,7 +16,7 @@ from django.contrib.auth.base_user import BaseUserManager
 from django.contrib.auth.models import (AbstractBaseUser, PermissionsMixin)
 from django.contrib.postgres.fields import ArrayField
 from django.core import validators
-from django.db import models
+from django.db import models, transaction
 from django.utils import timezone
 from django.utils.deconstruct import deconstructible
 from django.utils.http import urlquote
@@ -35,6 +34,9 @@ from .storages import BunnyCDNStorage
 
 logger = logging.getLogger(__name__)
 
+# Hashtags in the title/description of videos
+HASHTAG_RE = re.compile("(?:^|\s)[＃#]{1}(\w+)", re.UNICODE)
+
 
 @deconstructible
 class UploadDir:
@@ -346,15 +348,6 @@ def uuid4_title(instance, filename):
     return 'videos/{}{}'.format(title, file_extension)
 
 
-class VideoQuerySet(models.QuerySet):
-    def with_liked_and_following(self, follower):
-        return self.annotate(
-            following_owner=models.Exists(Follow.objects.filter(followed=models.OuterRef('owner'),
-                                                                follower=follower)))\
-            .annotate(liked=models.Exists(Like.objects.filter(video_id=models.OuterRef('id'),
-                                                              user=follower)))
-
-
 class Video(models.Model):
     # TODO: clarify deletion strategy. What happens if a user deletes their account? Do we delete their videos?
     # NOTE: We allow empty titles because of the current API use strategy: Video objects can be created by uploading a
@@ -362,6 +355,9 @@ class Video(models.Model):
     title = models.CharField(default='', max_length=255)
     description = models.TextField(blank=True, default='')
     view_count = models.PositiveIntegerField(default=0)
+    # Maintained by signals (see heartface.apps.core.signals) and reconciled nightly (see heartface.libs.engagement)
+    like_count = models.PositiveIntegerField(default=0)
+    comment_count = models.PositiveIntegerField(default=0)
     owner = models.ForeignKey(User, related_name='videos', on_delete=models.SET_DEFAULT, default=None)
     likes = models.ManyToManyField(User, related_name='likes', blank=True, through='Like')
     products = models.ManyToManyField(Product, related_name='videos', blank=True)
@@ -370,11 +366,22 @@ class Video(models.Model):
     recommended = models.BooleanField(default=False)
     published = models.DateTimeField(default=None, null=True, blank=True)
     cdn_available = models.DateTimeField(default=None, null=True, blank=True)
+    # When a sweep last checked (or is checking) the video on the CDN (see heartface.libs.cdn_availability)
+    cdn_checked = models.DateTimeField(null=True, editable=False)
+    # The name of the file on the CDN (what its webhook reports), kept in sync with videofile on save
+    cdn_key = models.CharField(max_length=255, blank=True, default='', db_index=True, editable=False)
 
+    # Set by the probe_video task once the file is uploaded (see heartface.libs.video_probe)
     video_length = models.PositiveIntegerField(null=True, blank=True)
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
+    video_codec = models.CharField(max_length=50, blank=True, default='')
+    # bits/s
+    bitrate = models.PositiveIntegerField(null=True, blank=True)
     created = models.DateTimeField(auto_now_add=True)
 
-    objects = models.Manager.from_queryset(VideoQuerySet)()
+    # The feed (see FeedCursorPagination) uses a partial index on (owner, -published, -id) of the published videos
+    #  available on the CDN, created in migration 0139 as Django can't express it in Meta.indexes
 
     @property
     def videofile_cdn_url(self):
@@ -403,58 +410,107 @@ class Video(models.Model):
 
     @classmethod
     def publish(cls, video, force=False):
-        from .tasks import upload_video
+        from .tasks import upload_video, fan_out_feed_item
+        from heartface.libs import timeline
         updated_rows = cls.objects.filter(pk=video.pk, published__isnull=True).update(published=timezone.now())
         if updated_rows:
             upload_video.delay(video.pk)
+            if timeline.is_push_mode():
+                fan_out_feed_item.delay(FeedTimelineEntry.TYPES.video, video.pk)
         elif force:
             logger.warn('Forcing upload_video task on already published video')
             upload_video.delay(video.pk)
 
-    # possible exceptions: corrupted video, file missing
-    # Note: Video files removed from server after 24hrs and pushed to CDN.
-    def video_duration(self):
-        """
-        This method is called when a new video instance is created and
-        it updates the video_length of the instance.
-        """
-        try:
-            video = VideoFileClip(str(self.videofile.file))
-            return int(video.duration)
-        except FileNotFoundError as e:
-            logger.error('Video file is missing: %s' % e)
-
-    def save(self, *args, **kwargs):
-        super().save(*args, **kwargs)
-        # Set the video_length when creating
-        if self._state.adding is True:
-            self.video_length = self.video_duration()
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # So we only sync the hashtags on save if the text they come from changed and only probe the file if it's a new
+        #  one (or the video is new)
+        self.__original_hashtag_text = self._hashtag_text() if self.pk is not None else None
+        self.__original_videofile_name = self._videofile_name() if self.pk is not None else None
 
-        # Extract hashtags from title/description
-        hashtag_re = re.compile("(?:^|\s)[＃#]{1}(\w+)", re.UNICODE)
+    def _videofile_name(self):
+        # The raw value is the name until the field is accessed, and a FieldFile after it
+        value = self.__dict__.get('videofile')
+        return getattr(value, 'name', value)
 
-        # find all tags in title and description
-        tag_names = hashtag_re.findall(self.title) + hashtag_re.findall(self.description)
+    def _hashtag_text(self):
+        # Read from __dict__ so a deferred field isn't loaded just for this (None means it's not loaded)
+        return self.__dict__.get('title'), self.__dict__.get('description')
 
-        # make list contains only unique tags
-        tag_names = list(set(tag_names))
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
 
-        # find all tags in 1 SQL query
-        tags = list(Hashtag.objects.filter(name__in=tag_names))
-        if len(tags) != len(tag_names):
-            existing_tags = [t.name for t in tags]
-            # not all tags existing - do slow operation to find and create
-            tags.extend([
-                Hashtag.objects.get_or_create(name=tag)[0]
-                for tag in tag_names
-                if tag not in existing_tags
-            ])
+        if self._videofile_name() and self._videofile_name() != self.__original_videofile_name:
+            # Only known once the file is stored (and named)
+            self.cdn_key = os.path.basename(self._videofile_name())
+            Video.objects.filter(pk=self.pk).update(cdn_key=self.cdn_key)
+            # The duration etc. of the file are read by a task, after the upload request is done with it
+            from .tasks import probe_video
+            video_id = self.pk
+            transaction.on_commit(lambda: probe_video.delay(video_id))
+            self.__original_videofile_name = self._videofile_name()
+
+        if self._hashtag_text() != self.__original_hashtag_text:
+            self.sync_hashtags()
+            self.__original_hashtag_text = self._hashtag_text()
+
+    def sync_hashtags(self):
+        """
+        Make the hashtags of the video the ones in its title and description
+        """
+        tag_names = set(HASHTAG_RE.findall(self.title) + HASHTAG_RE.findall(self.description))
+
+        # Hashtag names aren't unique (yet), any of the hashtags with a name will do
+        tags = dict(Hashtag.objects.filter(name__in=tag_names).values_list('name', 'pk'))
+        missing = [Hashtag(name=name) for name in tag_names if name not in tags]
+        if missing:
+            created = [tag.pk for tag in Hashtag.objects.bulk_create(missing)]
+            tags.update((tag.name, tag.pk) for tag in missing)
+            # bulk_create doesn't send post_save, index the new hashtags like the signal would
+            from .tasks import update_es_record_task
+
+            def index_created():
+                for pk in created:
+                    update_es_record_task.delay(pk, "Hashtag")
+            transaction.on_commit(index_created)
+
+        # Apply the difference to the M2M table
+        Through = Video.hashtags.through
+        current = dict(Through.objects.filter(video=self).values_list('hashtag_id', 'hashtag__name'))
+        stale = [tag_id for tag_id, name in current.items() if name not in tag_names]
+        if stale:
+            Through.objects.filter(video=self, hashtag_id__in=stale).delete()
+        current_names = set(current.values())
+        Through.objects.bulk_create(Through(video=self, hashtag_id=tags[name])
+                                    for name in tag_names if name not in current_names)
+
+
+class UploadSession(models.Model):
+    """
+    A resumable upload of a video file (see heartface.apps.core.api.views.uploads). The bytes received so far are in the
+    file at `path` (relative to MEDIA_ROOT), `crc32` is the running CRC-32 checksum of them.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    owner = models.ForeignKey(User, related_name='upload_sessions', on_delete=models.CASCADE)
+    # The name of the file on the client, only its extension is kept
+    filename = models.CharField(max_length=255)
+    path = models.CharField(max_length=255)
+    length = models.BigIntegerField()
+    offset = models.BigIntegerField(default=0)
+    crc32 = models.BigIntegerField(default=0)
+    # Set while a chunk is being written, by the request writing it (see partial_update). Another request can only take
+    #  over once it's past.
+    claimed_until = models.DateTimeField(null=True, editable=False)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
 
-        # Add tags to M2M
-        self.hashtags.add(*tags)
+    @property
+    def is_complete(self):
+        return self.offset == self.length
 
-        # Remove stale tags
-        self.hashtags.remove(*self.hashtags.exclude(name__in=tag_names))
+    @property
+    def is_claimed(self):
+        return self.claimed_until is not None and self.claimed_until > timezone.now()
 
 
 class VideoCDNStatus(models.Model):
@@ -477,6 +533,8 @@ class GlacierFile(models.Model):
     video = models.OneToOneField('Video', on_delete=models.CASCADE)
     size = models.BigIntegerField()
     archive_id = models.CharField(max_length=255)
+    # The name of the video file in the archive when it's bundled with others (see heartface.libs.glacier)
+    member = models.CharField(max_length=255, blank=True)
     created = models.DateTimeField(null=True, auto_now_add=True)
 
 
@@ -491,6 +549,9 @@ class Like(models.Model):
 
     class Meta:
         unique_together = ('video', 'user')
+        indexes = [
+            models.Index(fields=['user', '-created', '-id'], name='core_like_feed_idx'),
+        ]
 
 
 class Follow(models.Model):
@@ -506,6 +567,9 @@ class Follow(models.Model):
 
     class Meta:
         unique_together = ('follower', 'followed')
+        indexes = [
+            models.Index(fields=['follower', '-created', '-id'], name='core_follow_feed_idx'),
+        ]
 
 
 class View(models.Model):
@@ -629,6 +693,35 @@ class Comment(models.Model):
     def feed_order(self):
         return self.created
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['author', '-created', '-id'], name='core_comment_feed_idx'),
+        ]
+
+
+class FeedTimelineEntry(models.Model):
+    """
+    A materialized feed item. In push mode (see settings.FEED_MODE) activity is fanned out to the timelines of the
+    followers of the acting user when it happens, so reading a feed page doesn't have to look at the activity of
+    everyone the user follows. See heartface.libs.timeline
+    """
+    TYPES = Choices((0, 'video', 'video'), (1, 'like', 'like'), (2, 'comment', 'comment'), (3, 'follow', 'follow'))
+
+    # The user whose feed this entry is part of
+    owner = models.ForeignKey(User, related_name='timeline', on_delete=models.CASCADE)
+    # The (followed) user who did the upload/like/comment/follow. Needed for retracting entries on unfollow.
+    actor = models.ForeignKey(User, related_name='+', on_delete=models.CASCADE)
+    type = models.PositiveSmallIntegerField(choices=TYPES)
+    object_id = models.PositiveIntegerField()
+    feed_order = models.DateTimeField()
+
+    class Meta:
+        unique_together = ('owner', 'type', 'object_id')
+        indexes = [
+            models.Index(fields=['owner', '-feed_order', '-id'], name='core_timeline_owner_order_idx'),
+            models.Index(fields=['type', 'object_id'], name='core_timeline_object_idx'),
+        ]
+
 
 class Notification(models.Model):
     """
@@ -735,6 +828,33 @@ class TrendingHashtag(models.Model):
         unique_together = ('hashtag', 'trending')
 
 
+class TrendingCounter(models.Model):
+    """
+    How much of a kind of activity (the source) a user or hashtag got in an hour. The trending scores are summed from
+    these instead of the activity itself, see heartface.libs.trending
+    """
+    # In the order of heartface.libs.trending.Weight. The hashtag_* sources count for hashtags, the others for users.
+    SOURCES = Choices((0, 'views', 'views'), (1, 'likes', 'likes'), (2, 'followers', 'followers'),
+                      (3, 'comments', 'comments'), (4, 'uploads', 'uploads'), (5, 'hashtag_videos', 'hashtag videos'),
+                      (6, 'hashtag_comments', 'hashtag comments'))
+
+    source = models.PositiveSmallIntegerField(choices=SOURCES)
+    # The user or hashtag
+    object_id = models.PositiveIntegerField()
+    hour = models.DateTimeField()
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('hour', 'source', 'object_id')
+
+
+class TrendingWatermark(models.Model):
+    """
+    The activity before `counted_until` has been added to the TrendingCounters (there's a single one)
+    """
+    counted_until = models.DateTimeField()
+
+
 class TaskRunManager(models.Manager):
     def last_run_at(self, task_label):
         return TaskRun.objects.filter(task_label=task_label).order_by('-started_at').\
@@ -1,14 +1,23 @@
+import logging
+
 import analytics
+import redis
+from django.db import transaction
 from django.db.models import F
+from django.db.models.functions import Greatest
 from django.db.models.signals import post_save, post_delete, m2m_changed
 from django.dispatch import receiver
 from typing import Set
 from django.contrib.sites.models import Site
 
 from heartface.apps.core.models import User, Hashtag, Video, Product, SupplierProduct, Supplier, MarketplaceURL, \
-    Marketplace, Follow, VideoCDNStatus
+    Marketplace, Follow, VideoCDNStatus, Like, Comment, View
+from heartface.libs import cdn_availability, follow_graph, seen_filter, timeline
 from heartface.libs.utils import _req_ctx_with_request
-from heartface.apps.core.tasks import update_es_record_task, delete_es_record_task
+from heartface.apps.core.tasks import update_es_record_task, delete_es_record_task, fan_out_feed_item, \
+    retract_feed_item, retract_followed_activity, backfill_feed_timeline, archive_videos
+
+logger = logging.getLogger(__name__)
 
 
 @receiver(post_save, sender=User, dispatch_uid="update_user_index")
@@ -149,8 +158,86 @@ def update_follower_count_on_delete(sender, instance, **kwargs):
     User.objects.filter(pk=instance.followed.pk).update(follower_count=F('follower_count')-1)
 
 
+@receiver(post_save, sender=Like, dispatch_uid="update_like_count_on_create")
+def update_like_count_on_create(sender, instance, created, **kwargs):
+    if created:
+        Video.objects.filter(pk=instance.video_id).update(like_count=F('like_count')+1)
+
+
+@receiver(post_delete, sender=Like, dispatch_uid="update_like_count_on_delete")
+def update_like_count_on_delete(sender, instance, **kwargs):
+    Video.objects.filter(pk=instance.video_id).update(like_count=Greatest(F('like_count') - 1, 0))
+
+
+@receiver(post_save, sender=Comment, dispatch_uid="update_comment_count_on_create")
+def update_comment_count_on_create(sender, instance, created, **kwargs):
+    if created:
+        Video.objects.filter(pk=instance.video_id).update(comment_count=F('comment_count')+1)
+
+
+@receiver(post_delete, sender=Comment, dispatch_uid="update_comment_count_on_delete")
+def update_comment_count_on_delete(sender, instance, **kwargs):
+    Video.objects.filter(pk=instance.video_id).update(comment_count=Greatest(F('comment_count') - 1, 0))
+
+
+@receiver(post_save, sender=Follow, dispatch_uid="invalidate_follow_graph_on_create")
+def invalidate_follow_graph_on_create(sender, instance, created, **kwargs):
+    if created:
+        follow_graph.invalidate(instance.follower_id)
+
+
+@receiver(post_delete, sender=Follow, dispatch_uid="invalidate_follow_graph_on_delete")
+def invalidate_follow_graph_on_delete(sender, instance, **kwargs):
+    follow_graph.invalidate(instance.follower_id)
+
+
+@receiver(post_save, sender=View, dispatch_uid="add_to_seen_filter")
+def add_to_seen_filter(sender, instance, created, **kwargs):
+    if created and instance.user_id is not None and seen_filter.is_enabled():
+        user_id, video_id = instance.user_id, instance.video_id
+
+        def add():
+            # The view is saved either way, the filter just misses it (the video may be recommended again)
+            try:
+                seen_filter.add(user_id, video_id)
+            except redis.RedisError:
+                logger.error('Adding video [id=%s] to the seen filter of user [id=%s] failed', video_id, user_id,
+                             exc_info=True)
+        transaction.on_commit(add)
+
+
 @receiver(post_save, sender=VideoCDNStatus)
 def update_video_status(sender, instance, **kwargs):
     if instance.status == 'complete':
-        instance.video.cdn_available = instance.timestamp
-        instance.video.save()
+        # An update(), not a save() of the whole video (with its reindexing etc.)
+        archive_videos(cdn_availability.mark_available([instance.video_id]))
+
+
+# Feed timelines (push mode only). Videos are fanned out when they get published, see Video.publish
+
+@receiver(post_save, sender=Like, dispatch_uid="fan_out_like")
+@receiver(post_save, sender=Comment, dispatch_uid="fan_out_comment")
+@receiver(post_save, sender=Follow, dispatch_uid="fan_out_follow")
+def fan_out_to_timelines(sender, instance, created, **kwargs):
+    if created and timeline.is_push_mode():
+        # After the commit, or the task may not find the item yet
+        item_type, object_id = timeline.MODEL_TYPES[sender], instance.pk
+        transaction.on_commit(lambda: fan_out_feed_item.delay(item_type, object_id))
+        if sender is Follow:
+            # Show the recent activity of the newly followed user, as pull mode would
+            follower_id, followed_id = instance.follower_id, instance.followed_id
+            transaction.on_commit(lambda: backfill_feed_timeline.delay(follower_id, [followed_id]))
+
+
+@receiver(post_delete, sender=Video, dispatch_uid="retract_video_from_timelines")
+@receiver(post_delete, sender=Like, dispatch_uid="retract_like_from_timelines")
+@receiver(post_delete, sender=Comment, dispatch_uid="retract_comment_from_timelines")
+@receiver(post_delete, sender=Follow, dispatch_uid="retract_follow_from_timelines")
+def retract_from_timelines(sender, instance, **kwargs):
+    if timeline.is_push_mode():
+        item_type, object_id = timeline.MODEL_TYPES[sender], instance.pk
+        transaction.on_commit(lambda: retract_feed_item.delay(item_type, object_id))
+        if sender is Follow:
+            # Unfollow: drop the activity of the unfollowed user from the timeline
+            follower_id, followed_id = instance.follower_id, instance.followed_id
+            transaction.on_commit(lambda: retract_followed_activity.delay(follower_id, followed_id))
@@ -0,0 +1,125 @@
+"""
+Finding out when published videos become available on the CDN.
+
+The check_cdn_availability task sweeps the videos waiting for the CDN periodically. Videos the CDN has already
+reported as 'complete' (a VideoCDNStatus from its webhook) are taken as available right away, the rest are checked with
+HEAD requests on their CDN URLs, concurrently, over a pool of keep-alive connections. The available ones are marked
+with a single UPDATE, and the task starts their backup to Glacier.
+
+Each sweep claims its batch first (setting Video.cdn_checked), so sweeps that overlap check different videos. The
+videos never checked come first, then the ones checked the longest ago, so a backlog larger than a batch is rotated
+through instead of the oldest videos never getting checked.
+
+The statuses reported by the CDN's webhook are recorded by record_statuses, which marks the videos reported 'complete'
+right away, without waiting for the next sweep.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from rest_framework import status
+
+from heartface.apps.core.models import Video, VideoCDNStatus
+
+logger = logging.getLogger(__name__)
+
+
+def pending_videos():
+    """
+    The videos waiting for the CDN, the ones never checked first (the most recently published first), then the ones
+    checked the longest ago. After settings.CDN_CHECK_MAX_AGE we give up on a video.
+    """
+    return Video.objects.filter(published__isnull=False, cdn_available__isnull=True,
+                                published__gte=timezone.now() - settings.CDN_CHECK_MAX_AGE) \
+        .order_by(F('cdn_checked').asc(nulls_first=True), '-published')
+
+
+def claim(count):
+    """
+    The next `count` pending videos not checked within settings.CDN_CHECK_INTERVAL, marked as checked now. The ones
+    being claimed by another sweep are skipped.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        videos = list(pending_videos().select_for_update(skip_locked=True)
+                      .exclude(cdn_checked__gt=now - settings.CDN_CHECK_INTERVAL)[:count])
+        Video.objects.filter(pk__in=[video.pk for video in videos]).update(cdn_checked=now)
+    return videos
+
+
+def _session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.CDN_CHECK_CONCURRENCY)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def _is_available(session, video):
+    try:
+        return all(session.head(url, timeout=settings.CDN_CHECK_TIMEOUT).status_code == status.HTTP_200_OK
+                   for url in (video.videofile_cdn_url, video.cover_picture_cdn_url))
+    except requests.RequestException:
+        logger.warning('Checking video [id=%s] on the CDN failed', video.pk, exc_info=True)
+        return False
+
+
+def sweep():
+    """
+    Check the next pending videos (at most settings.CDN_CHECK_BATCH_SIZE of them) and mark the ones available on the
+    CDN. Returns the ids of the videos marked.
+    """
+    videos = claim(settings.CDN_CHECK_BATCH_SIZE)
+    if not videos:
+        return []
+
+    # The CDN's own word for it
+    complete = set(VideoCDNStatus.objects.filter(video__in=videos, status='complete').values_list('video_id', flat=True))
+
+    to_check = [video for video in videos if video.pk not in complete]
+    with _session() as session, ThreadPoolExecutor(max_workers=settings.CDN_CHECK_CONCURRENCY) as executor:
+        available = [video.pk for video, is_available
+                     in zip(to_check, executor.map(lambda video: _is_available(session, video), to_check))
+                     if is_available]
+
+    return mark_available(complete.union(available))
+
+
+def mark_available(video_ids):
+    """
+    Mark the videos available on the CDN with one UPDATE. The ones marked in the meantime (e.g. by the webhook) or being
+    marked by another sweep are skipped. Returns the ids of the videos marked, each id is returned only once (by one
+    sweep), so their backup is started only once.
+    """
+    with transaction.atomic():
+        marked = list(Video.objects.select_for_update(skip_locked=True)
+                      .filter(pk__in=video_ids, cdn_available__isnull=True).values_list('pk', flat=True))
+        Video.objects.filter(pk__in=marked).update(cdn_available=timezone.now())
+
+    logger.info('%s videos available on the CDN', len(marked))
+    return marked
+
+
+def record_statuses(statuses):
+    """
+    Record the statuses reported by the CDN, a list of (filename, status, description), and mark the videos reported
+    'complete' available. Returns the filenames of the unknown videos and the ids of the videos marked.
+    """
+    video_ids = dict(Video.objects.filter(cdn_key__in={filename for filename, _, _ in statuses})
+                     .values_list('cdn_key', 'pk'))
+
+    # Inserted in bulk, the post_save signal of VideoCDNStatus (which marks a single video) isn't needed
+    VideoCDNStatus.objects.bulk_create([
+        VideoCDNStatus(video_id=video_ids[filename], filename=filename, status=cdn_status, description=description)
+        for filename, cdn_status, description in statuses if filename in video_ids
+    ])
+
+    missing = [filename for filename, _, _ in statuses if filename not in video_ids]
+    complete = {video_ids[filename] for filename, cdn_status, _ in statuses
+                if cdn_status == 'complete' and filename in video_ids}
+    return missing, mark_available(complete) if complete else []
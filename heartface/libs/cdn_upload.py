@@ -0,0 +1,123 @@
+"""
+Uploading video files to the CDN over FTP.
+
+Authenticated FTP connections are pooled per worker process and reused by the upload tasks it runs. At most
+settings.CDN_FTP_MAX_CONCURRENT_UPLOADS uploads run at the same time in a worker (this only matters for the
+threaded/green pools; a prefork worker process runs one task at a time, cap those with the worker's --concurrency).
+
+A transfer that broke off is resumed: the size of the remote file (SIZE) tells how much of it has arrived, and the
+rest is sent from there (REST) instead of from the first byte.
+"""
+import ftplib
+import logging
+import os
+import queue
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# The result of an upload: the bytes actually sent, where the upload was resumed from and how long it took
+UploadStats = namedtuple('UploadStats', ['bytes_sent', 'resumed_from', 'seconds'])
+
+_idle_connections = queue.LifoQueue()
+_upload_slots = None
+_lock = threading.Lock()
+
+
+def _slots():
+    global _upload_slots
+    with _lock:
+        if _upload_slots is None:
+            _upload_slots = threading.BoundedSemaphore(settings.CDN_FTP_MAX_CONCURRENT_UPLOADS)
+    return _upload_slots
+
+
+def _connect():
+    return ftplib.FTP(settings.CDN_FTP, settings.CDN_USERNAME, settings.CDN_PASSWORD, timeout=settings.CDN_FTP_TIMEOUT)
+
+
+def _idle_connection():
+    """
+    A pooled connection that's still alive, None if there's none
+    """
+    while True:
+        try:
+            ftp = _idle_connections.get_nowait()
+        except queue.Empty:
+            return None
+        try:
+            ftp.voidcmd('NOOP')
+            return ftp
+        except (ftplib.Error, OSError, EOFError):
+            # Timed out on the server side while idle
+            ftp.close()
+
+
+@contextmanager
+def connection():
+    """
+    An authenticated FTP connection for one upload. It goes back to the pool afterwards, unless something went wrong
+    with it.
+    """
+    with _slots():
+        ftp = _idle_connection() or _connect()
+        try:
+            yield ftp
+        except BaseException:
+            ftp.close()
+            raise
+        if _idle_connections.qsize() < settings.CDN_FTP_MAX_CONCURRENT_UPLOADS:
+            _idle_connections.put(ftp)
+        else:
+            ftp.close()
+
+
+def _remote_size(ftp, name):
+    try:
+        return ftp.size(name) or 0
+    except ftplib.error_perm:
+        # Not there (yet)
+        return 0
+
+
+def upload(path, remote_dir, remote_name):
+    """
+    Upload the file at `path` into `remote_dir` on the CDN as `remote_name`, resuming a partial earlier upload of it.
+    Returns the UploadStats.
+    """
+    size = os.path.getsize(path)
+    started = time.monotonic()
+
+    with connection() as ftp:
+        ftp.cwd(remote_dir)
+        # SIZE and REST are about bytes, binary mode is needed for them to mean the same as the local file size
+        ftp.voidcmd('TYPE I')
+        offset = _remote_size(ftp, remote_name)
+        if offset > size:
+            # Not a partial upload of this file
+            offset = 0
+
+        if offset < size:
+            with open(path, 'rb') as f:
+                try:
+                    f.seek(offset)
+                    ftp.storbinary('STOR %s' % remote_name, f, blocksize=settings.CDN_FTP_BLOCK_SIZE,
+                                   rest=offset or None)
+                except ftplib.error_perm:
+                    if not offset:
+                        raise
+                    # The server doesn't do REST for uploads, send it all
+                    logger.warning('Resuming the upload of %s failed, uploading it from the start', remote_name)
+                    offset = 0
+                    f.seek(0)
+                    ftp.storbinary('STOR %s' % remote_name, f, blocksize=settings.CDN_FTP_BLOCK_SIZE)
+
+    stats = UploadStats(bytes_sent=size - offset, resumed_from=offset, seconds=time.monotonic() - started)
+    logger.info('Uploaded %s: %s bytes (resumed from %s) in %.1fs, %.0f bytes/s', remote_name, stats.bytes_sent,
+                stats.resumed_from, stats.seconds, stats.bytes_sent / stats.seconds if stats.seconds else 0)
+    return stats
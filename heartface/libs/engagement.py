@@ -0,0 +1,49 @@
+"""
+The denormalized engagement counters of videos: Video.like_count and Video.comment_count.
+
+They're kept up to date by atomic F() updates when a like/comment is created or deleted (see
+heartface.apps.core.signals), the same way User.follower_count is. Anything that bypasses the signals (bulk deletes,
+raw SQL, a failed update) makes them drift, so they're recomputed nightly by the reconcile_engagement_counts task.
+"""
+import logging
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Count
+
+from heartface.apps.core.models import Video, Like, Comment
+
+logger = logging.getLogger(__name__)
+
+# The counter fields of Video and the models they count
+COUNTERS = (
+    ('like_count', Like),
+    ('comment_count', Comment),
+)
+
+
+def reconcile():
+    """
+    Recompute the counters with one GROUP BY per counted table and fix the ones that drifted. Returns the number of
+    counters fixed.
+    """
+    fixed = 0
+    for field, model in COUNTERS:
+        actual = dict(model.objects.order_by().values('video_id').annotate(count=Count('pk'))
+                      .values_list('video_id', 'count'))
+
+        # Videos with the same correct value are fixed together
+        videos_by_count = defaultdict(list)
+        for video_id, count in Video.objects.values_list('pk', field).iterator():
+            if actual.get(video_id, 0) != count:
+                videos_by_count[actual.get(video_id, 0)].append(video_id)
+
+        with transaction.atomic():
+            for count, video_ids in videos_by_count.items():
+                Video.objects.filter(pk__in=video_ids).update(**{field: count})
+
+        drifted = sum(len(video_ids) for video_ids in videos_by_count.values())
+        if drifted:
+            logger.warning('Fixed the %s of %s videos', field, drifted)
+        fixed += drifted
+    return fixed
@@ -0,0 +1,67 @@
+"""
+A cache of the follow graph: the ids of the users each user is following.
+
+Hot endpoints (the feed, "following" flags on videos and users) need to know who the request user follows on every
+request. Instead of a subquery on Follow each time, the ids are kept in the cache (settings.FOLLOW_GRAPH_CACHE) as a
+compact array of unsigned ints. Each user's array is stored under a versioned key; a change to the user's follows
+(see heartface.apps.core.signals) just bumps the version, so a stale array is never read again and simply expires.
+"""
+import time
+from array import array
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+from heartface.apps.core.models import Follow
+
+VERSION_KEY = 'follow_graph:%s:version'
+FOLLOWING_KEY = 'follow_graph:%s:%s:following'
+
+
+def _cache():
+    return caches[settings.FOLLOW_GRAPH_CACHE]
+
+
+def _version(user_id):
+    key = VERSION_KEY % user_id
+    version = _cache().get(key)
+    if version is None:
+        # Start from the current time (in ms), so even if the key got evicted, a version used before isn't reused. add()
+        #  only sets it if no one else did in the meantime.
+        _cache().add(key, int(time.time() * 1000), timeout=None)
+        version = _cache().get(key)
+    return version
+
+
+def following_ids(user_id):
+    """
+    The ids of the users `user_id` is following (including the disabled ones) as a frozenset
+    """
+    key = FOLLOWING_KEY % (user_id, _version(user_id))
+    packed = _cache().get(key)
+    if packed is None:
+        ids = array('I', Follow.objects.filter(follower_id=user_id).values_list('followed_id', flat=True))
+        _cache().set(key, ids.tobytes(), timeout=settings.FOLLOW_GRAPH_CACHE_TIMEOUT)
+    else:
+        ids = array('I')
+        ids.frombytes(packed)
+    return frozenset(ids)
+
+
+def invalidate(user_id):
+    """
+    Drop the cached follows of `user_id`. It's done right away (so the rest of the current transaction sees the change)
+    and once more after the commit, because a concurrent request may have cached the follows from before the commit in
+    the meantime.
+    """
+    _bump_version(user_id)
+    transaction.on_commit(lambda: _bump_version(user_id))
+
+
+def _bump_version(user_id):
+    try:
+        _cache().incr(VERSION_KEY % user_id)
+    except ValueError:
+        # Not cached (yet or anymore), the next read starts a new version
+        pass
@@ -0,0 +1,235 @@
+"""
+Archiving video files to Amazon Glacier.
+
+Archives are uploaded with the multipart API: the data is cut into parts of settings.AWS_GLACIER_PART_SIZE, which are
+uploaded by a pool of threads (settings.AWS_GLACIER_MAX_CONCURRENT_PARTS at the same time) while the next part is read.
+The SHA-256 tree hash Glacier wants for every part and for the whole archive is computed on the fly, from the 1 MB
+chunks of the parts, so nothing is read twice.
+
+Videos smaller than settings.AWS_GLACIER_BUNDLE_VIDEO_SIZE are bundled: several of them go into one archive, a tar with
+a manifest.json (the video ids, their name in the tar and their size) followed by the video files. Their GlacierFile
+records the name of the video in the tar as `member`.
+"""
+import binascii
+import hashlib
+import json
+import logging
+import os
+import tarfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from io import BytesIO
+
+import boto3
+from django.conf import settings
+from django.db import IntegrityError, transaction
+
+from heartface.apps.core.models import Video, GlacierFile
+
+logger = logging.getLogger(__name__)
+
+# The tree hash is built from the hashes of 1 MB chunks
+CHUNK_SIZE = 1024 * 1024
+
+# Glacier's limit on archive descriptions
+MAX_DESCRIPTION_LENGTH = 1024
+
+
+class ArchiveExists(Exception):
+    pass
+
+
+def _client():
+    return boto3.client(
+        'glacier',
+        region_name=settings.AWS_REGION_NAME,
+        aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+        aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+    )
+
+
+def tree_hash(chunk_hashes):
+    """
+    The tree hash (as bytes) of the data with the SHA-256 hashes of its 1 MB chunks in `chunk_hashes`
+    """
+    if not chunk_hashes:
+        return hashlib.sha256().digest()
+    while len(chunk_hashes) > 1:
+        chunk_hashes = [hashlib.sha256(b''.join(chunk_hashes[i:i + 2])).digest() if i + 1 < len(chunk_hashes)
+                        else chunk_hashes[i] for i in range(0, len(chunk_hashes), 2)]
+    return chunk_hashes[0]
+
+
+def _description(text):
+    # Glacier only takes printable ASCII
+    return ''.join(c for c in text if ' ' <= c <= '~')[:MAX_DESCRIPTION_LENGTH]
+
+
+class ArchiveWriter(object):
+    """
+    A file-like object that uploads what's written to it as a Glacier archive, with a multipart upload. The archive
+    is complete when the writer is closed (or the with block exits), its id is `archive_id` then. The upload is
+    aborted if the with block raises.
+    """
+    def __init__(self, client, description):
+        self.client = client
+        self.archive_id = None
+        self.size = 0
+        self._buffer = bytearray()
+        self._part_hashes = {}
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=settings.AWS_GLACIER_MAX_CONCURRENT_PARTS)
+        self.upload_id = client.initiate_multipart_upload(
+            accountId='-', vaultName=settings.AWS_GLACIER_VAULT_NAME, archiveDescription=_description(description),
+            partSize=str(settings.AWS_GLACIER_PART_SIZE))['uploadId']
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= settings.AWS_GLACIER_PART_SIZE:
+            self._send(bytes(self._buffer[:settings.AWS_GLACIER_PART_SIZE]))
+            del self._buffer[:settings.AWS_GLACIER_PART_SIZE]
+        return len(data)
+
+    def _send(self, part):
+        # Only this many parts are held in memory, the writer waits for one of them to be uploaded
+        if len(self._pending) >= settings.AWS_GLACIER_MAX_CONCURRENT_PARTS:
+            done, self._pending = wait(self._pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                future.result()
+        self._pending.add(self._executor.submit(self._upload_part, self.size, part))
+        self.size += len(part)
+
+    def _upload_part(self, offset, part):
+        chunk_hashes = [hashlib.sha256(part[i:i + CHUNK_SIZE]).digest() for i in range(0, len(part), CHUNK_SIZE)]
+        self.client.upload_multipart_part(
+            accountId='-', vaultName=settings.AWS_GLACIER_VAULT_NAME, uploadId=self.upload_id,
+            range='bytes %d-%d/*' % (offset, offset + len(part) - 1),
+            checksum=binascii.hexlify(tree_hash(chunk_hashes)).decode('ascii'), body=part)
+        with self._lock:
+            self._part_hashes[offset] = chunk_hashes
+
+    def close(self):
+        if self.archive_id is not None:
+            return
+        try:
+            if self._buffer:
+                self._send(bytes(self._buffer))
+                self._buffer = bytearray()
+            for future in self._pending:
+                future.result()
+        except BaseException:
+            self.abort()
+            raise
+        self._executor.shutdown()
+
+        chunk_hashes = [h for offset in sorted(self._part_hashes) for h in self._part_hashes[offset]]
+        self.archive_id = self.client.complete_multipart_upload(
+            accountId='-', vaultName=settings.AWS_GLACIER_VAULT_NAME, uploadId=self.upload_id,
+            archiveSize=str(self.size), checksum=binascii.hexlify(tree_hash(chunk_hashes)).decode('ascii'))['archiveId']
+
+    def abort(self):
+        for future in self._pending:
+            future.cancel()
+        self._executor.shutdown()
+        self.client.abort_multipart_upload(accountId='-', vaultName=settings.AWS_GLACIER_VAULT_NAME,
+                                           uploadId=self.upload_id)
+
+
+def _video_file_size(video):
+    try:
+        return os.path.getsize(video.videofile.path)
+    except OSError:
+        return None
+
+
+def bundles(video_ids):
+    """
+    The video ids grouped into archives: the videos smaller than settings.AWS_GLACIER_BUNDLE_VIDEO_SIZE are bundled
+    up to settings.AWS_GLACIER_BUNDLE_MAX_SIZE, the others are archived alone.
+    """
+    if not settings.AWS_GLACIER_BUNDLE_VIDEO_SIZE:
+        return [[video_id] for video_id in video_ids]
+
+    groups, bundle, bundle_size = [], [], 0
+    for video in Video.objects.filter(pk__in=video_ids).order_by('pk'):
+        size = _video_file_size(video)
+        if size is None or size >= settings.AWS_GLACIER_BUNDLE_VIDEO_SIZE:
+            groups.append([video.pk])
+            continue
+        if bundle and bundle_size + size > settings.AWS_GLACIER_BUNDLE_MAX_SIZE:
+            groups.append(bundle)
+            bundle, bundle_size = [], 0
+        bundle.append(video.pk)
+        bundle_size += size
+    if bundle:
+        groups.append(bundle)
+    return groups
+
+
+def archive_video(video):
+    """
+    Archive the file of the video on its own, record its GlacierFile and delete the local file. Raises ArchiveExists
+    (after deleting the new archive) if the video has been archived by someone else meanwhile.
+    """
+    client = _client()
+    with open(video.videofile.path, 'rb') as f, \
+            ArchiveWriter(client, 'Video %s %s' % (video.pk, video.videofile.name)) as archive:
+        while True:
+            block = f.read(settings.AWS_GLACIER_PART_SIZE)
+            if not block:
+                break
+            archive.write(block)
+
+    _record(client, archive, [(video, '')])
+    os.unlink(video.videofile.path)
+    return archive.archive_id
+
+
+def archive_bundle(videos):
+    """
+    Archive the files of the videos together in a tar with a manifest, record their GlacierFiles and delete the local
+    files. Raises ArchiveExists like archive_video.
+    """
+    members = [(video, '%s/%s' % (video.pk, os.path.basename(video.videofile.name))) for video in videos]
+    manifest = json.dumps([
+        {'video_id': video.pk, 'name': name, 'size': os.path.getsize(video.videofile.path)} for video, name in members
+    ]).encode('utf-8')
+
+    client = _client()
+    with ArchiveWriter(client, 'Videos %s' % ' '.join(str(video.pk) for video in videos)) as archive:
+        with tarfile.open(fileobj=archive, mode='w|') as tar:
+            info = tarfile.TarInfo('manifest.json')
+            info.size = len(manifest)
+            tar.addfile(info, BytesIO(manifest))
+            for video, name in members:
+                tar.add(video.videofile.path, arcname=name)
+
+    _record(client, archive, members)
+    for video, name in members:
+        os.unlink(video.videofile.path)
+    return archive.archive_id
+
+
+def _record(client, archive, members):
+    try:
+        with transaction.atomic():
+            for video, name in members:
+                GlacierFile.objects.create(video=video, archive_id=archive.archive_id, member=name,
+                                           size=video.videofile.size)
+    except IntegrityError:
+        # The video (or one of them) already has a GlacierFile, it's been archived by another task
+        logger.error('Already archived: videos %s, deleting archive %s', [video.pk for video, _ in members],
+                     archive.archive_id)
+        client.delete_archive(accountId='-', vaultName=settings.AWS_GLACIER_VAULT_NAME,
+                              archiveId=archive.archive_id)
+        raise ArchiveExists()
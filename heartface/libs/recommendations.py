@@ -0,0 +1,112 @@
+"""
+The candidate pools of the recommended videos (see RecommendedVideosListView).
+
+Recommendations are sampled from the videos recommended by the admins, then from the most viewed 10%, 10-20% and
+20-30% of the other videos. Instead of ranking the whole catalog on every request, the refresh_recommendation_pools
+task ranks it periodically and keeps the ids of each pool in the cache (settings.RECOMMENDATION_POOLS_CACHE, which needs
+to be shared by the workers and the web processes) as compact arrays of unsigned ints, ordered by view count. A request
+samples from them in memory, skipping the videos the user has seen, and only loads the videos picked.
+
+The pools are computed over all the videos, not just the ones the user hasn't seen, and are only as fresh as the last
+refresh: a video published since then isn't a candidate yet, one deleted since then is dropped when the picked videos
+are loaded.
+"""
+import math
+import random
+from array import array
+
+from django.conf import settings
+from django.core.cache import caches
+
+from heartface.apps.core.models import Video
+
+POOLS_KEY = 'recommendations:pools'
+
+
+def _cache():
+    return caches[settings.RECOMMENDATION_POOLS_CACHE]
+
+
+def candidates():
+    """
+    The videos that can be recommended: published, available on the CDN, with an active owner
+    """
+    return Video.objects.filter(owner__disabled=False, published__isnull=False, cdn_available__isnull=False)
+
+
+def compute_pools():
+    """
+    The pools as a list of arrays of video ids: the admin recommended videos first, then the percentile buckets
+    (settings.RECOMMENDATION_PERCENTILES) of the others by view count. Only the ids in the buckets are read.
+    """
+    pools = [array('I', candidates().filter(recommended=True).values_list('pk', flat=True))]
+
+    others = candidates().filter(recommended=False).order_by('-view_count', 'pk')
+    total = others.count()
+    cutoffs = [math.ceil(percentile * total) for percentile in settings.RECOMMENDATION_PERCENTILES]
+    ranked = array('I', others.values_list('pk', flat=True)[:cutoffs[-1]]) if total else array('I')
+    for start, end in zip([0] + cutoffs, cutoffs):
+        pools.append(ranked[start:end])
+    return pools
+
+
+def refresh():
+    """
+    Recompute the pools and cache them. Returns them.
+    """
+    pools = compute_pools()
+    _cache().set(POOLS_KEY, [pool.tobytes() for pool in pools], timeout=settings.RECOMMENDATION_POOLS_TIMEOUT)
+    return pools
+
+
+def pools():
+    """
+    The cached pools, computed right away if they're not cached (yet or anymore)
+    """
+    packed = _cache().get(POOLS_KEY)
+    if packed is None:
+        return refresh()
+
+    unpacked = []
+    for pool_bytes in packed:
+        pool = array('I')
+        pool.frombytes(pool_bytes)
+        unpacked.append(pool)
+    return unpacked
+
+
+def sample(pool, count, exclude, picked=()):
+    """
+    At most `count` random ids from `pool` that aren't in `exclude` (anything supporting `in`) or `picked`. Random picks
+    are retried a few times (it's O(count) as long as most of the pool isn't excluded), then the rest of the pool is
+    filtered.
+    """
+    def allowed(video_id):
+        return video_id not in chosen and video_id not in picked and video_id not in exclude
+
+    chosen = []
+    for _ in range(count * 10 if pool else 0):
+        video_id = pool[random.randrange(len(pool))]
+        if allowed(video_id):
+            chosen.append(video_id)
+            if len(chosen) == count:
+                return chosen
+
+    rest = [video_id for video_id in pool if allowed(video_id)]
+    return chosen + random.sample(rest, min(count - len(chosen), len(rest)))
+
+
+def recommend(count, seen):
+    """
+    The ids of `count` videos to recommend, the ones in `seen` (the ids of the videos the user has seen, or their
+    heartface.libs.seen_filter) only if there isn't enough of the others
+    """
+    recommended, *buckets = pools()
+
+    # The unseen recommended videos first, then the most viewed, then the seen recommended videos
+    video_ids = []
+    for pool, exclude in [(recommended, seen)] + [(bucket, seen) for bucket in buckets] + [(recommended, ())]:
+        if len(video_ids) == count:
+            break
+        video_ids.extend(sample(pool, count - len(video_ids), exclude, picked=video_ids))
+    return video_ids
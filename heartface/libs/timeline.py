@@ -0,0 +1,123 @@
+"""
+Materialized feed timelines for the push mode of the feed (settings.FEED_MODE).
+
+In pull mode the feed is computed on every request by looking at the activity of everyone the user follows. In push
+mode every upload/like/comment/follow is fanned out (by celery tasks, see heartface.apps.core.tasks) into a compact
+FeedTimelineEntry for each follower of the acting user, so a feed page is a single index range scan on the timeline.
+"""
+import logging
+from collections import namedtuple
+
+from django.conf import settings
+from django.db import transaction
+
+from heartface.apps.core.models import Video, Like, Comment, Follow, FeedTimelineEntry
+
+logger = logging.getLogger(__name__)
+
+FEED_MODE_PULL = 'pull'
+FEED_MODE_PUSH = 'push'
+
+# Where the items of a given type come from: the model, the FK to the user doing it and the field the feed is
+#  ordered by.
+TimelineSource = namedtuple('TimelineSource', ['model', 'actor_field', 'order_field'])
+
+SOURCES = {
+    FeedTimelineEntry.TYPES.video: TimelineSource(Video, 'owner', 'published'),
+    FeedTimelineEntry.TYPES.like: TimelineSource(Like, 'user', 'created'),
+    FeedTimelineEntry.TYPES.comment: TimelineSource(Comment, 'author', 'created'),
+    FeedTimelineEntry.TYPES.follow: TimelineSource(Follow, 'follower', 'created'),
+}
+
+MODEL_TYPES = {source.model: item_type for item_type, source in SOURCES.items()}
+
+
+def is_push_mode():
+    return settings.FEED_MODE == FEED_MODE_PUSH
+
+
+def timeline_for(user):
+    """
+    The timeline of `user`. Entries of disabled users are left out the same way they are in pull mode.
+    """
+    return FeedTimelineEntry.objects.filter(owner=user, actor__disabled=False)
+
+
+def fan_out(item_type, object_id):
+    """
+    Append the item to the timeline of every follower of the user who did it. Followers that already have the entry
+    are skipped, so running it again (e.g. on a task retry) is harmless.
+
+    Returns the number of entries created.
+    """
+    source = SOURCES[item_type]
+    actor_field = '%s_id' % source.actor_field
+    try:
+        item = source.model.objects.values(actor_field, source.order_field).get(pk=object_id)
+    except source.model.DoesNotExist:
+        # Deleted before we got to it
+        logger.warning('Not fanning out missing feed item [type=%s, id=%s]', item_type, object_id)
+        return 0
+
+    if item[source.order_field] is None:
+        # Unpublished video. It will be fanned out when published.
+        return 0
+
+    existing = set(FeedTimelineEntry.objects.filter(type=item_type, object_id=object_id)
+                   .values_list('owner_id', flat=True))
+    entries = [FeedTimelineEntry(owner_id=follower_id, actor_id=item[actor_field], type=item_type,
+                                 object_id=object_id, feed_order=item[source.order_field])
+               for follower_id in Follow.objects.filter(followed_id=item[actor_field])
+                                                .values_list('follower_id', flat=True)
+               if follower_id not in existing]
+    FeedTimelineEntry.objects.bulk_create(entries, batch_size=settings.FEED_TIMELINE_BATCH_SIZE)
+    logger.debug('Fanned out feed item [type=%s, id=%s] to %s timelines', item_type, object_id, len(entries))
+    return len(entries)
+
+
+def retract(item_type, object_id):
+    """
+    Remove a (deleted) item from every timeline
+    """
+    FeedTimelineEntry.objects.filter(type=item_type, object_id=object_id).delete()
+
+
+def retract_actor(owner_id, actor_id):
+    """
+    Remove everything done by `actor_id` from the timeline of `owner_id`. (Used when `owner_id` unfollows `actor_id`.)
+    """
+    FeedTimelineEntry.objects.filter(owner_id=owner_id, actor_id=actor_id).delete()
+
+
+def backfill(owner_id, actor_ids=None):
+    """
+    (Re)build the timeline of `owner_id` from the activity tables, or only the part of it containing the activity of
+    `actor_ids` (e.g. when starting to follow someone). At most settings.FEED_TIMELINE_BACKFILL_LIMIT of the most recent
+    items of each type are copied.
+
+    Returns the number of entries created.
+    """
+    followed_ids = Follow.objects.filter(follower_id=owner_id).values_list('followed_id', flat=True)
+    if actor_ids is not None:
+        followed_ids = followed_ids.filter(followed_id__in=actor_ids)
+    followed_ids = list(followed_ids)
+
+    entries = []
+    for item_type, source in SOURCES.items():
+        actor_field = '%s_id' % source.actor_field
+        items = source.model.objects.filter(**{'%s__in' % actor_field: followed_ids,
+                                               '%s__isnull' % source.order_field: False}) \
+            .order_by('-%s' % source.order_field) \
+            .values_list('pk', actor_field, source.order_field)[:settings.FEED_TIMELINE_BACKFILL_LIMIT]
+        entries.extend(FeedTimelineEntry(owner_id=owner_id, actor_id=actor_id, type=item_type, object_id=pk,
+                                         feed_order=feed_order)
+                       for pk, actor_id, feed_order in items)
+
+    with transaction.atomic():
+        stale = FeedTimelineEntry.objects.filter(owner_id=owner_id)
+        if actor_ids is not None:
+            stale = stale.filter(actor_id__in=actor_ids)
+        stale.delete()
+        FeedTimelineEntry.objects.bulk_create(entries, batch_size=settings.FEED_TIMELINE_BATCH_SIZE)
+
+    return len(entries)
@@ -0,0 +1,274 @@
+"""
+Incremental counting of the activity behind the trending profiles and hashtags (see check_trending).
+
+A trending score compares the popularity score of a user or hashtag in the last settings.TRENDING_WINDOW_SIZE with the
+one in the window before. Instead of aggregating all the comments, likes, views etc. of both windows on every run, the
+update_trending_counters task adds the activity since the last update (the watermark) to hourly TrendingCounters, one
+per user or hashtag, source (kind of activity) and hour. The scores of both windows are then summed from the counters.
+
+Scoring works on NumPy arrays aligned by user or hashtag id, so it stays fast with millions of them: the weighted sums
+of both windows, the trending scores and the top ones (with argpartition, the rest isn't sorted).
+
+Activity is counted settings.TRENDING_COUNTER_LAG after it happens, so rows being written when an update runs aren't
+missed. The counters only grow: deleted activity is still counted until it's out of the windows, and a video is counted
+for the hashtags it has when it becomes available on the CDN. Counters older than the two windows are deleted.
+
+popularity_scores computes the popularity scores of users from the activity itself instead, both windows in one query.
+drift compares the two (see the check_trending_counters command).
+"""
+import logging
+import re
+from collections import Counter, defaultdict, namedtuple
+from datetime import timedelta
+from itertools import chain
+
+import numpy as np
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import BooleanField, Case, Count, Sum, Value, When
+from django.db.models.functions import TruncHour
+from django.utils import timezone
+
+from heartface.apps.core.models import Video, Like, Comment, View, Follow, Hashtag, TrendingCounter, \
+    TrendingWatermark
+
+logger = logging.getLogger(__name__)
+
+# Weighting for popularity score components, in the order of TrendingCounter.SOURCES
+Weight = namedtuple('Weight', 'views likes followers comments uploads hashtag_videos hashtag_comments')
+weight = Weight(3, 1, 2, 3, 1, 1, 1)
+WEIGHTS = np.array(weight, dtype=np.int64)
+
+SOURCES = TrendingCounter.SOURCES
+USER_SOURCES = (SOURCES.views, SOURCES.likes, SOURCES.followers, SOURCES.comments, SOURCES.uploads)
+HASHTAG_SOURCES = (SOURCES.hashtag_videos, SOURCES.hashtag_comments)
+
+HOUR = timedelta(hours=1)
+
+HASHTAG_PATTERN = r"(?:^|\s)[＃#]{1}(\w+)"
+hashtag_re = re.compile(HASHTAG_PATTERN, re.UNICODE)
+
+# Where the activity of a source comes from: the model, the user or hashtag it counts for, when it happened (the hour
+#  it's counted in) and when it became countable (compared with the watermark, when it happened by default)
+Activity = namedtuple('Activity', ['model', 'object_field', 'time_field', 'new_field'])
+
+ACTIVITY = {
+    SOURCES.views: Activity(View, 'video__owner', 'created', None),
+    SOURCES.likes: Activity(Like, 'video__owner', 'created', None),
+    SOURCES.followers: Activity(Follow, 'followed', 'created', None),
+    SOURCES.comments: Activity(Comment, 'video__owner', 'created', None),
+    SOURCES.uploads: Activity(Video, 'owner', 'published', None),
+    # Only videos available on the CDN count for their hashtags
+    SOURCES.hashtag_videos: Activity(Video.hashtags.through, 'hashtag', 'video__published', 'video__cdn_available'),
+}
+
+
+def _hour(t):
+    return t.astimezone(timezone.utc).replace(minute=0, second=0, microsecond=0)
+
+
+def _new_activity(start, end):
+    """
+    The activity that became countable in [start, end) as (hour, source, user or hashtag id, count)
+    """
+    for source, activity in ACTIVITY.items():
+        new_field = activity.new_field or activity.time_field
+        rows = activity.model.objects.filter(**{'%s__gte' % new_field: start, '%s__lt' % new_field: end}) \
+            .annotate(hour=TruncHour(activity.time_field, tzinfo=timezone.utc)) \
+            .order_by().values('hour', activity.object_field).annotate(count=Count('pk')) \
+            .values_list('hour', activity.object_field, 'count')
+        for hour, object_id, count in rows:
+            if hour is not None and object_id is not None:
+                yield hour, source, object_id, count
+
+    # Comments mentioning hashtags, every mention counts for every hashtag with that name
+    mentions = Counter()
+    for created, text in Comment.objects.filter(created__gte=start, created__lt=end, text__regex=HASHTAG_PATTERN) \
+            .values_list('created', 'text').iterator():
+        for name in hashtag_re.findall(text):
+            mentions[_hour(created), name] += 1
+    hashtag_ids = defaultdict(list)
+    for hashtag_id, name in Hashtag.objects.filter(name__in={name for _, name in mentions}).values_list('pk', 'name'):
+        hashtag_ids[name].append(hashtag_id)
+    for (hour, name), count in mentions.items():
+        for hashtag_id in hashtag_ids[name]:
+            yield hour, SOURCES.hashtag_comments, hashtag_id, count
+
+
+def _add(counts):
+    # An upsert, the counters of the current hour are added to by every update
+    table = TrendingCounter._meta.db_table
+    counts = list(counts.items())
+    with connection.cursor() as cursor:
+        for i in range(0, len(counts), settings.TRENDING_COUNTER_BATCH_SIZE):
+            batch = counts[i:i + settings.TRENDING_COUNTER_BATCH_SIZE]
+            cursor.execute(
+                'INSERT INTO {table} (hour, source, object_id, count) VALUES {values} '
+                'ON CONFLICT (hour, source, object_id) DO UPDATE SET count = {table}.count + EXCLUDED.count'.format(
+                    table=table, values=', '.join(['(%s, %s, %s, %s)'] * len(batch))),
+                [value for (hour, source, object_id), count in batch for value in (hour, source, object_id, count)])
+
+
+def _watermark():
+    # Locked, so only one update runs at a time. The first one counts the activity of the last two windows.
+    TrendingWatermark.objects.get_or_create(
+        pk=1, defaults={'counted_until': _hour(timezone.now()) - 2 * settings.TRENDING_WINDOW_SIZE})
+    return TrendingWatermark.objects.select_for_update().get(pk=1)
+
+
+def update():
+    """
+    Add the activity since the last update to the counters and delete the ones out of the windows. Returns the number
+    of counters added to.
+    """
+    with transaction.atomic():
+        watermark = _watermark()
+        start, end = watermark.counted_until, timezone.now() - settings.TRENDING_COUNTER_LAG
+        if end <= start:
+            return 0
+
+        # Nothing older than the previous window is kept (a video can become available on the CDN long after it was
+        #  published)
+        oldest = _hour(end) + HOUR - 2 * settings.TRENDING_WINDOW_SIZE
+        counts = Counter()
+        for hour, source, object_id, count in _new_activity(start, end):
+            if hour >= oldest:
+                counts[hour, source, object_id] += count
+        _add(counts)
+        TrendingCounter.objects.filter(hour__lt=oldest).delete()
+
+        watermark.counted_until = end
+        watermark.save()
+
+    logger.info('Counted the activity from %s to %s for trending, %s counters', start, end, len(counts))
+    return len(counts)
+
+
+def _popularity_sql():
+    # A UNION ALL of the weighted activity counts of each source by user and window
+    video = Video._meta.db_table
+    branches = [
+        'SELECT video.owner_id AS user_id, activity.created >= %(current_start)s AS in_current, '
+        '%({source})s * COUNT(*) AS score '
+        'FROM {table} activity JOIN {video} video ON video.id = activity.video_id '
+        'WHERE activity.created >= %(start)s AND activity.created < %(end)s '
+        'GROUP BY 1, 2'.format(source=source, table=model._meta.db_table, video=video)
+        for source, model in (('comments', Comment), ('likes', Like), ('views', View))
+    ]
+    branches.append(
+        'SELECT followed_id, created >= %(current_start)s, %(followers)s * COUNT(*) '
+        'FROM {follow} WHERE created >= %(start)s AND created < %(end)s '
+        'GROUP BY 1, 2'.format(follow=Follow._meta.db_table))
+    branches.append(
+        'SELECT owner_id, published >= %(current_start)s, %(uploads)s * COUNT(*) '
+        'FROM {video} WHERE published >= %(start)s AND published < %(end)s '
+        'GROUP BY 1, 2'.format(video=video))
+    return 'SELECT user_id, in_current, CAST(SUM(score) AS bigint) FROM ({}) scores ' \
+        'GROUP BY user_id, in_current'.format(' UNION ALL '.join(branches))
+
+
+def popularity_scores(t):
+    """
+    The popularity scores of the users in the settings.TRENDING_WINDOW_SIZE before `t` and in the window before that,
+    as two dicts indexed by user id. Computed from the activity itself rather than the counters, in a single query.
+    """
+    params = dict(weight._asdict(), end=t, current_start=t - settings.TRENDING_WINDOW_SIZE,
+                  start=t - 2 * settings.TRENDING_WINDOW_SIZE)
+    with connection.cursor() as cursor:
+        cursor.execute(_popularity_sql(), params)
+        rows = cursor.fetchall()
+
+    current, previous = defaultdict(int), defaultdict(int)
+    for user_id, is_current, score in rows:
+        (current if is_current else previous)[user_id] += score
+    return current, previous
+
+
+def sum_windows(counters):
+    """
+    The popularity scores in both windows from `counters`, (user or hashtag id, source, in the current window, count)
+    rows, as aligned arrays: the ids (sorted), their score in the current window and in the previous one
+    """
+    rows = np.fromiter(chain.from_iterable(counters), dtype=np.int64).reshape(-1, 4)
+    ids, index = np.unique(rows[:, 0], return_inverse=True)
+    weighted = WEIGHTS[rows[:, 1]] * rows[:, 3]
+    is_current = rows[:, 2].astype(bool)
+    current = np.bincount(index[is_current], weights=weighted[is_current], minlength=len(ids))
+    previous = np.bincount(index[~is_current], weights=weighted[~is_current], minlength=len(ids))
+    return ids, current, previous
+
+
+def window_scores(sources, end=None):
+    """
+    The popularity scores from the counters of `sources` (USER_SOURCES or HASHTAG_SOURCES) in the current window, the
+    last settings.TRENDING_WINDOW_SIZE up to the hour of the last update (or up to the hour `end`), and in the previous
+    window. See sum_windows.
+    """
+    if end is None:
+        counted_until = TrendingWatermark.objects.values_list('counted_until', flat=True).first()
+        if counted_until is None:
+            return sum_windows([])
+        end = _hour(counted_until) + HOUR
+    current_start = end - settings.TRENDING_WINDOW_SIZE
+
+    counters = TrendingCounter.objects \
+        .filter(source__in=sources, hour__gte=current_start - settings.TRENDING_WINDOW_SIZE, hour__lt=end) \
+        .annotate(current=Case(When(hour__gte=current_start, then=Value(True)), default=Value(False),
+                               output_field=BooleanField())) \
+        .order_by().values('object_id', 'source', 'current').annotate(total=Sum('count')) \
+        .values_list('object_id', 'source', 'current', 'total')
+    return sum_windows(counters.iterator())
+
+
+def drift():
+    """
+    The users whose popularity score in the current window differs between the counters and their activity, e.g. by
+    activity deleted since it was counted, as sorted (user id, score from the counters, score from the activity). The
+    window ends at the last whole hour counted.
+    """
+    counted_until = TrendingWatermark.objects.values_list('counted_until', flat=True).first()
+    if counted_until is None:
+        return []
+    end = _hour(counted_until)
+    ids, current, _ = window_scores(USER_SOURCES, end)
+    counted = dict(zip(ids.tolist(), current.astype(np.int64).tolist()))
+    actual, _ = popularity_scores(end)
+    return sorted((user_id, counted.get(user_id, 0), actual.get(user_id, 0))
+                  for user_id in set(counted).union(actual) if counted.get(user_id, 0) != actual.get(user_id, 0))
+
+
+def trending_scores(ids, current, previous):
+    """
+    The trending scores of the users or hashtags active in the current window: the change of their popularity score,
+    relative to the previous one (at least settings.TRENDING_THRESHOLD). Returns their ids and scores as arrays.
+    """
+    active = current > 0
+    previous = previous[active]
+    return ids[active], (current[active] - previous) / np.maximum(previous, settings.TRENDING_THRESHOLD)
+
+
+def best(scores, k):
+    """
+    The indices of the `k` best `scores`, best first, without sorting all of them
+    """
+    k = min(k, len(scores))
+    if not k:
+        return np.array([], dtype=np.int64)
+    indices = np.argpartition(-scores, k - 1)[:k]
+    return indices[np.argsort(-scores[indices], kind='mergesort')]
+
+
+def top(ids, scores, model):
+    """
+    The settings.TRENDING_LIMIT best (id, score), leaving out the users or hashtags (`model`) deleted since their
+    activity was counted
+    """
+    limit = k = settings.TRENDING_LIMIT
+    while True:
+        indices = best(scores, k)
+        existing = set(model.objects.filter(pk__in=ids[indices].tolist()).values_list('pk', flat=True))
+        found = [(object_id, score) for object_id, score in zip(ids[indices].tolist(), scores[indices].tolist())
+                 if object_id in existing]
+        if len(found) >= limit or len(indices) == len(scores):
+            return found[:limit]
+        k *= 2
@@ -0,0 +1,140 @@
+"""
+Deleting the videos that were uploaded but never published, after settings.UNPUBLISHED_VIDEO_RETAIN_WINDOW.
+
+The videos are deleted in chunks of settings.UNPUBLISHED_VIDEO_CLEANUP_CHUNK_SIZE, in primary key order, with one
+DELETE per chunk (plus one per related table), one bulk request to Elasticsearch and their files removed by a pool of
+threads. This bypasses Video's delete signals: the only one that matters for unpublished videos is the removal from the
+search index, which is done in bulk here (they're never fanned out to timelines).
+
+The resumable uploads (UploadSessions) abandoned for settings.VIDEO_UPLOAD_SESSION_EXPIRY are deleted along with their
+partial files by the same task.
+"""
+import logging
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import models, transaction
+from django.utils import timezone
+from elasticsearch import ElasticsearchException
+from elasticsearch.helpers import bulk
+from elasticsearch_dsl.connections import connections
+
+from heartface.apps.core.models import UploadSession, Video
+from heartface.apps.core.search_indexes import VideoIndex
+
+logger = logging.getLogger(__name__)
+
+# The result of a cleanup: the number of videos deleted (or to be deleted in a dry run) and whether it stopped because
+# the time budget ran out
+CleanupStats = namedtuple('CleanupStats', ['deleted', 'out_of_time'])
+
+
+def stale_videos():
+    return Video.objects.filter(published__isnull=True,
+                                created__lte=timezone.now() - settings.UNPUBLISHED_VIDEO_RETAIN_WINDOW)
+
+
+def _delete_related(video_ids):
+    # What the cascade of Video.delete() would do, one query per related table (more for related models with delete
+    # signals of their own)
+    for relation in Video._meta.get_fields(include_hidden=True):
+        if not (relation.auto_created and not relation.concrete and (relation.one_to_many or relation.one_to_one)):
+            continue
+        related = relation.related_model._base_manager.filter(**{'%s__in' % relation.field.name: video_ids})
+        if relation.on_delete is models.CASCADE:
+            related.delete()
+        elif relation.on_delete is models.SET_NULL:
+            related.update(**{relation.field.name: None})
+
+
+def _delete_from_index(video_ids):
+    actions = [{'_op_type': 'delete', '_index': VideoIndex._doc_type.index, '_type': VideoIndex._doc_type.name,
+                '_id': video_id} for video_id in video_ids]
+    try:
+        # Not found is fine, they may not have been indexed yet
+        bulk(connections.get_connection(), actions, raise_on_error=False)
+    except ElasticsearchException:
+        logger.error('Removing videos %s-%s from the search index failed', video_ids[0], video_ids[-1], exc_info=True)
+
+
+def _delete_file(name):
+    try:
+        Video._meta.get_field('videofile').storage.delete(name)
+    except OSError:
+        logger.warning('Unable to delete %s', name, exc_info=True)
+
+
+def cleanup(dry_run=False, time_budget=None, chunk_size=None):
+    """
+    Delete the stale unpublished videos, their related objects, search index entries and files. With `dry_run`
+    nothing's deleted, only counted. It stops after the chunk that used up the `time_budget` (seconds), the next
+    cleanup carries on from there. Returns the CleanupStats.
+    """
+    chunk_size = chunk_size or settings.UNPUBLISHED_VIDEO_CLEANUP_CHUNK_SIZE
+    started = time.monotonic()
+    deleted = 0
+    last_pk = 0
+
+    with ThreadPoolExecutor(max_workers=settings.UNPUBLISHED_VIDEO_CLEANUP_FILE_WORKERS) as executor:
+        while True:
+            with transaction.atomic():
+                videos = stale_videos().filter(pk__gt=last_pk).order_by('pk')
+                if not dry_run:
+                    # Not published while being deleted
+                    videos = videos.select_for_update()
+                chunk = list(videos.values_list('pk', 'videofile')[:chunk_size])
+                if not chunk:
+                    break
+                video_ids = [video_id for video_id, _ in chunk]
+                last_pk = video_ids[-1]
+
+                if not dry_run:
+                    _delete_related(video_ids)
+                    Video.objects.filter(pk__in=video_ids)._raw_delete(Video.objects.db)
+
+            if not dry_run:
+                _delete_from_index(video_ids)
+                # Waits for them, so that only a chunk's worth of files is pending
+                list(executor.map(_delete_file, [name for _, name in chunk if name]))
+
+            deleted += len(video_ids)
+            elapsed = time.monotonic() - started
+            logger.info('%s %s unpublished videos (ids %s-%s), %s so far in %.1fs',
+                        'Would delete' if dry_run else 'Deleted', len(video_ids), video_ids[0], last_pk, deleted,
+                        elapsed)
+
+            if time_budget is not None and elapsed >= time_budget:
+                logger.warning('Out of time cleaning up unpublished videos, stopped after id %s', last_pk)
+                return CleanupStats(deleted, True)
+
+    return CleanupStats(deleted, False)
+
+
+def expired_uploads():
+    # Not the ones with a chunk being written
+    now = timezone.now()
+    return UploadSession.objects.filter(updated__lte=now - settings.VIDEO_UPLOAD_SESSION_EXPIRY) \
+        .exclude(claimed_until__gt=now)
+
+
+def cleanup_uploads(dry_run=False):
+    """
+    Delete the expired upload sessions and their partial files. With `dry_run` they're only counted. Returns the number
+    of sessions.
+    """
+    with transaction.atomic():
+        sessions = expired_uploads()
+        if not dry_run:
+            # Not resumed while being deleted
+            sessions = sessions.select_for_update(skip_locked=True)
+        expired = list(sessions.values_list('pk', 'path'))
+        if not dry_run:
+            UploadSession.objects.filter(pk__in=[pk for pk, _ in expired]).delete()
+
+    if not dry_run:
+        for _, path in expired:
+            _delete_file(path)
+    logger.info('%s %s expired uploads', 'Would delete' if dry_run else 'Deleted', len(expired))
+    return len(expired)
@@ -0,0 +1,75 @@
+"""
+Reading the properties of uploaded video files (duration, resolution, codec, bitrate) with ffprobe.
+
+Probing is done by the probe_video task after the upload, so it never holds up the upload request. ffprobe only reads
+the container headers and stream info, it doesn't decode the video.
+"""
+import json
+import logging
+import subprocess
+
+from django.conf import settings
+
+from heartface.apps.core.models import Video
+
+logger = logging.getLogger(__name__)
+
+
+class ProbeError(Exception):
+    pass
+
+
+def probe(path):
+    """
+    The properties of the video file at `path` as a dict of Video fields. Raises ProbeError if ffprobe fails.
+    """
+    command = [settings.FFPROBE_BINARY, '-v', 'error', '-print_format', 'json', '-show_format', '-show_streams', path]
+    try:
+        # Only stdout is JSON, the errors ffprobe reports go to stderr
+        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                timeout=settings.FFPROBE_TIMEOUT)
+    except (OSError, subprocess.SubprocessError) as e:
+        raise ProbeError('Unable to probe %s: %s' % (path, e))
+    errors = result.stderr.decode('utf-8', 'replace').strip()
+    if result.returncode:
+        logger.warning('ffprobe failed on %s: %s', path, errors)
+        raise ProbeError('Unable to probe %s: ffprobe exited with %s' % (path, result.returncode))
+    try:
+        info = json.loads(result.stdout.decode('utf-8'))
+    except ValueError as e:
+        logger.warning('ffprobe output for %s is invalid, errors: %s', path, errors)
+        raise ProbeError('Unable to probe %s: %s' % (path, e))
+
+    container = info.get('format', {})
+    stream = next((s for s in info.get('streams', []) if s.get('codec_type') == 'video'), {})
+
+    duration = container.get('duration') or stream.get('duration')
+    bitrate = container.get('bit_rate') or stream.get('bit_rate')
+    return {
+        'video_length': int(float(duration)) if duration else None,
+        'width': stream.get('width'),
+        'height': stream.get('height'),
+        'video_codec': stream.get('codec_name', ''),
+        'bitrate': int(bitrate) if bitrate else None,
+    }
+
+
+def probe_video(video_id):
+    """
+    Probe the file of the video and store the results on it. Returns False if it couldn't be probed.
+    """
+    try:
+        video = Video.objects.get(pk=video_id)
+    except Video.DoesNotExist:
+        logger.warning('Not probing missing video [id=%s]', video_id)
+        return False
+
+    try:
+        properties = probe(video.videofile.path)
+    except ProbeError:
+        logger.error('Probing video [id=%s] failed', video_id, exc_info=True)
+        return False
+
+    # update() doesn't trigger a save (and its signals) for what's just metadata
+    Video.objects.filter(pk=video_id).update(**properties)
+    return True
@@ -0,0 +1,135 @@
+"""
+Buffered ingestion of video views (settings.VIEW_INGESTION_MODE = 'buffered').
+
+Counting a view synchronously means an insert and an UPDATE of the view_count of the video, i.e. a row lock on the
+hottest videos exactly when they're the hottest. In buffered mode a view is only checked against the views seen so far
+(a set of user ids per video, a HyperLogLog of anonymous visitors per video) and appended to a queue in Redis. The
+ingest_views task drains the queue periodically: it inserts the View rows in bulk and adds the new views to the
+view_count of each video with a single UPDATE per distinct increment.
+
+The queue is drained at most once: events popped by a consumer that dies before writing them are lost. That's the
+price of not locking anything on the request path, and fine for view counts.
+"""
+import json
+import logging
+from collections import Counter, defaultdict
+
+import redis
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+
+from heartface.apps.core.models import Video, View, User
+from heartface.libs import seen_filter
+
+logger = logging.getLogger(__name__)
+
+INGESTION_MODE_SYNC = 'sync'
+INGESTION_MODE_BUFFERED = 'buffered'
+
+QUEUE_KEY = 'views:queue'
+USER_VIEWS_KEY = 'views:%s:users'
+ANONYMOUS_VIEWS_KEY = 'views:%s:anonymous'
+
+_redis = None
+
+
+def _connection():
+    global _redis
+    if _redis is None:
+        _redis = redis.StrictRedis.from_url(settings.VIEW_INGESTION_REDIS_URL)
+    return _redis
+
+
+def is_buffered():
+    return settings.VIEW_INGESTION_MODE == INGESTION_MODE_BUFFERED
+
+
+def record(video_id, user_id=None, visitor=None):
+    """
+    Queue a view of `video_id` by `user_id`, or by an anonymous `visitor` (a string identifying them). Returns False for
+    a repeated view, which isn't queued.
+
+    Anonymous visitors are only counted approximately: a HyperLogLog can't tell for sure if it has seen an element, so
+    a small fraction of the first views of anonymous visitors is taken for a repeated one.
+    """
+    connection = _connection()
+    if user_id is not None:
+        key = USER_VIEWS_KEY % video_id
+        new = connection.sadd(key, user_id)
+    else:
+        key = ANONYMOUS_VIEWS_KEY % video_id
+        new = connection.pfadd(key, visitor)
+    if not new:
+        return False
+
+    pipeline = connection.pipeline()
+    pipeline.expire(key, settings.VIEW_INGESTION_DEDUP_TIMEOUT)
+    pipeline.rpush(QUEUE_KEY, json.dumps({'video': video_id, 'user': user_id}))
+    pipeline.execute()
+    return True
+
+
+def ingest(batch_size=None):
+    """
+    Write the queued views to the database, `batch_size` (settings.VIEW_INGESTION_BATCH_SIZE by default) at a time until
+    the queue is empty. Returns the number of View rows created.
+    """
+    batch_size = batch_size or settings.VIEW_INGESTION_BATCH_SIZE
+    created = 0
+    while True:
+        events = _pop(batch_size)
+        if not events:
+            return created
+        created += _write(events)
+
+
+def _pop(count):
+    """
+    Take the first `count` events off the queue (atomically, so concurrent consumers get different events)
+    """
+    pipeline = _connection().pipeline(transaction=True)
+    pipeline.lrange(QUEUE_KEY, 0, count - 1)
+    pipeline.ltrim(QUEUE_KEY, count, -1)
+    return [json.loads(event.decode('utf-8')) for event in pipeline.execute()[0]]
+
+
+def _write(events):
+    """
+    Create the View rows of `events` and update the view counts. A user's view that's already in the database (from
+    before the buffering or from after their dedup key expired) is dropped, so are the views of deleted videos/users.
+    """
+    video_ids = set(Video.objects.filter(pk__in={event['video'] for event in events}).values_list('pk', flat=True))
+    user_ids = {event['user'] for event in events if event['user'] is not None}
+    if user_ids:
+        user_ids = set(User.objects.filter(pk__in=user_ids).values_list('pk', flat=True))
+        seen = set(View.objects.filter(video_id__in=video_ids, user_id__in=user_ids).values_list('video_id', 'user_id'))
+    else:
+        seen = set()
+
+    views = []
+    for event in events:
+        video_id, user_id = event['video'], event['user']
+        if video_id not in video_ids or (user_id is not None and (user_id not in user_ids or
+                                                                  (video_id, user_id) in seen)):
+            continue
+        if user_id is not None:
+            seen.add((video_id, user_id))
+        views.append(View(video_id=video_id, user_id=user_id))
+
+    # Videos with the same number of new views are updated together
+    videos_by_increment = defaultdict(list)
+    for video_id, count in Counter(view.video_id for view in views).items():
+        videos_by_increment[count].append(video_id)
+
+    with transaction.atomic():
+        View.objects.bulk_create(views, batch_size=settings.VIEW_INGESTION_BATCH_SIZE)
+        for increment, ids in videos_by_increment.items():
+            Video.objects.filter(pk__in=ids).update(view_count=F('view_count') + increment)
+
+    # bulk_create() doesn't send the post_save signal that adds single views to the seen filters
+    if seen_filter.is_enabled():
+        seen_filter.add_many((view.user_id, view.video_id) for view in views if view.user_id is not None)
+
+    logger.info('Ingested %s views of %s videos (%s events)', len(views), len(video_ids), len(events))
+    return len(views)
@@ -73,20 +73,25 @@ DATABASES = {
 ########## END DATABASE CONFIGURATION
 
 ########## CACHE CONFIGURATION
-# CACHES = {
-#     'default': {
-#         'BACKEND': 'django_redis.cache.RedisCache',
-#         'LOCATION': 'redis://127.0.0.1:6379/1',
-#         'OPTIONS': {
-#             'CLIENT_CLASS': 'django_redis.client.DefaultClient',
-#             'SOCKET_TIMEOUT': 5,  # in seconds
-#             'CONNECTION_POOL_KWARGS': {'max_connections': 100},
-#             # Native parser for added performance (can be included later, maybe for deployment only
-#             # 'PARSER_CLASS': 'redis.connection.HiredisParser',
-#             # 'PASSWORD': 'secretpassword',  # Optional
-#         }
-#     }
-# }
+CACHES = {
+    # Local to each process
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Shared by all the web and celery processes, for what has to be the same (and invalidated) everywhere
+    'shared': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': 'redis://127.0.0.1:6379/1',
+        'OPTIONS': {
+            'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+            'SOCKET_TIMEOUT': 5,  # in seconds
+            'CONNECTION_POOL_KWARGS': {'max_connections': 100},
+            # Native parser for added performance (can be included later, maybe for deployment only
+            # 'PARSER_CLASS': 'redis.connection.HiredisParser',
+            # 'PASSWORD': 'secretpassword',  # Optional
+        }
+    }
+}
 ########## END CACHE CONFIGURATION
 
 
@@ -467,6 +472,11 @@ ONESIGNAL_AUTH_KEY = os.environ.get('ONESIGNAL_AUTH_KEY')
 ONESIGNAL_APP_ID = os.environ.get('ONESIGNAL_APP_ID')
 
 CDN_FTP = 'ftp10.pushrcdn.com'
+# Uploads to the CDN (see heartface.libs.cdn_upload): the max number of them at the same time in a worker (also the max
+#  number of idle connections kept), the block size and the socket timeout (s)
+CDN_FTP_MAX_CONCURRENT_UPLOADS = 4
+CDN_FTP_BLOCK_SIZE = 1024 * 1024
+CDN_FTP_TIMEOUT = 60
 CDN_USERNAME = '206'
 CDN_PASSWORD = 'QRCaHMEH'
 CDN_VIDEO_UPLOAD_PATH = '/media/upload/'
@@ -476,6 +486,22 @@ CDN_COVER_PICTURE_ROOT = '/thumb/'
 # Without the dot
 CDN_COVER_PICTURE_EXTENSION = 'jpg'
 CDN_VIDEO_EXTENSION = 'mp4'
+# Checking published videos on the CDN (see heartface.libs.cdn_availability): the max number of videos checked per
+#  sweep, the number of HEAD requests at the same time, their timeout (s), how long to keep checking a video and how
+#  long before it's checked again (longer than a sweep takes, so overlapping sweeps don't check the same videos)
+CDN_CHECK_BATCH_SIZE = 500
+CDN_CHECK_CONCURRENCY = 16
+CDN_CHECK_TIMEOUT = 10
+CDN_CHECK_MAX_AGE = timedelta(days=1)
+CDN_CHECK_INTERVAL = timedelta(minutes=2)
+
+# Archiving videos to Glacier (see heartface.libs.glacier): the size of the parts of the multipart uploads (1 MB times
+#  a power of two) and the max number of them uploaded at the same time. Videos smaller than AWS_GLACIER_BUNDLE_VIDEO_SIZE
+#  are archived together, in archives of up to AWS_GLACIER_BUNDLE_MAX_SIZE (None doesn't bundle).
+AWS_GLACIER_PART_SIZE = 8 * 1024 * 1024
+AWS_GLACIER_MAX_CONCURRENT_PARTS = 4
+AWS_GLACIER_BUNDLE_VIDEO_SIZE = None
+AWS_GLACIER_BUNDLE_MAX_SIZE = 256 * 1024 * 1024
 
 CELERY_BROKER_URL = BROKER_URL = 'redis://localhost:6379/0'
 CELERY_RESULT_BACKEND = 'redis://localhost:6379/0'
@@ -484,6 +510,14 @@ CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TASK_SERIALIZER = 'json'
 
 DATA_UPLOAD_MAX_MEMORY_SIZE = 100 * 1024 * 1024
+# Resumable uploads (see heartface.apps.core.api.views.uploads): the largest file accepted and the size of the blocks
+#  the request body is copied to the file in
+VIDEO_UPLOAD_MAX_LENGTH = 2 * 1024 * 1024 * 1024
+VIDEO_UPLOAD_BLOCK_SIZE = 64 * 1024
+# How long a request may take to write a chunk before another one can write the upload instead
+VIDEO_UPLOAD_CLAIM_TIMEOUT = timedelta(minutes=30)
+# Uploads not resumed for this long are deleted, with their files, by the hourly cleanup_unpublished_vids task
+VIDEO_UPLOAD_SESSION_EXPIRY = timedelta(hours=24)
 
 ELASTIC_URL = 'http://127.0.0.1:9200/'
 DEFAULT_FROM_EMAIL = 'noreply@heartface.io'
@@ -494,6 +528,59 @@ DEFAULT_ADMIN_EMAIL = 'orders-admin@heartface.io'
 # Whether to use https urls in Elastic serialized models. (We want this by default.)
 ELASTIC_STORE_URLS_AS_HTTPS=True
 
+# How the feed is built. 'pull': computed from the activity of the followed users on every request. 'push': read from
+#  per user timelines that activity is fanned out to when it happens (see heartface.libs.timeline). Run
+#  ./manage backfill_feed_timelines before switching to 'push' as timelines aren't maintained in pull mode.
+FEED_MODE = 'pull'
+# Max number of the most recent items of each type copied into a timeline when (re)building it
+FEED_TIMELINE_BACKFILL_LIMIT = 200
+FEED_TIMELINE_BATCH_SIZE = 1000
+# The most new items counted by the feed/since endpoint
+FEED_SINCE_MAX_COUNT = 100
+# Likes and follows of a user are grouped into one feed item if there are at least FEED_GROUP_MIN_SIZE of them in the
+#  same FEED_GROUP_PERIOD ('minute', 'hour' or 'day', see heartface.apps.core.api.feed_groups)
+FEED_GROUP_PERIOD = 'hour'
+FEED_GROUP_MIN_SIZE = 3
+
+# The cache holding the ids of the users each user follows (see heartface.libs.follow_graph) and how long they're kept.
+#  It has to be shared by all the processes, a follow only invalidates it once.
+FOLLOW_GRAPH_CACHE = 'shared'
+FOLLOW_GRAPH_CACHE_TIMEOUT = 24 * 60 * 60
+
+# The cache holding the candidate pools of the recommended videos (see heartface.libs.recommendations), refreshed every
+#  10 minutes, and how long they're kept. The pools after the admin recommended videos are the most viewed videos up to
+#  these percentiles.
+RECOMMENDATION_POOLS_CACHE = 'shared'
+RECOMMENDATION_POOLS_TIMEOUT = 60 * 60
+RECOMMENDATION_PERCENTILES = (0.1, 0.2, 0.3)
+
+# Keeping the videos each user has seen in a Bloom filter in Redis for the recommendations (see
+#  heartface.libs.seen_filter), instead of reading their views each time. Run rebuild_seen_filters when enabling it (and
+#  after changing the capacity or error rate, which start new filters). The filters are sized for SEEN_FILTER_CAPACITY
+#  views at a false positive rate of SEEN_FILTER_ERROR_RATE.
+SEEN_FILTER_ENABLED = False
+SEEN_FILTER_REDIS_URL = 'redis://localhost:6379/2'
+SEEN_FILTER_CAPACITY = 10000
+SEEN_FILTER_ERROR_RATE = 0.01
+
+# The ffprobe executable used for reading the duration, resolution etc. of uploaded videos and its time limit (s)
+FFPROBE_BINARY = 'ffprobe'
+FFPROBE_TIMEOUT = 60
+
+# How video views are counted. 'sync': a View row and a view_count update on every request. 'buffered': views are
+#  queued in Redis and written in bulk by the ingest_views task (see heartface.libs.view_ingestion).
+VIEW_INGESTION_MODE = 'sync'
+VIEW_INGESTION_REDIS_URL = 'redis://localhost:6379/2'
+# How long the views of a video are remembered for deduplication (in Redis) after its last new view
+VIEW_INGESTION_DEDUP_TIMEOUT = 30 * 24 * 60 * 60
+VIEW_INGESTION_BATCH_SIZE = 5000
+
+# Trending compares the activity of the last TRENDING_WINDOW_SIZE (a whole number of hours) with the window before.
+#  The activity is counted in hourly counters by update_trending_counters (see heartface.libs.trending),
+#  TRENDING_COUNTER_LAG after it happens so rows being written aren't missed.
+TRENDING_WINDOW_SIZE = timedelta(days=1)
+TRENDING_COUNTER_LAG = timedelta(minutes=1)
+TRENDING_COUNTER_BATCH_SIZE = 1000
 # The sensitivity for trending items to avoid false positives for unpopular
 TRENDING_THRESHOLD = 10
 #  How many top trending items to allow
@@ -518,6 +605,11 @@ MARKETPLACES = [{'name': 'eBay',
                 ]
 
 UNPUBLISHED_VIDEO_RETAIN_WINDOW = timedelta(hours=24)  # Keep unpublished vids for...
+# Deleting them (see heartface.libs.video_cleanup): the number of videos deleted at once, the number of threads deleting
+#  their files and how long the hourly task may run (s)
+UNPUBLISHED_VIDEO_CLEANUP_CHUNK_SIZE = 500
+UNPUBLISHED_VIDEO_CLEANUP_FILE_WORKERS = 8
+UNPUBLISHED_VIDEO_CLEANUP_TIME_BUDGET = 15 * 60
 
 
 SUPPLIERS = ['Offspring', 'Schuh', 'Footasylum', 'Sports Direct', 'Vans',
@@ -7,3 +7,10 @@ SOUTH_TESTS_MIGRATE = False
 # Skip South's own tests. The documentation suggests that these are fragile caused by
 #  some mocking with INSTALLED_APPS, and we don't want to run South tests anyway.
 SKIP_SOUTH_TESTS = True
+
+# The follow graph and the recommendation pools, local to the test process (and empty when it starts), see
+#  tests.utils.SharedCacheMixin
+CACHES = dict(CACHES, shared={
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    'LOCATION': 'shared',
+})
@@ -9,11 +9,13 @@ from rest_framework.test import APITestCase
 import sure
 
 from heartface.apps.core.models import Follow
+from heartface.libs import recommendations
 from tests.factories import UserFactory, VideoFactory, CommentFactory, FollowFactory, LikeFactory
+from tests.utils import SharedCacheMixin
 from allauth.account.models import EmailAddress
 
 
-class DisabledUserTestCase(APITestCase):
+class DisabledUserTestCase(SharedCacheMixin, APITestCase):
     """
     Test if disabled user can re-enable account, can't do
     various things, videos from this user are hidden, likes/comments
@@ -80,6 +82,8 @@ class DisabledUserTestCase(APITestCase):
 
         self.client.force_login(request_user)
 
+        # What the refresh_recommendation_pools task does
+        recommendations.refresh()
         response = self.client.get('/api/v1/recommended/')
         response.status_code.should.equal(status.HTTP_200_OK)
 
@@ -171,7 +175,7 @@ class DisabledUserTestCase(APITestCase):
         c_res['author']['age'].should.equal(None)
 
 
-class UsersMeTestCase(APITestCase):
+class UsersMeTestCase(SharedCacheMixin, APITestCase):
     """
     Test if the /users/me/ shorthand works
     """
@@ -199,7 +203,7 @@ class UsersMeTestCase(APITestCase):
         response.status_code.should.equal(status.HTTP_403_FORBIDDEN)
 
 
-class UsernameAvailableTestCase(APITestCase):
+class UsernameAvailableTestCase(SharedCacheMixin, APITestCase):
     def test_username_available(self):
         UserFactory(username='abcdefg')
         request_user = UserFactory(username='zyxwvu')
@@ -214,7 +218,7 @@ class UsernameAvailableTestCase(APITestCase):
         response.status_code.should.equal(status.HTTP_404_NOT_FOUND)
 
 
-class ResendEmailTestCase(APITestCase):
+class ResendEmailTestCase(SharedCacheMixin, APITestCase):
     def test_resend_email(self):
         request_user = UserFactory()
         self.client.force_login(request_user)
@@ -240,7 +244,7 @@ class ResendEmailTestCase(APITestCase):
         mail.outbox.should.have.length_of(1)
 
 
-class FollowingLikeIDTestCase(APITestCase):
+class FollowingLikeIDTestCase(SharedCacheMixin, APITestCase):
     def test_get_own_following_ids(self):
         user = UserFactory()
 
@@ -278,7 +282,7 @@ class FollowingLikeIDTestCase(APITestCase):
         response_ids = set(d['id'] for d in data['results'])
         response_ids.should.equal(set(v.pk for v in liked_videos))
 
-class UserGuestTestCase(APITestCase):
+class UserGuestTestCase(SharedCacheMixin, APITestCase):
     def test_guest_can_retrive_user(self):
         u = UserFactory(username='abcdefg')
 
@@ -310,7 +314,7 @@ class UserGuestTestCase(APITestCase):
         response.status_code.should.equal(status.HTTP_401_UNAUTHORIZED)
 
 
-class UserSerializationTestCase(APITestCase):
+class UserSerializationTestCase(SharedCacheMixin, APITestCase):
     SENSITIVE_FIELDS = ['email', 'age', 'gender', 'email_verified', 'can_charge', 'disabled']
 
     def test_self_sees_all_fields(self):
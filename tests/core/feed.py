@@ -1,28 +1,46 @@
 #!/usr/bin/env python
 # coding=utf-8
 import json
+import logging
+import math
+import operator
 import os
+import random
+import time
+from array import array
 from collections import namedtuple
 from itertools import product
-from urllib.parse import urljoin
+from unittest.mock import patch
+from urllib.parse import urljoin, urlparse, parse_qs
 
 import datetime
+import redis
 from django.utils import timezone
-from django.db import transaction
+from django.db import connection, transaction
+from django.db.models import Q
 from django.conf import settings
+from django.test import override_settings, SimpleTestCase
+from django.test.utils import CaptureQueriesContext
+from nose.plugins.attrib import attr
 from rest_framework import status
 from rest_framework.reverse import reverse
 from rest_framework.test import APITestCase
 
 import sure
 
-from heartface.apps.core.models import User, ReportedVideo
+from heartface.apps.core.api.flags import VideoFlags
+from heartface.apps.core.api.pagination import FeedPosition
+from heartface.apps.core.api.views.feed import MergingQuerySetAdapter, FeedSource, FEED_TYPES
+from heartface.apps.core.models import User, ReportedVideo, FeedTimelineEntry, Comment, Like, View
+from heartface.libs import follow_graph, recommendations, seen_filter, timeline
 from tests.factories import UserFactory, VideoFactory, ProductFactory, HashtagFactory, CommentFactory, FollowFactory, \
-  LikeFactory, DefaultFollowRecommendationFactory
-from tests.utils import Clock, pp
+  LikeFactory, DefaultFollowRecommendationFactory, SupplierProductFactory, ProductPictureFactory, ViewFactory
+from tests.utils import Clock, SharedCacheMixin, benchmark, pp
 
+logger = logging.getLogger(__name__)
 
-class FeedTestCase(APITestCase):
+
+class FeedTestCase(SharedCacheMixin, APITestCase):
 
     def setUp(self):
         self.clock = Clock(-datetime.timedelta(minutes=10))
@@ -119,8 +137,220 @@ class FeedTestCase(APITestCase):
         self._check_item_ordering(response.data['results'])
         response.data.get('results').should.equal(first_page_data.get('results'))
 
-        # TODO: test for no overlap and no missing items between pages (i.e. test that all data is returned and returned
-        #  only once
+    # The likes would be grouped otherwise
+    @override_settings(FEED_GROUP_MIN_SIZE=100)
+    def test_feed_pagination_with_shared_timestamps(self):
+        consumer = UserFactory()
+        producer = UserFactory()
+        FollowFactory(follower=consumer, followed=producer)
+
+        # Items of different types (and the same type) at the same time shouldn't be lost or repeated between pages
+        timestamp = self.clock.tick()
+        for i in range(8):
+            video = VideoFactory(owner=producer, published=timestamp)
+            CommentFactory(author=producer, video=video)
+            LikeFactory(user=producer, video=video)
+        Comment.objects.update(created=timestamp)
+        Like.objects.update(created=timestamp)
+
+        self.client.force_login(consumer)
+        pages = [self.client.get('/api/v1/feed/').data]
+        while pages[-1]['next']:
+            pages.append(self.client.get(pages[-1]['next']).data)
+
+        items = [(item['type'], item['content']['id']) for page in pages for item in page['results']]
+        items.should.have.length_of(24)
+        set(items).should.have.length_of(24)
+
+        # ...and going backwards gives the same pages
+        response = self.client.get(pages[-1]['previous'])
+        response.data['results'].should.equal(pages[-2]['results'])
+
+    # Grouped items are covered by test_grouped_items
+    @override_settings(FEED_GROUP_MIN_SIZE=100)
+    def test_query_count_doesnt_depend_on_page(self):
+        consumer = UserFactory()
+        producer = UserFactory()
+        FollowFactory(follower=consumer, followed=producer)
+        self.client.force_login(consumer)
+
+        def add_items():
+            video = VideoFactory(owner=producer, published=self.clock.tick())
+            for i in range(2):
+                product = SupplierProductFactory().product
+                ProductPictureFactory(product=product)
+                video.products.add(product)
+                video.hashtags.add(HashtagFactory())
+            CommentFactory(author=producer, video=video, created=self.clock.tick())
+            LikeFactory(user=producer, video=VideoFactory(), created=self.clock.tick())
+            FollowFactory(follower=producer, created=self.clock.tick())
+
+        def count_queries():
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get('/api/v1/feed/')
+            response.status_code.should.equal(status.HTTP_200_OK)
+            set(item['type'] for item in response.data['results']).should.have.length_of(4)
+            return len(queries)
+
+        add_items()
+        # The follow graph gets cached by the first request, make it the same for both
+        follow_graph.following_ids(consumer.pk)
+        small_page_queries = count_queries()
+
+        for i in range(3):
+            add_items()
+        count_queries().should.equal(small_page_queries)
+
+    def test_new_items_since(self):
+        consumer = UserFactory()
+        producer = UserFactory()
+        FollowFactory(follower=consumer, followed=producer)
+        video = VideoFactory(owner=producer, published=self.clock.tick())
+        CommentFactory(author=producer, video=video, created=self.clock.tick())
+
+        self.client.force_login(consumer)
+        since = self.client.get('/api/v1/feed/').data['since']
+        since.should.match('http://testserver/api/v1/feed/since/\?cursor=.*')
+
+        response = self.client.get(since)
+        response.status_code.should.equal(status.HTTP_200_OK)
+        response.data.should.equal({'count': 0, 'timestamp': None})
+
+        LikeFactory(user=producer, video=video, created=self.clock.tick())
+        newest = VideoFactory(owner=producer, published=self.clock.tick())
+        # Not in the feed
+        VideoFactory(published=self.clock.tick())
+
+        response = self.client.get(since)
+        response.data['count'].should.equal(2)
+        response.data['timestamp'].should.equal(newest.published)
+
+        # Only the first page has it
+        response = self.client.get('/api/v1/feed/', {'cursor': parse_qs(urlparse(since).query)['cursor'][0]})
+        response.status_code.should.equal(status.HTTP_200_OK)
+        response.data.should_not.have.key('since')
+
+    @override_settings(FEED_GROUP_PERIOD='hour', FEED_GROUP_MIN_SIZE=3)
+    def test_grouped_items(self):
+        consumer = UserFactory()
+        producer = UserFactory()
+        FollowFactory(follower=consumer, followed=producer)
+
+        # A burst of likes within an hour and a couple of single ones in the next hour
+        hour = timezone.now().replace(minute=0, second=0, microsecond=0) - datetime.timedelta(hours=2)
+        liked_videos = [VideoFactory() for i in range(5)]
+        for i, video in enumerate(liked_videos):
+            LikeFactory(user=producer, video=video, created=hour + datetime.timedelta(minutes=i))
+        for i in range(2):
+            LikeFactory(user=producer, video=VideoFactory(), created=hour + datetime.timedelta(minutes=60 + i))
+        for i in range(3):
+            FollowFactory(follower=producer, created=hour + datetime.timedelta(minutes=10 + i))
+
+        self.client.force_login(consumer)
+        response = self.client.get('/api/v1/feed/')
+        response.status_code.should.equal(status.HTTP_200_OK)
+        self._check_item_ordering(response.data['results'])
+        [item['type'] for item in response.data['results']].should.equal(['like', 'like', 'follow_group', 'like_group'])
+
+        like_group = response.data['results'][3]['content']
+        like_group['actor']['id'].should.equal(producer.pk)
+        like_group['count'].should.equal(5)
+        sorted(like_group['objects']).should.equal(sorted(video.pk for video in liked_videos))
+        response.data['results'][2]['content']['count'].should.equal(3)
+
+        # Expanded
+        response = self.client.get('/api/v1/feed/', {'expand': 'groups'})
+        videos = response.data['results'][3]['content']['objects']
+        sorted(video['id'] for video in videos).should.equal(sorted(video.pk for video in liked_videos))
+        response.data['results'][2]['content']['objects'][0].should.have.key('username')
+
+    @override_settings(FEED_GROUP_PERIOD='hour', FEED_GROUP_MIN_SIZE=3)
+    def test_query_count_doesnt_depend_on_bursts(self):
+        consumer = UserFactory()
+        producer = UserFactory()
+        FollowFactory(follower=consumer, followed=producer)
+        self.client.force_login(consumer)
+        hour = timezone.now().replace(minute=0, second=0, microsecond=0) - datetime.timedelta(hours=3)
+        for i in range(2):
+            LikeFactory(user=producer, created=hour + datetime.timedelta(hours=2, minutes=i))
+        # A burst just big enough for a group
+        for i in range(3):
+            LikeFactory(user=producer, created=hour + datetime.timedelta(minutes=i))
+        follow_graph.following_ids(consumer.pk)
+
+        def count_queries():
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get('/api/v1/feed/')
+            response.status_code.should.equal(status.HTTP_200_OK)
+            return len(queries)
+
+        small_burst_queries = count_queries()
+
+        # The likes of a burst are left out of the single ones by the database, not by reading them
+        for i in range(40):
+            LikeFactory(user=producer, created=hour + datetime.timedelta(minutes=10, seconds=i))
+        count_queries().should.equal(small_burst_queries)
+
+    @override_settings(FEED_GROUP_PERIOD='hour', FEED_GROUP_MIN_SIZE=3)
+    def test_grouped_items_are_bounded_by_cursor(self):
+        consumer = UserFactory()
+        producer = UserFactory()
+        FollowFactory(follower=consumer, followed=producer)
+
+        # More bursts of likes than fit in a page
+        hour = timezone.now().replace(minute=0, second=0, microsecond=0) - datetime.timedelta(hours=20)
+        for i in range(12):
+            for j in range(3):
+                LikeFactory(user=producer, created=hour + datetime.timedelta(hours=i, minutes=j))
+
+        self.client.force_login(consumer)
+        first_page = self.client.get('/api/v1/feed/').data
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(first_page['next'])
+        response.status_code.should.equal(status.HTTP_200_OK)
+        [item['type'] for item in response.data['results']].should.equal(['like_group'] * 2)
+        response.data['results'][-1]['content']['count'].should.equal(3)
+
+        # The rows grouped are limited by the cursor, not just the groups (a HAVING clause)
+        created = '"%s"."created" <' % Like._meta.db_table
+        grouping = [query['sql'] for query in queries.captured_queries
+                    if 'GROUP BY' in query['sql'] and 'ARRAY_AGG' in query['sql'] and Like._meta.db_table in query['sql']]
+        grouping.should_not.be.empty
+        for sql in grouping:
+            sql.split('GROUP BY')[0].should.contain(created)
+
+    def test_type_filter(self):
+        consumer = UserFactory()
+        producer = UserFactory()
+        FollowFactory(follower=consumer, followed=producer)
+        video = VideoFactory(owner=producer, published=self.clock.tick())
+        CommentFactory(author=producer, video=video, created=self.clock.tick())
+        LikeFactory(user=producer, video=video, created=self.clock.tick())
+        FollowFactory(follower=producer, created=self.clock.tick())
+
+        self.client.force_login(consumer)
+        follow_graph.following_ids(consumer.pk)
+        with CaptureQueriesContext(connection) as all_queries:
+            self.client.get('/api/v1/feed/')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/v1/feed/', {'types': 'video,comment'})
+        response.status_code.should.equal(status.HTTP_200_OK)
+        [item['type'] for item in response.data['results']].should.equal(['comment', 'video'])
+        # The likes and follows (single and grouped) aren't even looked at: 4 sources less to read
+        (len(all_queries) - len(queries)).should.be.greater_than_or_equal_to(4)
+
+        since = response.data['since']
+        parse_qs(urlparse(since).query)['types'].should.equal(['video,comment'])
+        LikeFactory(user=producer, created=self.clock.tick())
+        self.client.get(since).data['count'].should.equal(0)
+
+        response = self.client.get('/api/v1/feed/', {'types': 'video,bogus'})
+        response.status_code.should.equal(status.HTTP_400_BAD_REQUEST)
+
+    def test_invalid_cursor(self):
+        self.client.force_login(UserFactory())
+        response = self.client.get('/api/v1/feed/', {'cursor': 'bogus'})
+        response.status_code.should.equal(status.HTTP_404_NOT_FOUND)
 
     def test_feed_ordering_mixed_events(self):
         consumer = UserFactory()
@@ -166,7 +396,176 @@ class FeedTestCase(APITestCase):
         return instance
 
 
-class CommentTestCase(APITestCase):
+class FeedTimelineTestCase(SharedCacheMixin, APITestCase):
+    def setUp(self):
+        self.consumer = UserFactory()
+        self.producer = UserFactory()
+        FollowFactory(follower=self.consumer, followed=self.producer)
+
+    def _feed_items(self):
+        self.client.force_login(self.consumer)
+        response = self.client.get('/api/v1/feed/')
+        response.status_code.should.equal(status.HTTP_200_OK)
+        return set((item['type'], item['content'].get('id')) for item in response.data['results'])
+
+    def test_push_mode_matches_pull_mode(self):
+        video = VideoFactory(owner=self.producer)
+        CommentFactory(author=self.producer, video=video)
+        LikeFactory(user=self.producer, video=VideoFactory())
+        # Not visible yet, in neither of the modes
+        VideoFactory(owner=self.producer, cdn_available=None)
+
+        pull_items = self._feed_items()
+
+        timeline.backfill(self.consumer.pk)
+        with override_settings(FEED_MODE='push'):
+            push_items = self._feed_items()
+
+        push_items.should.equal(pull_items)
+        push_items.should.have.length_of(3)
+
+    def test_fan_out_is_idempotent(self):
+        video = VideoFactory(owner=self.producer)
+
+        timeline.fan_out(FeedTimelineEntry.TYPES.video, video.pk).should.equal(1)
+        timeline.fan_out(FeedTimelineEntry.TYPES.video, video.pk).should.equal(0)
+
+        entry = FeedTimelineEntry.objects.get(owner=self.consumer)
+        entry.object_id.should.equal(video.pk)
+        entry.feed_order.should.equal(video.published)
+
+    def test_unfollow_retracts_entries(self):
+        other_producer = UserFactory()
+        FollowFactory(follower=self.consumer, followed=other_producer)
+        VideoFactory(owner=self.producer)
+        other_video = VideoFactory(owner=other_producer)
+
+        timeline.backfill(self.consumer.pk)
+        FeedTimelineEntry.objects.filter(owner=self.consumer).count().should.equal(2)
+
+        timeline.retract_actor(self.consumer.pk, self.producer.pk)
+        list(FeedTimelineEntry.objects.filter(owner=self.consumer).values_list('object_id', flat=True)) \
+            .should.equal([other_video.pk])
+
+
+# Stand-ins for the models of the feed items
+FAKE_FEED_MODELS = {type_name: namedtuple('Fake%s' % type_name.title(), ['created', 'pk']) for type_name in FEED_TYPES}
+
+LOOKUPS = {'': operator.eq, 'lt': operator.lt, 'lte': operator.le, 'gt': operator.gt, 'gte': operator.ge}
+
+
+class RowCountingQuerySet(object):
+    """
+    Just enough of the QuerySet interface for MergingQuerySetAdapter over a list of items of one of the
+    FAKE_FEED_MODELS. Counts the rows fetched.
+    """
+    def __init__(self, model, items, stats):
+        self.model = model
+        self.items = items
+        self.stats = stats
+
+    def filter(self, q):
+        return RowCountingQuerySet(self.model, [i for i in self.items if self._matches(i, q)], self.stats)
+
+    def order_by(self, *fields):
+        return RowCountingQuerySet(self.model, sorted(self.items, key=lambda i: (i.created, i.pk),
+                                                      reverse=fields[0].startswith('-')), self.stats)
+
+    def values_list(self, *fields):
+        return RowCountingQuerySet(self.model, [tuple(getattr(i, field) for field in fields) for i in self.items],
+                                   self.stats)
+
+    def in_bulk(self, id_list):
+        return {i.pk: i for i in self.items if i.pk in id_list}
+
+    def __getitem__(self, key):
+        rows = self.items[key]
+        self.stats['rows'] += len(rows)
+        return rows
+
+    def _matches(self, item, q):
+        matches = (self._matches(item, child) if isinstance(child, Q) else self._lookup(item, *child)
+                   for child in q.children)
+        return any(matches) if q.connector == Q.OR else all(matches)
+
+    @staticmethod
+    def _lookup(item, lookup, value):
+        field, _, operation = lookup.partition('__')
+        return LOOKUPS[operation](getattr(item, field), value)
+
+
+class MergingQuerySetAdapterTestCase(SimpleTestCase):
+    PAGE_SIZE = 10
+
+    def _adapter(self, item_count, stats, seed=42):
+        """
+        `item_count` items spread over a source of each type, with lots of timestamps shared between (and within) them
+        """
+        rnd = random.Random(seed)
+        items = [(rnd.choice(FEED_TYPES), rnd.randrange(item_count // 2), pk) for pk in range(item_count)]
+        return MergingQuerySetAdapter([
+            FeedSource(type_name, RowCountingQuerySet(FAKE_FEED_MODELS[type_name], [
+                FAKE_FEED_MODELS[type_name](created, pk) for item_type, created, pk in items if item_type == type_name
+            ], stats), 'created', 'pk')
+            for type_name in FEED_TYPES
+        ])
+
+    def _pages(self, adapter, backwards=False):
+        """
+        Page through the whole feed the way FeedCursorPagination does
+        """
+        query_set = adapter.seek(FeedPosition(-1, 'video', -1), reverse=True) if backwards else adapter
+        while True:
+            page = query_set[0:self.PAGE_SIZE + 1][:self.PAGE_SIZE]
+            if not page:
+                return
+            yield page
+            query_set = adapter.seek(adapter.position(page[-1]), backwards)
+
+    def test_paging_has_no_gaps_or_duplicates(self):
+        stats = {'rows': 0}
+        adapter = self._adapter(500, stats)
+        all_items = sorted(((i, source.type_name) for source in adapter.sources for i in source.query_set.items),
+                           key=lambda i: (i[0].created, FEED_TYPES.index(i[1]), i[0].pk), reverse=True)
+        all_items = [item for item, type_name in all_items]
+
+        forward = [item for page in self._pages(adapter) for item in adapter.load(page)]
+        forward.should.equal(all_items)
+
+        backward = [item for page in self._pages(adapter, backwards=True) for item in adapter.load(page)]
+        backward.should.equal(all_items[::-1])
+
+    def test_seek_unknown_type(self):
+        adapter = self._adapter(10, {'rows': 0})
+        adapter.seek.when.called_with(FeedPosition(1, 'bogus', 1)).should.throw(ValueError)
+
+    @attr('slow')
+    def test_rows_fetched_per_page_benchmark(self):
+        """
+        The number of rows fetched for a page doesn't depend on how deep the cursor is, and it's less than a page from
+        each source (which is what sorting the concatenated query sets needed).
+
+        ./manage test --nologcapture tests.core.feed:MergingQuerySetAdapterTestCase.test_rows_fetched_per_page_benchmark
+        """
+        stats = {'rows': 0}
+        adapter = self._adapter(40000, stats)
+
+        rows_per_page = []
+        query_set = adapter
+        for page in range(1000):
+            stats['rows'] = 0
+            results = query_set[0:self.PAGE_SIZE + 1]
+            rows_per_page.append(stats['rows'])
+            query_set = adapter.seek(adapter.position(results[self.PAGE_SIZE - 1]))
+
+        # Bounded by a constant at any depth...
+        max(rows_per_page).should.be.lower_than(len(FEED_TYPES) * (self.PAGE_SIZE + 1))
+        # ...and the same on average for the first and the last pages
+        first_pages, last_pages = rows_per_page[:100], rows_per_page[-100:]
+        (sum(last_pages) / sum(first_pages)).should.be.within(0.8, 1.25)
+
+
+class CommentTestCase(SharedCacheMixin, APITestCase):
     def test_comment_response(self):
         user = UserFactory()
 
@@ -183,7 +582,7 @@ class CommentTestCase(APITestCase):
         comments.get('author').get('id').should.equal(user.id)
 
 
-class ReportVideoTestCase(APITestCase):
+class ReportVideoTestCase(SharedCacheMixin, APITestCase):
     def test_report_video_anonymous(self):
         # init variables
         video = VideoFactory()
@@ -214,7 +613,7 @@ class ReportVideoTestCase(APITestCase):
         ReportedVideo.objects.filter(reporting_user=user, video=video).count().should.be(1)
 
 
-class WithLikesFollowingVideoTestCase(APITestCase):
+class WithLikesFollowingVideoTestCase(SharedCacheMixin, APITestCase):
     def test_recommended_videos(self):
         """
         ./manage test --keepdb --nologcapture tests.core.feed:WithLikesFollowingVideoTestCase.test_recommended_videos
@@ -237,6 +636,8 @@ class WithLikesFollowingVideoTestCase(APITestCase):
             videos[video.pk] = params
 
         self.client.force_login(request_user)
+        # What the refresh_recommendation_pools task does
+        recommendations.refresh()
         response = self.client.get('/api/v1/recommended/')
         response.status_code.should.equal(status.HTTP_200_OK)
 
@@ -288,6 +689,51 @@ class WithLikesFollowingVideoTestCase(APITestCase):
         unloved_video_res[0]['owner']['following'].should.be(False)
         unloved_video_res[0]['liked'].should.be(False)
 
+    def test_liked_videos(self):
+        """
+        ./manage test --keepdb --nologcapture tests.core.feed:WithLikesFollowingVideoTestCase.test_liked_videos
+        """
+        followed_user = UserFactory()
+        request_user = UserFactory()
+        FollowFactory(follower=request_user, followed=followed_user)
+        followed_video = VideoFactory(owner=followed_user)
+        other_video = VideoFactory()
+        LikeFactory(video=followed_video, user=request_user)
+        LikeFactory(video=other_video, user=request_user)
+
+        self.client.force_login(request_user)
+        response = self.client.get('/api/v1/users/me/likes/')
+        response.status_code.should.equal(status.HTTP_200_OK)
+
+        videos = dict((v['id'], v) for v in response.data.get('results'))
+        videos.should.have.length_of(2)
+        videos[followed_video.pk]['liked'].should.be(True)
+        videos[followed_video.pk]['owner']['following'].should.be(True)
+        videos[other_video.pk]['liked'].should.be(True)
+        videos[other_video.pk]['owner']['following'].should.be(False)
+
+    def test_flags_query_count(self):
+        """
+        The flags of a page of videos are looked up with a single query, and only once per request
+        """
+        request_user = UserFactory()
+        owner = UserFactory()
+        FollowFactory(follower=request_user, followed=owner)
+        videos = [VideoFactory(owner=owner) for i in range(5)]
+        for video in videos[:2]:
+            LikeFactory(video=video, user=request_user)
+        # Warm up the follow graph cache
+        follow_graph.following_ids(request_user.pk)
+
+        flags = VideoFlags(request_user)
+        with self.assertNumQueries(1):
+            flags.annotate(videos)
+        with self.assertNumQueries(0):
+            flags.annotate(videos[:3])
+
+        [video.liked for video in videos].should.equal([True, True, False, False, False])
+        all(video.following_owner for video in videos).should.be.true
+
     def test_feed(self):
         """
         ./manage test --keepdb --nologcapture tests.core.feed:WithLikesFollowingVideoTestCase.test_feed
@@ -335,7 +781,104 @@ class WithLikesFollowingVideoTestCase(APITestCase):
         # ipdb.set_trace()
 
 
-class UserVideosTestCase(APITestCase):
+class RecommendationPoolsTestCase(SharedCacheMixin, APITestCase):
+    def test_pools(self):
+        recommended = VideoFactory(recommended=True)
+        ranked = [VideoFactory(view_count=view_count) for view_count in range(20, 0, -1)]
+        VideoFactory(recommended=True, cdn_available=None)
+
+        recommendations.refresh()
+        [list(pool) for pool in recommendations.pools()] \
+            .should.equal([[recommended.pk], [v.pk for v in ranked[:2]], [v.pk for v in ranked[2:4]],
+                           [v.pk for v in ranked[4:6]]])
+
+        # The unseen ones first, then the seen recommended video, the rest isn't a candidate
+        user = UserFactory()
+        for video in [recommended, ranked[0], ranked[2]]:
+            ViewFactory(video=video, user=user)
+        self.client.force_login(user)
+        response = self.client.get('/api/v1/recommended/')
+        set(result['id'] for result in response.data['results']) \
+            .should.equal({ranked[1].pk, ranked[3].pk, ranked[4].pk, ranked[5].pk, recommended.pk})
+
+    @override_settings(SEEN_FILTER_ENABLED=True)
+    def test_seen_filter(self):
+        videos = [VideoFactory(view_count=view_count) for view_count in range(20, 0, -1)]
+        user = UserFactory()
+        seen_filter._connection().delete(seen_filter._key(user.pk))
+        self.addCleanup(seen_filter._connection().delete, seen_filter._key(user.pk))
+
+        # Seeded from the existing views, then kept up to date by the signal
+        View.objects.bulk_create([View(video=videos[0], user=user), View(video=videos[2], user=user)])
+        seen_filter.rebuild([user.pk]).should.equal(1)
+        # Once the view is committed, the test transaction never is
+        with patch('django.db.transaction.on_commit', side_effect=lambda func: func()):
+            ViewFactory(video=videos[4], user=user)
+            # A filter that can't be updated doesn't fail the view
+            with patch('heartface.libs.seen_filter.add', side_effect=redis.ConnectionError):
+                ViewFactory(video=videos[0], user=user)
+
+        seen = seen_filter.load(user.pk)
+        for video in [videos[0], videos[2], videos[4]]:
+            (video.pk in seen).should.be.true
+        # No false positives among these few
+        [video.pk for video in videos if video.pk in seen].should.equal([videos[0].pk, videos[2].pk, videos[4].pk])
+
+        recommendations.refresh()
+        self.client.force_login(user)
+        response = self.client.get('/api/v1/recommended/')
+        set(result['id'] for result in response.data['results']) \
+            .should.equal({videos[1].pk, videos[3].pk, videos[5].pk})
+
+        # Without Redis, the views are read instead
+        with patch('heartface.libs.seen_filter.load', side_effect=redis.ConnectionError):
+            response = self.client.get('/api/v1/recommended/')
+        response.status_code.should.equal(status.HTTP_200_OK)
+        set(result['id'] for result in response.data['results']) \
+            .should.equal({videos[1].pk, videos[3].pk, videos[5].pk})
+
+
+class RecommendationSamplingTestCase(SimpleTestCase):
+    @attr('slow')
+    @benchmark
+    def test_sampling_benchmark(self):
+        """
+        Sampling from the precomputed pools vs ranking a synthetic catalog of 1M videos on every request (which is what
+        the view did)
+
+        BENCHMARK=1 ./manage test --nologcapture tests.core.feed:RecommendationSamplingTestCase.test_sampling_benchmark
+        """
+        rnd = random.Random(42)
+        # (id, view count, recommended), with long tailed view counts
+        catalog = [(pk, int(rnd.paretovariate(1.2)), rnd.random() < 0.0001) for pk in range(1, 1000001)]
+        seen = set(rnd.sample(range(1, 1000001), 5000))
+
+        started = time.perf_counter()
+        unseen_recommended = [pk for pk, _, is_recommended in catalog if is_recommended and pk not in seen]
+        unseen = sorted((video for video in catalog if not video[2] and video[0] not in seen), key=lambda v: -v[1])
+        cutoff = math.ceil(0.1 * len(unseen))
+        random.sample(unseen_recommended, min(5, len(unseen_recommended)))
+        random.sample(unseen[:cutoff], 5)
+        per_request_ranking = time.perf_counter() - started
+
+        ranked = [pk for pk, _, is_recommended in sorted(catalog, key=lambda v: (-v[1], v[0])) if not is_recommended]
+        cutoffs = [math.ceil(percentile * len(ranked)) for percentile in (0.1, 0.2, 0.3)]
+        pools = [array('I', [pk for pk, _, is_recommended in catalog if is_recommended])] + \
+            [array('I', ranked[start:end]) for start, end in zip([0] + cutoffs, cutoffs)]
+
+        with patch('heartface.libs.recommendations.pools', return_value=pools):
+            started = time.perf_counter()
+            for _ in range(1000):
+                video_ids = recommendations.recommend(5, seen)
+            sampling = (time.perf_counter() - started) / 1000
+
+        video_ids.should.have.length_of(5)
+        set(video_ids).isdisjoint(seen).should.be.true
+        logger.debug('Per request: ranking %.3fs, sampling from the pools %.6fs', per_request_ranking, sampling)
+        (per_request_ranking / sampling).should.be.greater_than(100)
+
+
+class UserVideosTestCase(SharedCacheMixin, APITestCase):
     def test_get_user_videos(self):
         user = UserFactory()
         other_owner = UserFactory()
@@ -377,7 +920,7 @@ class UserVideosTestCase(APITestCase):
         response.status_code.should.equal(status.HTTP_404_NOT_FOUND)
 
 
-class RecommendedFollowTestCase(APITestCase):
+class RecommendedFollowTestCase(SharedCacheMixin, APITestCase):
     def test_recommended_follow(self):
         dfr = DefaultFollowRecommendationFactory()
         request_user = UserFactory()
@@ -4,10 +4,12 @@ from rest_framework import status
 from rest_framework.test import APITestCase
 import sure
 
+from heartface.libs import follow_graph
 from tests.factories import UserFactory
+from tests.utils import SharedCacheMixin
 
 
-class FollowersAPITestCase(APITestCase):
+class FollowersAPITestCase(SharedCacheMixin, APITestCase):
     def test_followers_returned_correctly(self):
         u1 = UserFactory()
         u2 = UserFactory()
@@ -72,3 +74,37 @@ class FollowersAPITestCase(APITestCase):
 
         followed.followers.count().should.equal(1)
         followed.followers.filter(pk=follower.pk).exists().should.be(False)
+
+
+class FollowGraphTestCase(SharedCacheMixin, APITestCase):
+    def test_following_ids_follow_the_changes(self):
+        follower = UserFactory()
+        u1 = UserFactory()
+        u2 = UserFactory()
+
+        follow_graph.following_ids(follower.pk).should.equal(frozenset())
+
+        follower.follow(u1)
+        follower.follow(u2)
+        follow_graph.following_ids(follower.pk).should.equal(frozenset([u1.pk, u2.pk]))
+        # Cached now
+        with self.assertNumQueries(0):
+            follow_graph.following_ids(follower.pk).should.equal(frozenset([u1.pk, u2.pk]))
+
+        follower.unfollow(u1)
+        follow_graph.following_ids(follower.pk).should.equal(frozenset([u2.pk]))
+
+    def test_following_flags(self):
+        user = UserFactory()
+        followed = UserFactory()
+        other = UserFactory()
+        request_user = UserFactory()
+        user.follow(followed)
+        user.follow(other)
+        request_user.follow(followed)
+
+        self.client.force_login(request_user)
+        response = self.client.get('/api/v1/users/%s/following/' % user.pk)
+        response.status_code.should.equal(status.HTTP_200_OK)
+
+        dict((u['id'], u['following']) for u in response.data).should.equal({followed.pk: True, other.pk: False})
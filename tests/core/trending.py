@@ -1,19 +1,32 @@
 #!/usr/bin/env python
 # coding=utf-8
+import logging
 import random
+import time
+from collections import defaultdict
+from operator import itemgetter
 
 from django.utils import timezone
 from django.conf import settings
+from django.db import connection
+from django.db.models import Count
+from django.test import override_settings, SimpleTestCase
+from django.test.utils import CaptureQueriesContext
 from nose.plugins.attrib import attr
 from rest_framework.test import APITestCase
 from datetime import timedelta
 
 from tests.factories import UserFactory, CommentFactory, LikeFactory, FollowFactory, ViewFactory, VideoFactory, HashtagFactory
-from heartface.apps.core.tasks import popularity_score, hashtag_popularity_score, check_trending
-from heartface.apps.core.models import Trending, TrendingProfile, TrendingHashtag
+from heartface.apps.core.tasks import check_trending
+from heartface.apps.core.models import Trending, TrendingProfile, TrendingHashtag, TrendingWatermark, User, Comment, \
+    Like, View
+from heartface.libs import trending
 from nose_parameterized import parameterized
+from tests.utils import benchmark
 import sure
 
+logger = logging.getLogger(__name__)
+
 
 def insert_tag(ctext, tag):
     """
@@ -25,6 +38,31 @@ def insert_tag(ctext, tag):
     return ' '.join(words[:insert_point] + [tag, ] + words[insert_point:])
 
 
+def orm_popularity_score(t):
+    """
+    The popularity scores of the users in the window before `t` as they were computed with the ORM, one query per
+    source (counting the likes it filters on, not the likers of the videos)
+    """
+    ps_dict = defaultdict(int)
+    t1 = t - settings.TRENDING_WINDOW_SIZE
+    querysets = [
+        (User.objects.filter(videos__comments__in=Comment.objects.filter(created__lt=t, created__gte=t1))
+         .annotate(cnt=Count('videos__comments')), trending.weight.comments),
+        (User.objects.filter(videos__like__in=Like.objects.filter(created__lt=t, created__gte=t1))
+         .annotate(cnt=Count('videos__like')), trending.weight.likes),
+        (User.objects.filter(videos__view__in=View.objects.filter(created__lt=t, created__gte=t1))
+         .annotate(cnt=Count('videos__view')), trending.weight.views),
+        (User.objects.filter(followed__created__lt=t, followed__created__gte=t1)
+         .annotate(cnt=Count('followed')), trending.weight.followers),
+        (User.objects.filter(videos__published__lt=t, videos__published__gte=t1)
+         .annotate(cnt=Count('videos')), trending.weight.uploads),
+    ]
+    for qs, weight in querysets:
+        for item in qs.values('id', 'cnt'):
+            ps_dict[item['id']] += weight * item['cnt']
+    return ps_dict
+
+
 @attr('slow')
 class TrendingTestCase(APITestCase):
 
@@ -91,18 +129,78 @@ class TrendingTestCase(APITestCase):
         t1 = now - timedelta(days=1) - timedelta(hours=12)
         exp_scores2 = self._create_profile_fixtures(users, t1, count_params)
 
-        # Now run popularity_score and ensure the `exp_score` for each of
-        # our Users matches the `computed_score`
+        # Now compute the popularity scores and ensure the `exp_score` for
+        # each of our Users matches the `computed_score`
         now = now + timedelta(seconds=100)
-        ps_dict = popularity_score(now)
+        ps_dict, ps_dict2 = trending.popularity_scores(now)
         for user_id in exp_scores:
             ps_dict[user_id].should.equal(exp_scores[user_id])
 
         # Yesterday's
-        ps_dict2 = popularity_score(now - timedelta(days=1))
         for user_id in exp_scores2:
             ps_dict2[user_id].should.equal(exp_scores2[user_id])
 
+    def test_popularity_scores_single_query(self):
+        """
+        Usage:
+        ./manage test tests.core.trending:TrendingTestCase.test_popularity_scores_single_query
+        """
+        now = timezone.now()
+        users = UserFactory.create_batch(30)
+        # comments, likes, followers, uploads, views, exp_score
+        exp_scores = self._create_profile_fixtures(users, now, [(4, 6, 3, 2, 5, 41), (2, 3, 5, 3, 4, 34)])
+        exp_scores2 = self._create_profile_fixtures(users, now - timedelta(days=1), [(6, 1, 0, 1, 2, 26)])
+
+        t = now + timedelta(seconds=100)
+        with CaptureQueriesContext(connection) as queries:
+            current, previous = trending.popularity_scores(t)
+        len(queries).should.equal(1)
+
+        dict(current).should.equal(exp_scores)
+        dict(previous).should.equal(exp_scores2)
+        dict(current).should.equal(dict(orm_popularity_score(t)))
+        dict(previous).should.equal(dict(orm_popularity_score(t - settings.TRENDING_WINDOW_SIZE)))
+
+    @override_settings(TRENDING_COUNTER_LAG=timedelta(0))
+    def test_drift(self):
+        """
+        Usage:
+        ./manage test tests.core.trending:TrendingTestCase.test_drift
+        """
+        users = UserFactory.create_batch(30)
+        # comments, likes, followers, uploads, views, exp_score
+        self._create_profile_fixtures(users, timezone.now() - timedelta(hours=2), [(4, 6, 3, 2, 5, 41)])
+        trending.update()
+        trending.drift().should.equal([])
+
+        # Still counted
+        Like.objects.filter(video__owner=users[0]).first().delete()
+        trending.drift().should.equal([(users[0].id, 41, 41 - trending.weight.likes)])
+
+    @override_settings(TRENDING_COUNTER_LAG=timedelta(0))
+    def test_incremental_counters(self):
+        """
+        Usage:
+        ./manage test tests.core.trending:TrendingTestCase.test_incremental_counters
+        """
+        t = timezone.now()
+        users = UserFactory.create_batch(30)
+        # comments, likes, followers, uploads, views, exp_score
+        count_params = [(3, 4, 2, 2, 5, 34), (1, 2, 3, 1, 2, 18)]
+        self._create_profile_fixtures(users, t - timedelta(days=1), count_params)
+        self._create_profile_fixtures(users, t, count_params[:1])
+        trending.update()
+        counted_until = TrendingWatermark.objects.get().counted_until
+
+        # The next update only counts what's new (the second user's activity, by the first user this time)
+        self._create_profile_fixtures(users, timezone.now(), count_params[1:])
+        trending.update()
+        TrendingWatermark.objects.get().counted_until.should.be.greater_than(counted_until)
+
+        ids, current, previous = trending.window_scores(trending.USER_SOURCES)
+        dict(zip(ids.tolist(), zip(current.tolist(), previous.tolist()))) \
+            .should.equal({users[0].id: (34 + 18, 34), users[1].id: (0, 18)})
+
     @staticmethod
     def _create_hashtag_fixtures(users, hashtags, t, count_params):
         exp_scores = {}
@@ -155,6 +253,7 @@ class TrendingTestCase(APITestCase):
           (34, 6, 40)],
          )
     ])
+    @override_settings(TRENDING_COUNTER_LAG=timedelta(0))
     def test_hashtag_popularity_score(self, _, count_params):
         """
         Usage:
@@ -168,17 +267,22 @@ class TrendingTestCase(APITestCase):
         t1 = now - timedelta(days=1) - timedelta(hours=12)
         exp_scores2 = self._create_hashtag_fixtures(users, hashtags, t1, count_params)
 
-        # Now run hashtag_popularity_score and ensure the `exp_score` for each of
-        # our Hashtags matches the `computed_score`
-        now = now + timedelta(seconds=100)
-        ps_dict = hashtag_popularity_score(now)
+        # Now count the activity and ensure the `exp_score` for each of
+        # our Hashtags matches the `computed_score`, today's and yesterday's
+        trending.update()
+        ps_dict, ps_dict2 = self._hashtag_scores()
         for hashtag_id in exp_scores:
             ps_dict[hashtag_id].should.equal(exp_scores[hashtag_id])
 
-        ps_dict2 = hashtag_popularity_score(now - timedelta(days=1))
         for hashtag_id in exp_scores2:
             ps_dict2[hashtag_id].should.equal(exp_scores2[hashtag_id])
 
+    @staticmethod
+    def _hashtag_scores():
+        # The popularity scores of the hashtags in the current and the previous window, from the counters
+        ids, current, previous = trending.window_scores(trending.HASHTAG_SOURCES)
+        return dict(zip(ids.tolist(), map(int, current))), dict(zip(ids.tolist(), map(int, previous)))
+
     @parameterized.expand([
         ("hashtag_batch1",
          # videos with tag, comments with tag, expected score
@@ -217,6 +321,7 @@ class TrendingTestCase(APITestCase):
           -0.9661016949152542]
          )
     ])
+    @override_settings(TRENDING_COUNTER_LAG=timedelta(0))
     def test_check_trending_tags(self, _, today_count_params, yest_count_params, exp_trending_scores):
         """
         Usage:
@@ -235,12 +340,12 @@ class TrendingTestCase(APITestCase):
         len(exp_scores_t1).should.equal(len(yest_count_params))
 
         # Pop score tests
-        ps_dict = hashtag_popularity_score(t + timedelta(seconds=100))
+        trending.update()
+        ps_dict, ps_dict1 = self._hashtag_scores()
         for hashtag_id in exp_scores_t:
             ps_dict[hashtag_id].should.equal(exp_scores_t[hashtag_id])
-        ps_dict = hashtag_popularity_score(t1 + timedelta(seconds=100))
         for hashtag_id in exp_scores_t1:
-            ps_dict[hashtag_id].should.equal(exp_scores_t1[hashtag_id])
+            ps_dict1[hashtag_id].should.equal(exp_scores_t1[hashtag_id])
 
         # Check trending tests
         check_trending()
@@ -297,6 +402,7 @@ class TrendingTestCase(APITestCase):
           0.11507936507936507],
          )
     ])
+    @override_settings(TRENDING_COUNTER_LAG=timedelta(0))
     def test_check_trending_profs(self, _, today_count_params, yest_count_params, exp_trending_scores):
         """
         Usage:
@@ -314,12 +420,11 @@ class TrendingTestCase(APITestCase):
         len(exp_scores_t1).should.equal(len(yest_count_params))
 
         # Pop score tests
-        ps_dict = popularity_score(t + timedelta(seconds=100))
+        ps_dict, ps_dict1 = trending.popularity_scores(t + timedelta(seconds=100))
         for user_id in exp_scores_t:
             ps_dict[user_id].should.equal(exp_scores_t[user_id])
-        ps_dict = popularity_score(t1 + timedelta(seconds=100))
         for user_id in exp_scores_t1:
-            ps_dict[user_id].should.equal(exp_scores_t1[user_id])
+            ps_dict1[user_id].should.equal(exp_scores_t1[user_id])
 
         # Check trending tests
         check_trending()
@@ -337,3 +442,37 @@ class TrendingTestCase(APITestCase):
         for idx, trending_profile in enumerate(trending_profiles):
             exp_score_2dp = '{0:.2f}'.format(exp_trending_scores[idx])
             exp_score_2dp.should.equal('{0:.2f}'.format(trending_profile.score))
+
+
+class TrendingScoringTestCase(SimpleTestCase):
+    @attr('slow')
+    @benchmark
+    def test_scoring_benchmark(self):
+        """
+        Scoring 1M users with NumPy arrays vs the dicts check_trending used
+
+        BENCHMARK=1 ./manage test --nologcapture tests.core.trending:TrendingScoringTestCase.test_scoring_benchmark
+        """
+        rnd = random.Random(42)
+        # (user id, source, in the current window, count) rows of the summed counters, two sources per user
+        counters = [(pk, source, rnd.random() < 0.7, int(rnd.paretovariate(1.5)))
+                    for pk in range(1, 1000001) for source in rnd.sample(trending.USER_SOURCES, 2)]
+
+        started = time.perf_counter()
+        current, previous = defaultdict(int), defaultdict(int)
+        for object_id, source, is_current, total in counters:
+            (current if is_current else previous)[object_id] += trending.weight[source] * total
+        threshold = settings.TRENDING_THRESHOLD
+        scores = {pk: (score - previous.get(pk, 0)) / max(previous.get(pk, 0), threshold)
+                  for pk, score in current.items()}
+        expected = sorted(scores.items(), key=itemgetter(1), reverse=True)[:settings.TRENDING_LIMIT]
+        with_dicts = time.perf_counter() - started
+
+        started = time.perf_counter()
+        ids, scores = trending.trending_scores(*trending.sum_windows(counters))
+        best = trending.best(scores, settings.TRENDING_LIMIT)
+        vectorized = time.perf_counter() - started
+
+        list(zip(ids[best].tolist(), scores[best].tolist())).should.equal(expected)
+        logger.debug('Scoring 1M users: dicts %.3fs, NumPy %.3fs', with_dicts, vectorized)
+        (with_dicts / vectorized).should.be.greater_than(2)
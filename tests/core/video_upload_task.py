@@ -1,49 +1,358 @@
+import binascii
+import ftplib
+import hashlib
+import json
 import os
-from unittest.mock import patch
+import subprocess
+import tarfile
+from datetime import timedelta
+from io import BytesIO
+from unittest.mock import patch, MagicMock
 
-from django.db import IntegrityError
+import boto3
+from botocore.stub import Stubber, ANY
 from django.conf import settings
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.utils import timezone
 
-from tests.factories import VideoFactory, GlacierFileFactory
-from heartface.apps.core.tasks import upload_video_glacier
+from tests.factories import VideoFactory, GlacierFileFactory, HashtagFactory, CommentFactory, UserFactory
+from heartface.apps.core.models import GlacierFile, Video, VideoCDNStatus, Comment, UploadSession
+from heartface.apps.core.tasks import upload_video_glacier, upload_videos_glacier, probe_video, check_cdn_availability
+from heartface.libs import cdn_availability, cdn_upload, glacier, video_cleanup
 
 import sure
 
+MB = 1024 * 1024
 
+
+def expected_tree_hash(data):
+    hashes = [hashlib.sha256(data[i:i + MB]).digest() for i in range(0, len(data), MB)]
+    while len(hashes) > 1:
+        pairs = [hashes[i:i + 2] for i in range(0, len(hashes), 2)]
+        hashes = [hashlib.sha256(b''.join(pair)).digest() if len(pair) == 2 else pair[0] for pair in pairs]
+    return binascii.hexlify(hashes[0]).decode('ascii')
+
+
+@override_settings(AWS_GLACIER_PART_SIZE=MB, AWS_GLACIER_MAX_CONCURRENT_PARTS=2)
 class TestUpload(TestCase):
-    @patch('heartface.apps.core.tasks.subprocess')
-    def test_glacier_upload(self, subprocess):
-        video = VideoFactory()
+    def setUp(self):
+        self.client = boto3.client('glacier', region_name='us-east-1', aws_access_key_id='test',
+                                   aws_secret_access_key='test')
+        self.stubber = Stubber(self.client)
+        self.vault = dict(accountId='-', vaultName=settings.AWS_GLACIER_VAULT_NAME)
+        # The parts as uploaded, they're in the expected params as ANY as they're uploaded in parallel
+        self.parts = {}
+        self.client.meta.events.register('before-parameter-build.glacier.UploadMultipartPart', self._record_part)
+
+        patcher = patch('heartface.libs.glacier._client', return_value=self.client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _record_part(self, params, **kwargs):
+        self.parts[int(params['range'].split()[1].split('-')[0])] = params['body']
+
+    def uploaded(self):
+        return b''.join(self.parts[offset] for offset in sorted(self.parts))
+
+    def expect_archive(self, parts, archive_id, checksum=ANY):
+        self.stubber.add_response('initiate_multipart_upload', {'location': '/', 'uploadId': 'uploadId'},
+                                  dict(self.vault, archiveDescription=ANY, partSize=str(MB)))
+        for _ in range(parts):
+            self.stubber.add_response('upload_multipart_part', {'checksum': 'checksum'},
+                                      dict(self.vault, uploadId='uploadId', range=ANY, checksum=ANY, body=ANY))
+        self.stubber.add_response('complete_multipart_upload',
+                                  {'location': '/', 'checksum': 'checksum', 'archiveId': archive_id},
+                                  dict(self.vault, uploadId='uploadId', archiveSize=ANY, checksum=checksum))
 
-        subprocess.check_output.return_value = 'Archive ID: archiveId'
+    def test_glacier_upload(self):
+        data = os.urandom(3 * MB + 1000)
+        video = VideoFactory(videofile__data=data)
+        self.expect_archive(4, 'archiveId', checksum=expected_tree_hash(data))
 
-        upload_video_glacier(video.pk)
+        with self.stubber:
+            upload_video_glacier(video.pk)
 
+        self.stubber.assert_no_pending_responses()
+        self.uploaded().should.equal(data)
         video.glacierfile.archive_id.should.equal('archiveId')
         os.path.exists(video.videofile.path).should.be.falsy
 
-    @patch('heartface.apps.core.tasks.subprocess')
-    def test_missing_file(self, subprocess):
+    def test_missing_file(self):
         video = VideoFactory()
 
         os.unlink(video.videofile.path)
 
         upload_video_glacier(video.pk).should.be.none
 
-    @patch('heartface.apps.core.tasks.subprocess')
-    @patch('heartface.apps.core.tasks.GlacierFile')
-    @patch('heartface.apps.core.tasks.boto3')
-    def test_already_uploaded_to_glacier(self, boto3, GlacierFile, subprocess):
-        video = VideoFactory()
+    def test_already_uploaded_to_glacier(self):
+        video = VideoFactory(videofile__data=b'video')
         GlacierFileFactory(video=video, size=100, archive_id='12345')
+        self.expect_archive(1, 'archiveId')
+        self.stubber.add_response('delete_archive', {}, dict(self.vault, archiveId='archiveId'))
 
-        client = boto3.client.return_value
-        subprocess.check_output.return_value = 'Archive ID: archiveId'
+        with self.stubber:
+            upload_video_glacier(video.pk).should.be.none
 
-        GlacierFile.objects.create.side_effect = IntegrityError()
+        self.stubber.assert_no_pending_responses()
+        GlacierFile.objects.get(video=video).archive_id.should.equal('12345')
 
-        upload_video_glacier(video.pk).should.be.none
+    @override_settings(AWS_GLACIER_BUNDLE_VIDEO_SIZE=MB, AWS_GLACIER_BUNDLE_MAX_SIZE=2 * MB)
+    def test_bundle(self):
+        small = [VideoFactory(videofile__data=os.urandom(700 * 1024)) for _ in range(3)]
+        large = VideoFactory(videofile__data=os.urandom(MB))
+        contents = {video.pk: open(video.videofile.path, 'rb').read() for video in small}
+
+        glacier.bundles([video.pk for video in small + [large]]) \
+            .should.equal([[small[0].pk, small[1].pk], [large.pk], [small[2].pk]])
+
+        self.expect_archive(2, 'archiveId')
+        with self.stubber:
+            upload_videos_glacier([small[0].pk, small[1].pk])
+        self.stubber.assert_no_pending_responses()
+
+        with tarfile.open(fileobj=BytesIO(self.uploaded())) as tar:
+            manifest = json.loads(tar.extractfile('manifest.json').read().decode('utf-8'))
+            [entry['video_id'] for entry in manifest].should.equal([small[0].pk, small[1].pk])
+            for entry in manifest:
+                tar.extractfile(entry['name']).read().should.equal(contents[entry['video_id']])
+                glacier_file = GlacierFile.objects.get(video_id=entry['video_id'])
+                (glacier_file.archive_id, glacier_file.member).should.equal(('archiveId', entry['name']))
+        os.path.exists(small[0].videofile.path).should.be.falsy
+
+
+FFPROBE_OUTPUT = b'''{
+    "streams": [
+        {"codec_type": "audio", "codec_name": "aac"},
+        {"codec_type": "video", "codec_name": "h264", "width": 720, "height": 1280}
+    ],
+    "format": {"duration": "14.766000", "bit_rate": "2413522"}
+}'''
+
+
+class TestProbe(TestCase):
+    @patch('heartface.libs.video_probe.subprocess.run')
+    def test_probe_video(self, run):
+        video = VideoFactory()
+        # Warnings on stderr don't get in the way
+        run.return_value = subprocess.CompletedProcess([], 0, FFPROBE_OUTPUT, b'Stream #1: unknown codec')
+
+        probe_video(video.pk)
+
+        run.call_args[0][0][-1].should.equal(video.videofile.path)
+        video.refresh_from_db()
+        (video.video_length, video.width, video.height, video.video_codec, video.bitrate) \
+            .should.equal((14, 720, 1280, 'h264', 2413522))
+
+    @patch('heartface.libs.video_probe.subprocess.run')
+    def test_probe_failure(self, run):
+        video = VideoFactory()
+        run.return_value = subprocess.CompletedProcess([], 1, b'{}', b'Invalid data found')
+
+        with patch('heartface.libs.video_probe.logger') as logger:
+            probe_video(video.pk).should.be(False)
+        logger.warning.call_args[0][-1].should.equal('Invalid data found')
+
+        video.refresh_from_db()
+        video.video_length.should.be.none
+
+
+class FakeFTP(object):
+    """
+    Just enough of ftplib.FTP for cdn_upload, with the remote files in `files`
+    """
+    def __init__(self, files):
+        self.files = files
+        self.closed = False
+
+    def cwd(self, path):
+        pass
+
+    def voidcmd(self, command):
+        pass
+
+    def size(self, name):
+        if name not in self.files:
+            raise ftplib.error_perm('550 No such file')
+        return len(self.files[name])
+
+    def storbinary(self, command, f, blocksize, rest=None):
+        name = command.split(' ', 1)[1]
+        self.files[name] = self.files.get(name, b'')[:rest or 0] + f.read()
+
+    def close(self):
+        self.closed = True
+
+
+class TestCDNUpload(TestCase):
+    def setUp(self):
+        self.files = {}
+        self.connections = []
+        while not cdn_upload._idle_connections.empty():
+            cdn_upload._idle_connections.get()
+
+    def _connect(self):
+        self.connections.append(FakeFTP(self.files))
+        return self.connections[-1]
+
+    def test_resume_and_reuse_connection(self):
+        video = VideoFactory(videofile__data=os.urandom(1000))
+        with open(video.videofile.path, 'rb') as f:
+            data = f.read()
+        name = os.path.basename(video.videofile.name)
+        # What a broken off upload left there
+        self.files[name] = data[:len(data) // 2]
+
+        with patch('heartface.libs.cdn_upload._connect', self._connect):
+            stats = cdn_upload.upload(video.videofile.path, '/upload/', name)
+            stats.resumed_from.should.equal(len(data) // 2)
+            stats.bytes_sent.should.equal(len(data) - len(data) // 2)
+            self.files[name].should.equal(data)
+
+            # Already there
+            cdn_upload.upload(video.videofile.path, '/upload/', name).bytes_sent.should.equal(0)
+
+        self.connections.should.have.length_of(1)
+
+
+class TestCDNAvailability(TestCase):
+    @patch('heartface.apps.core.tasks.upload_video_glacier')
+    @patch('heartface.libs.cdn_availability._session')
+    def test_check_cdn_availability(self, _session, upload_video_glacier):
+        on_cdn = VideoFactory(cdn_available=None)
+        not_on_cdn = VideoFactory(cdn_available=None)
+        reported_complete = VideoFactory(cdn_available=None)
+        # Not through the signal, that would mark it available
+        VideoCDNStatus.objects.bulk_create([
+            VideoCDNStatus(video=reported_complete, filename=reported_complete.videofile.name, status='complete')
+        ])
+        given_up = VideoFactory(cdn_available=None, published=timezone.now() - settings.CDN_CHECK_MAX_AGE * 2)
+        VideoFactory(cdn_available=None, published=None)
+        VideoFactory()
+
+        session = MagicMock()
+        session.__enter__.return_value = session
+        session.head.side_effect = lambda url, timeout: MagicMock(
+            status_code=404 if url == not_on_cdn.videofile_cdn_url else 200)
+        _session.return_value = session
+
+        check_cdn_availability()
+
+        for video in (on_cdn, not_on_cdn, reported_complete, given_up):
+            video.refresh_from_db()
+        (on_cdn.cdn_available, reported_complete.cdn_available).shouldnt.contain(None)
+        (not_on_cdn.cdn_available, given_up.cdn_available).should.equal((None, None))
+        # Neither the ones the CDN reported nor the ones given up on are checked
+        requested = set(call[0][0] for call in session.head.call_args_list)
+        requested.should.contain(on_cdn.videofile_cdn_url)
+        requested.should.contain(not_on_cdn.videofile_cdn_url)
+        requested.shouldnt.contain(reported_complete.videofile_cdn_url)
+        requested.shouldnt.contain(given_up.videofile_cdn_url)
+        set(call[1]['video_id'] for call in upload_video_glacier.delay.call_args_list) \
+            .should.equal({on_cdn.pk, reported_complete.pk})
+
+        # Once only
+        upload_video_glacier.reset_mock()
+        check_cdn_availability()
+        upload_video_glacier.delay.called.should.be.false
+
+    @override_settings(CDN_CHECK_BATCH_SIZE=2)
+    @patch('heartface.libs.cdn_availability._session')
+    def test_sweeps_rotate(self, _session):
+        videos = [VideoFactory(cdn_available=None, published=timezone.now() - timedelta(minutes=i)) for i in range(3)]
+        session = MagicMock()
+        session.__enter__.return_value = session
+        session.head.return_value = MagicMock(status_code=404)
+        _session.return_value = session
+
+        def checked():
+            urls = set(call[0][0] for call in session.head.call_args_list)
+            session.head.reset_mock()
+            return [video for video in videos if video.videofile_cdn_url in urls]
+
+        # The newest first, then the one left out, not the same ones again (e.g. by an overlapping sweep)
+        cdn_availability.sweep()
+        checked().should.equal(videos[:2])
+        cdn_availability.sweep()
+        checked().should.equal(videos[2:])
+        cdn_availability.sweep()
+        checked().should.equal([])
+
+        # Then the ones checked the longest ago
+        Video.objects.filter(pk=videos[1].pk) \
+            .update(cdn_checked=timezone.now() - settings.CDN_CHECK_INTERVAL - timedelta(minutes=2))
+        Video.objects.filter(pk=videos[2].pk) \
+            .update(cdn_checked=timezone.now() - settings.CDN_CHECK_INTERVAL - timedelta(minutes=1))
+        cdn_availability.sweep()
+        checked().should.equal(videos[1:])
+
+
+class TestUnpublishedCleanup(TestCase):
+    def setUp(self):
+        self.stale = [VideoFactory(published=None) for _ in range(3)]
+        self.fresh = VideoFactory(published=None)
+        self.published = VideoFactory()
+        Video.objects.exclude(pk=self.fresh.pk) \
+            .update(created=timezone.now() - settings.UNPUBLISHED_VIDEO_RETAIN_WINDOW - timedelta(hours=1))
+
+        self.stale[0].hashtags.add(HashtagFactory())
+        VideoCDNStatus.objects.create(video=self.stale[0], filename=self.stale[0].videofile.name, status='pending')
+        CommentFactory(video=self.stale[1])
+
+        patcher = patch('heartface.libs.video_cleanup.bulk')
+        self.bulk = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_cleanup(self):
+        video_cleanup.cleanup(chunk_size=2).should.equal((3, False))
+
+        Video.objects.filter(pk__in=[video.pk for video in self.stale]).exists().should.be.false
+        set(Video.objects.values_list('pk', flat=True)).should.equal({self.fresh.pk, self.published.pk})
+        VideoCDNStatus.objects.exists().should.be.false
+        Comment.objects.exists().should.be.false
+        for video in self.stale:
+            os.path.exists(video.videofile.path).should.be.false
+        os.path.exists(self.fresh.videofile.path).should.be.true
+
+        # One bulk request per chunk
+        [[action['_id'] for action in call[0][1]] for call in self.bulk.call_args_list] \
+            .should.equal([[self.stale[0].pk, self.stale[1].pk], [self.stale[2].pk]])
+
+    def test_dry_run(self):
+        video_cleanup.cleanup(dry_run=True).should.equal((3, False))
+
+        Video.objects.count().should.equal(5)
+        os.path.exists(self.stale[0].videofile.path).should.be.true
+        self.bulk.called.should.be.false
+
+    def test_time_budget(self):
+        video_cleanup.cleanup(time_budget=0, chunk_size=2).should.equal((2, True))
+        Video.objects.filter(pk=self.stale[2].pk).exists().should.be.true
+
+        # The next one carries on
+        video_cleanup.cleanup(time_budget=0, chunk_size=2).should.equal((1, True))
+        Video.objects.filter(pk=self.stale[2].pk).exists().should.be.false
+
+
+class TestUploadCleanup(TestCase):
+    def _session(self, age, **kwargs):
+        path = os.path.join('videos', '%s.mp4' % os.urandom(8).hex())
+        os.makedirs(os.path.join(settings.MEDIA_ROOT, 'videos'), exist_ok=True)
+        open(os.path.join(settings.MEDIA_ROOT, path), 'wb').close()
+        session = UploadSession.objects.create(owner=UserFactory(), filename='clip.mp4', path=path, length=100,
+                                               **kwargs)
+        UploadSession.objects.filter(pk=session.pk).update(updated=timezone.now() - age)
+        return session
+
+    def test_cleanup_uploads(self):
+        expired = self._session(settings.VIDEO_UPLOAD_SESSION_EXPIRY + timedelta(minutes=1))
+        fresh = self._session(timedelta(minutes=1))
+        being_written = self._session(settings.VIDEO_UPLOAD_SESSION_EXPIRY + timedelta(minutes=1),
+                                      claimed_until=timezone.now() + timedelta(minutes=1))
+
+        video_cleanup.cleanup_uploads(dry_run=True).should.equal(1)
+        UploadSession.objects.count().should.equal(3)
 
-        client.delete_archive.assert_called_once_with(archiveId='archiveId',
-                                                      vaultName=settings.AWS_GLACIER_VAULT_NAME)
+        video_cleanup.cleanup_uploads().should.equal(1)
+        set(UploadSession.objects.values_list('pk', flat=True)).should.equal({fresh.pk, being_written.pk})
+        os.path.exists(os.path.join(settings.MEDIA_ROOT, expired.path)).should.be.false
+        os.path.exists(os.path.join(settings.MEDIA_ROOT, fresh.path)).should.be.true
@@ -1,17 +1,25 @@
 #!/usr/bin/env python
 # coding=utf-8
+import datetime
+import os
+import zlib
 from typing import List
+from unittest.mock import patch
 
 from django.conf import settings
 from django.db import transaction
+from django.test import override_settings
+from django.utils import timezone
 from parameterized import parameterized
 from rest_framework import status
 from rest_framework.test import APITestCase
 
 
-from heartface.apps.core.models import Video, View, ReportedVideo
+from heartface.apps.core.models import Video, View, Like, Hashtag, ReportedVideo, UploadSession, VideoCDNStatus
+from heartface.apps.core.tasks import ingest_views
+from heartface.libs import engagement, view_ingestion
 from tests.factories import UserFactory, VideoFactory, ProductFactory, HashtagFactory, LikeFactory, \
-    SupplierProductFactory
+    SupplierProductFactory, CommentFactory
 
 import sure
 
@@ -63,6 +71,86 @@ class VideoTestCase(APITestCase):
         response = self.client.post('/api/v1/videos/%s/views/' % non_existent_video_id)
         response.status_code.should.equal(status.HTTP_404_NOT_FOUND)
 
+    @override_settings(VIEW_INGESTION_MODE='buffered')
+    def test_view_video_buffered(self):
+        view_ingestion._connection().delete(view_ingestion.QUEUE_KEY)
+        video = VideoFactory()
+        other_video = VideoFactory()
+        user = UserFactory()
+        View.objects.create(video=other_video, user=user)
+        # Ids are reused by new test databases
+        for video_id in (video.id, other_video.id):
+            view_ingestion._connection().delete(view_ingestion.USER_VIEWS_KEY % video_id,
+                                                view_ingestion.ANONYMOUS_VIEWS_KEY % video_id)
+
+        self.client.force_login(user)
+        self.client.post('/api/v1/videos/%s/views/' % video.id).status_code.should.equal(status.HTTP_201_CREATED)
+        self.client.post('/api/v1/videos/%s/views/' % video.id).status_code.should.equal(status.HTTP_200_OK)
+        # Seen before the buffering, dropped by the consumer
+        self.client.post('/api/v1/videos/%s/views/' % other_video.id)
+        self.client.logout()
+        for user_agent in ('one', 'other', 'one'):
+            self.client.post('/api/v1/videos/%s/views/' % video.id, HTTP_USER_AGENT=user_agent)
+
+        # Nothing's written until the queue is ingested
+        View.objects.filter(video=video).count().should.equal(0)
+
+        view_ingestion.ingest(batch_size=2).should.equal(3)
+        View.objects.filter(video=video, user=user).count().should.equal(1)
+        View.objects.filter(video=video, user=None).count().should.equal(2)
+        View.objects.filter(video=other_video).count().should.equal(1)
+        video.refresh_from_db()
+        video.view_count.should.equal(3)
+        other_video.refresh_from_db()
+        other_video.view_count.should.equal(0)
+
+        view_ingestion.ingest().should.equal(0)
+
+    def test_ingest_views_direct(self):
+        # The task is scheduled in both modes, but only buffered views are queued
+        with patch('heartface.libs.view_ingestion.ingest') as ingest:
+            ingest_views()
+        ingest.called.should.be(False)
+
+        with override_settings(VIEW_INGESTION_MODE='buffered'), patch('heartface.libs.view_ingestion.ingest') as ingest:
+            ingest_views()
+        ingest.called.should.be(True)
+
+    def test_engagement_counts(self):
+        video = VideoFactory()
+        user = UserFactory()
+
+        self.client.force_login(user)
+        self.client.post('/api/v1/videos/%s/like/' % video.id)
+        self.client.post('/api/v1/videos/%s/like/' % video.id)
+        CommentFactory(video=video)
+        CommentFactory(video=video)
+        video.refresh_from_db()
+        (video.like_count, video.comment_count).should.equal((1, 2))
+
+        response = self.client.get('/api/v1/videos/%s/' % video.id)
+        (response.data['like_count'], response.data['comment_count']).should.equal((1, 2))
+
+        self.client.delete('/api/v1/videos/%s/like/' % video.id)
+        video.comments.first().delete()
+        video.refresh_from_db()
+        (video.like_count, video.comment_count).should.equal((0, 1))
+
+        # Drift (e.g. from a bulk operation) is fixed by the reconciliation
+        Video.objects.filter(pk=video.pk).update(like_count=5, comment_count=0)
+        LikeFactory(video=video)
+        engagement.reconcile().should.equal(2)
+        video.refresh_from_db()
+        (video.like_count, video.comment_count).should.equal((1, 1))
+        engagement.reconcile().should.equal(0)
+
+        # Nor are the counts made negative by drift the other way
+        Video.objects.filter(pk=video.pk).update(like_count=0, comment_count=0)
+        Like.objects.filter(video=video).first().delete()
+        video.comments.first().delete()
+        video.refresh_from_db()
+        (video.like_count, video.comment_count).should.equal((0, 0))
+
     def test_double_like_video(self):
         video = VideoFactory()
         user = UserFactory()
@@ -145,6 +233,35 @@ class VideoTestCase(APITestCase):
         video.title.should.equal(new_title)
 
 
+    def test_hashtags_from_text(self):
+        existing = HashtagFactory(name='shoes')
+        video = VideoFactory(title='New #shoes', description='#sneakers and #shoes')
+        set(video.hashtags.values_list('name', flat=True)).should.equal({'shoes', 'sneakers'})
+        video.hashtags.filter(name='shoes').get().should.equal(existing)
+
+        video = Video.objects.get(pk=video.pk)
+        video.description = '#boots'
+        video.save()
+        set(video.hashtags.values_list('name', flat=True)).should.equal({'shoes', 'boots'})
+
+        # Saving anything else doesn't touch the hashtags
+        video = Video.objects.get(pk=video.pk)
+        video.view_count = 10
+        with self.assertNumQueries(1):
+            video.save()
+
+    def test_new_hashtags_are_indexed(self):
+        existing = HashtagFactory(name='shoes')
+        video = VideoFactory(title='New #shoes', description='#sneakers')
+        video.hashtags.clear()
+        Hashtag.objects.filter(name='sneakers').delete()
+        # The test transaction is never committed, run the callbacks right away
+        with patch('django.db.transaction.on_commit', side_effect=lambda func: func()), \
+                patch('heartface.apps.core.tasks.update_es_record_task.delay') as update_es_record:
+            video.sync_hashtags()
+        created = video.hashtags.exclude(pk=existing.pk).get()
+        update_es_record.assert_called_once_with(created.pk, "Hashtag")
+
     def test_filter_by_hashtag(self):
         def tag(tag, videos: List[Video]):
             for v in videos:
@@ -184,6 +301,41 @@ class VideoTestCase(APITestCase):
 
         video.videofile_cdn_url.should.match('\.%s$' % settings.CDN_VIDEO_EXTENSION)
 
+    @patch('heartface.apps.core.api.views.feed.archive_videos')
+    def test_pushr_status(self, archive_videos):
+        video = VideoFactory(cdn_available=None)
+        other_video = VideoFactory(cdn_available=None)
+        video.cdn_key.should.equal(os.path.basename(video.videofile.name))
+
+        response = self.client.get('/api/v1/videos/pushr-status/', {'filename': video.cdn_key, 'status': 'transcoding'})
+        response.status_code.should.equal(status.HTTP_200_OK)
+        video.cdn_status.get().status.should.equal('transcoding')
+
+        response = self.client.get('/api/v1/videos/pushr-status/', {'filename': 'unknown.mp4', 'status': 'complete'})
+        response.status_code.should.equal(status.HTTP_404_NOT_FOUND)
+
+        # Batched
+        response = self.client.post('/api/v1/videos/pushr-status/', {'statuses': [
+            {'filename': video.cdn_key, 'status': 'complete'},
+            {'filename': other_video.cdn_key, 'error': 'Unsupported codec'},
+            {'filename': 'unknown.mp4', 'status': 'complete'},
+        ]}, format='json')
+        response.status_code.should.equal(status.HTTP_200_OK)
+        response.data.should.equal({'missing': ['unknown.mp4']})
+
+        video.refresh_from_db()
+        other_video.refresh_from_db()
+        video.cdn_available.shouldnt.be.none
+        other_video.cdn_available.should.be.none
+        (other_video.cdn_status.get().status, other_video.cdn_status.get().description) \
+            .should.equal(('error', 'Unsupported codec'))
+        archive_videos.assert_called_with([video.pk])
+
+        response = self.client.post('/api/v1/videos/pushr-status/', {'statuses': [{'status': 'complete'}]},
+                                    format='json')
+        response.status_code.should.equal(status.HTTP_400_BAD_REQUEST)
+        VideoCDNStatus.objects.count().should.equal(3)
+
     def test_video_has_likes_list_even_if_no_likes(self):
         video = VideoFactory()
 
@@ -226,3 +378,73 @@ class VideoProductTaggingTestCase(APITestCase):
         response = self.client.delete('/api/v1/videos/%s/products/' % video.pk, {'id': product.pk})
 
         response.status_code.should.equal(status.HTTP_200_OK)
+
+
+class ResumableUploadTestCase(APITestCase):
+    DATA = os.urandom(1000)
+
+    def setUp(self):
+        self.user = UserFactory()
+        self.client.force_login(self.user)
+        response = self.client.post('/api/v1/uploads/', {'filename': 'clip.mp4', 'length': len(self.DATA)})
+        response.status_code.should.equal(status.HTTP_201_CREATED)
+        response['Location'].should.match('http://testserver/api/v1/uploads/%s/$' % response.data['id'])
+        self.url = '/api/v1/uploads/%s/' % response.data['id']
+
+    def _patch(self, offset, data):
+        return self.client.patch(self.url, data, content_type='application/offset+octet-stream',
+                                 HTTP_UPLOAD_OFFSET=str(offset))
+
+    def test_upload_in_chunks(self):
+        self._patch(0, self.DATA[:400]).status_code.should.equal(status.HTTP_204_NO_CONTENT)
+
+        # Resuming from a wrong offset
+        response = self._patch(300, self.DATA[300:])
+        response.status_code.should.equal(status.HTTP_409_CONFLICT)
+        response['Upload-Offset'].should.equal('400')
+
+        # Finalizing too early
+        self.client.post(self.url + 'finalize/').status_code.should.equal(status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.head(self.url)
+        response['Upload-Offset'].should.equal('400')
+        response = self._patch(400, self.DATA[400:])
+        response['Upload-Offset'].should.equal('1000')
+
+        response = self.client.post(self.url + 'finalize/', {'checksum': '%08x' % zlib.crc32(self.DATA)})
+        response.status_code.should.equal(status.HTTP_201_CREATED)
+        video = Video.objects.get(pk=response.data['id'])
+        video.owner.should.equal(self.user)
+        video.videofile.name.should.match('^videos/.*\.mp4$')
+        with open(video.videofile.path, 'rb') as f:
+            f.read().should.equal(self.DATA)
+
+        self.client.get(self.url).status_code.should.equal(status.HTTP_404_NOT_FOUND)
+
+    def test_chunk_being_written(self):
+        # Another request is writing the upload
+        UploadSession.objects.update(claimed_until=timezone.now() + datetime.timedelta(minutes=1))
+        response = self._patch(0, self.DATA)
+        response.status_code.should.equal(status.HTTP_409_CONFLICT)
+        response['Upload-Offset'].should.equal('0')
+
+        # It went away without saving its offset
+        UploadSession.objects.update(claimed_until=timezone.now() - datetime.timedelta(minutes=1))
+        self._patch(0, self.DATA).status_code.should.equal(status.HTTP_204_NO_CONTENT)
+        session = UploadSession.objects.get()
+        (session.offset, session.claimed_until).should.equal((len(self.DATA), None))
+
+    def test_checksum_mismatch(self):
+        self._patch(0, self.DATA)
+        response = self.client.post(self.url + 'finalize/', {'checksum': '00000000'})
+        response.status_code.should.equal(status.HTTP_400_BAD_REQUEST)
+        Video.objects.filter(owner=self.user).exists().should.be.false
+
+        for checksum in (1234, 'bogus'):
+            response = self.client.post(self.url + 'finalize/', {'checksum': checksum}, format='json')
+            response.status_code.should.equal(status.HTTP_400_BAD_REQUEST)
+            response.data.should.have.key('checksum')
+
+    def test_other_users_upload(self):
+        self.client.force_login(UserFactory())
+        self._patch(0, self.DATA).status_code.should.equal(status.HTTP_404_NOT_FOUND)
@@ -2,9 +2,25 @@
 # coding=utf-8
 import datetime
 import json
+import os
+import unittest
 
+from django.core.cache import caches
 from django.utils import timezone
 
+# Benchmarks time things and take a while, they're left out of test runs unless BENCHMARK is set
+benchmark = unittest.skipUnless(os.environ.get('BENCHMARK'), 'A benchmark, set BENCHMARK to run it')
+
+
+class SharedCacheMixin(object):
+    """
+    Clears the shared cache (the follow graph, the recommendation pools) after each test, it isn't rolled back with the
+    test database
+    """
+    def tearDown(self):
+        caches['shared'].clear()
+        super().tearDown()
+
 
 class Clock(object):
     DEFAULT_TICK_LENGTH = datetime.timedelta(seconds=1)